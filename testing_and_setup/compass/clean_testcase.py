@@ -10,11 +10,12 @@ import sys
 import os
 import shutil
 import fnmatch
-import re
 import argparse
 import subprocess
 import xml.etree.ElementTree as ET
 
+from list_testcases import get_test_cases, get_test_case
+
 if __name__ == "__main__":
     # Define and process input arguments
     parser = argparse.ArgumentParser(
@@ -68,26 +69,21 @@ if __name__ == "__main__":
         if args.case_num:
             use_case_list = True
             case_list = args.case_num.split(',')
+            for case_num in case_list:
+                if get_test_case(case_num) is None:
+                    parser.error(' Invalid case number {}. See '
+                                 'list_testcases.py for the available test '
+                                 'cases.'.format(case_num))
         else:
             use_case_list = False
             case_list = list()
             case_list.append(0)
     else:
         use_case_list = True
-        valid_case = 1
-        case_num = 1
         case_list = list()
 
-        regex = re.compile('(\d):')
-        core_configuration = subprocess.check_output(['./list_testcases.py'])
-        for line in core_configuration.split('\n'):
-            if regex.search(line) is not None:
-                conf_arr = line.replace(":", " ").split()
-                case_num = int(conf_arr[0])
-                del conf_arr
-                case_list.append(case_num)
-        del core_configuration
-        del regex
+        for case in get_test_cases():
+            case_list.append(case['number'])
 
     if not args.work_dir:
         args.work_dir = os.getcwd()
@@ -112,14 +108,11 @@ if __name__ == "__main__":
         # If we're using a case_list, determine the core, configuration, and
         # resolution for the current test case.
         if use_case_list:
-            core_configuration = subprocess.check_output(
-                    ['./list_testcases.py', '-n',
-                     '{:d}'.format(int(case_num))])
-            config_options = core_configuration.strip('\n').split(' ')
-            args.core = config_options[1]
-            args.configuration = config_options[3]
-            args.resolution = config_options[5]
-            args.test = config_options[7]
+            case = get_test_case(case_num)
+            args.core = case['core']
+            args.configuration = case['configuration']
+            args.resolution = case['resolution']
+            args.test = case['test']
 
         # Setup each xml file in the configuration directory:
         test_path = '{}/{}/{}/{}'.format(args.core, args.configuration,
@@ -187,17 +180,14 @@ if __name__ == "__main__":
         history_file.write('setup the following cases:\n')
         if use_case_list:
             for case_num in case_list:
-                core_configuration = subprocess.check_output(
-                        ['./list_testcases.py', '-n',
-                         '{:d}'.format(int(case_num))])
-                config_options = core_configuration.strip('\n').split(' ')
+                case = get_test_case(case_num)
                 history_file.write('\n')
-                history_file.write('    core: {}\n'.format(config_options[1]))
+                history_file.write('    core: {}\n'.format(case['core']))
                 history_file.write('    configuration: {}\n'.format(
-                        config_options[3]))
+                        case['configuration']))
                 history_file.write('    resolution: {}\n'.format(
-                        config_options[5]))
-                history_file.write('    test: {}\n'.format(config_options[7]))
+                        case['resolution']))
+                history_file.write('    test: {}\n'.format(case['test']))
         else:
             history_file.write('core: {}\n'.format(args.core))
             history_file.write('configuration: {}\n'.format(
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+This module downloads and validates the files that test cases require (e.g.
+meshes and initial conditions from <get_file> tags).
+
+Files are downloaded with urllib2, so any URL it supports (http, https, ftp or
+file) can be used as a mirror, including a local HTTP server for testing.
+Downloads are written to a partial file next to their destination and renamed
+into place once complete. An interrupted download is resumed from its partial
+file with an HTTP range request, if the mirror supports them.
+
+The mirrors of a file are probed in parallel, and the file is downloaded from
+the mirrors that responded, fastest first. If a validation function is given,
+a downloaded file that it rejects is deleted and the next mirror is tried.
+Many files can be fetched concurrently with fetch_files.
+
+The file_id of a validated file is recorded in a sidecar file (.<name>.file_id)
+next to it, along with the file's size and modification time, so later setups
+do not need to open the file again unless it has changed.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import urllib2
+import Queue
+from multiprocessing.pool import ThreadPool
+
+import netCDF4
+
+# Number of files downloaded at once by fetch_files, and the timeout (in
+# seconds) for connecting to a mirror.
+default_workers = 4
+timeout = 60
+
+# Size of the blocks downloaded files are written in.
+block_size = 1024 * 1024
+
+# Serializes output from concurrent downloads.
+print_lock = threading.Lock()
+
+# Serializes reading netCDF files, since netCDF4/HDF5 is not thread safe and
+# files are validated in the threads that downloaded them.
+netcdf_lock = threading.Lock()
+
+
+def log(message):  # {{{
+    with print_lock:
+        print message
+        sys.stdout.flush()
+# }}}
+
+
+def probe_mirrors(urls):  # {{{
+    # Check all mirrors in parallel, yielding the URLs of those that respond
+    # in the order they respond. Mirrors that didn't respond (e.g. servers
+    # that don't support HEAD requests) are yielded last, so they are still
+    # tried.
+    responses = Queue.Queue()
+
+    def probe(url):
+        try:
+            request = urllib2.Request(url)
+            request.get_method = lambda: 'HEAD'
+            urllib2.urlopen(request, timeout=timeout).close()
+            responses.put((url, True))
+        except Exception:
+            responses.put((url, False))
+
+    for url in urls:
+        thread = threading.Thread(target=probe, args=(url,))
+        thread.daemon = True
+        thread.start()
+
+    unresponsive = list()
+    for _ in urls:
+        url, responded = responses.get()
+        if responded:
+            yield url
+        else:
+            unresponsive.append(url)
+
+    for url in unresponsive:
+        yield url
+# }}}
+
+
+def download(url, dest):  # {{{
+    # Download url to dest, resuming from a partial download if there is one.
+    # Returns True if the download completed.
+    part_path = '{}.part'.format(dest)
+    if os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+    else:
+        offset = 0
+
+    request = urllib2.Request(url)
+    if offset > 0:
+        request.add_header('Range', 'bytes={:d}-'.format(offset))
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code != 416 or offset == 0:
+            return False
+        # The partial file can't be resumed (e.g. it is from a different
+        # version of the file), so start again.
+        os.remove(part_path)
+        return download(url, dest)
+    except Exception:
+        return False
+
+    try:
+        # If the mirror ignored the range request, start from the beginning.
+        if offset > 0 and response.getcode() == 206:
+            part_file = open(part_path, 'ab')
+        else:
+            part_file = open(part_path, 'wb')
+            offset = 0
+        try:
+            shutil.copyfileobj(response, part_file, block_size)
+        finally:
+            part_file.close()
+        expected_size = response.info().getheader('Content-Length')
+    except Exception:
+        return False
+    finally:
+        response.close()
+
+    # Keep the partial file if the connection was closed early, so the
+    # download can be resumed.
+    if expected_size is not None and \
+            os.path.getsize(part_path) != offset + int(expected_size):
+        return False
+
+    os.rename(part_path, dest)
+    return True
+# }}}
+
+
+def fetch_file(dest, urls, validate=None):  # {{{
+    # Download the file dest from the first of the mirrors in urls that
+    # works. If validate is given, it is called with the path of each
+    # downloaded file, and files it returns False for are deleted and the
+    # next mirror is tried. Returns True if dest exists afterwards.
+    if os.path.exists(dest):
+        return True
+
+    if not urls:
+        return False
+
+    file_name = os.path.basename(dest)
+    log(' -- Downloading {}'.format(file_name))
+    start = time.time()
+    for url in probe_mirrors(urls):
+        if not download(url, dest):
+            log('  -- Web mirror attempt failed. Trying other mirrors...')
+            continue
+
+        if validate is not None and not validate(dest):
+            if os.path.exists(dest):
+                os.remove(dest)
+            log('  -- File from {} is not valid. Trying other '
+                'mirrors...'.format(url))
+            continue
+
+        log(' -- Downloaded {} in {:.1f} s'.format(file_name,
+                                                   time.time() - start))
+        return True
+
+    return False
+# }}}
+
+
+def fetch_files(files, workers=None, validate=None):  # {{{
+    # Download several files concurrently. files is a list of (dest, urls)
+    # tuples, and validate is used for each file as in fetch_file. Returns a
+    # dictionary mapping each dest to True if it exists afterwards.
+    if workers is None:
+        workers = default_workers
+
+    # Each destination is only fetched once, from all of its mirrors.
+    mirrors = dict()
+    for dest, urls in files:
+        dest = os.path.abspath(dest)
+        mirrors.setdefault(dest, list())
+        for url in urls:
+            if url not in mirrors[dest]:
+                mirrors[dest].append(url)
+
+    missing = [dest for dest in mirrors if not os.path.exists(dest)]
+    if len(missing) <= 1 or workers <= 1:
+        for dest in missing:
+            fetch_file(dest, mirrors[dest], validate)
+    else:
+        pool = ThreadPool(min(workers, len(missing)))
+        try:
+            pool.map(lambda dest: fetch_file(dest, mirrors[dest], validate),
+                     missing)
+        finally:
+            pool.close()
+            pool.join()
+
+    return dict([(dest, os.path.exists(dest)) for dest in mirrors])
+# }}}
+
+
+def get_sidecar_path(path):  # {{{
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{}.file_id'.format(name))
+# }}}
+
+
+def get_recorded_file_hash(path):  # {{{
+    # Return the file_id recorded for a file by get_file_hash, or None if none
+    # was recorded or the file has changed since.
+    try:
+        stat = os.stat(path)
+        sidecar_file = open(get_sidecar_path(path), 'r')
+        try:
+            sidecar = json.load(sidecar_file)
+        finally:
+            sidecar_file.close()
+        if sidecar['size'] == stat.st_size and \
+                sidecar['mtime'] == stat.st_mtime:
+            return str(sidecar['file_id'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    return None
+# }}}
+
+
+def get_file_hash(path):  # {{{
+    # Return the file_id attribute of a netCDF file, or None if it doesn't
+    # have one. The result is recorded in a sidecar file, and reused as long
+    # as the file's size and modification time haven't changed.
+    file_hash = get_recorded_file_hash(path)
+    if file_hash is not None:
+        return file_hash
+
+    stat = os.stat(path)
+    sidecar_path = get_sidecar_path(path)
+
+    with netcdf_lock:
+        nc = netCDF4.Dataset(path, 'r')
+        try:
+            file_hash = nc.file_id
+        except AttributeError:
+            return None
+        finally:
+            nc.close()
+
+    # Recording the file_id is best effort, since databases may be read-only.
+    temp_path = '{}.{:d}.tmp'.format(sidecar_path, os.getpid())
+    try:
+        sidecar_file = open(temp_path, 'w')
+        try:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime,
+                       'file_id': file_hash}, sidecar_file)
+        finally:
+            sidecar_file.close()
+        os.rename(temp_path, sidecar_path)
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return file_hash
+# }}}
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+This module provides the file operations used when setting up test cases and
+regression suites (creating symbolic links, making scripts executable, moving
+and removing files) without starting a subprocess for each one.
+
+Links and moves are atomic: the new file is created under a temporary name in
+the destination directory and renamed into place, so an existing destination
+is replaced in a single step and is never missing or partially written.
+
+Operations can also be queued and applied together with apply_operations. If
+a log is set with set_log, every operation is written to it as the equivalent
+shell command. For a dry run, operations can be logged without being
+performed.
+"""
+
+import os
+import sys
+import errno
+import shutil
+import itertools
+
+# File to log operations to, and whether operations are only logged.
+log_file = None
+dry_run = False
+
+# Counter for unique temporary file names within this process.
+temp_counter = itertools.count()
+
+
+def set_log(log=None, only_log=False):  # {{{
+    # Set the file object that operations are logged to. If only_log is True,
+    # operations are logged (to stdout if no log is given) but not performed.
+    global log_file, dry_run
+    if only_log and log is None:
+        log = sys.stdout
+    log_file = log
+    dry_run = only_log
+# }}}
+
+
+def log_operation(command):  # {{{
+    if log_file is not None:
+        log_file.write('{}\n'.format(command))
+    return not dry_run
+# }}}
+
+
+def get_temp_path(path):  # {{{
+    # A temporary name in the same directory as path, so renaming it to path
+    # is atomic.
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{}.tmp.{:d}.{:d}'.format(
+        name, os.getpid(), next(temp_counter)))
+# }}}
+
+
+def get_link_path(source, dest, follow_dest=False):  # {{{
+    # The path of the link that symlink(source, dest, follow_dest) creates: if
+    # dest is a directory, the link is created inside it. A link to a
+    # directory is only followed if follow_dest is True (like 'ln -sf' rather
+    # than 'ln -sfn').
+    if os.path.isdir(dest) and (follow_dest or not os.path.islink(dest)):
+        return os.path.join(dest, os.path.basename(source))
+    return dest
+# }}}
+
+
+def symlink(source, dest, follow_dest=False):  # {{{
+    # Create a symbolic link at dest pointing to source, replacing dest if it
+    # exists (like 'ln -sfn', or 'ln -sf' if follow_dest is True). If dest is
+    # a directory, the link is created inside it.
+    link_path = get_link_path(source, dest, follow_dest)
+    if follow_dest:
+        command = 'ln -sf'
+    else:
+        command = 'ln -sfn'
+
+    if not log_operation('{} {} {}'.format(command, source, dest)):
+        return
+
+    temp_path = get_temp_path(link_path)
+    os.symlink(source, temp_path)
+    try:
+        os.rename(temp_path, link_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+# }}}
+
+
+def make_executable(path):  # {{{
+    # Add execute permission for all users (like 'chmod a+x').
+    if not log_operation('chmod a+x {}'.format(path)):
+        return
+
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode | 0o111)
+# }}}
+
+
+def move(source, dest):  # {{{
+    # Move a file, replacing dest if it exists (like 'mv'). Files are renamed
+    # when possible. Otherwise (e.g. across file systems) they are copied to a
+    # temporary file next to dest, which is then renamed into place.
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        dest = os.path.join(dest, os.path.basename(source))
+
+    if not log_operation('mv {} {}'.format(source, dest)):
+        return
+
+    try:
+        os.rename(source, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        temp_path = get_temp_path(dest)
+        try:
+            shutil.copy2(source, temp_path)
+            os.rename(temp_path, dest)
+        except (IOError, OSError):
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.remove(source)
+# }}}
+
+
+def remove(path):  # {{{
+    # Remove a file or link, if it exists (like 'rm -f').
+    if not log_operation('rm -f {}'.format(path)):
+        return
+
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+# }}}
+
+
+def apply_operations(operations):  # {{{
+    # Apply a list of queued operations in order, each a tuple of a function
+    # from this module and its arguments, e.g. (symlink, source, dest).
+    for operation in operations:
+        operation[0](*operation[1:])
+# }}}
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
@@ -10,14 +10,25 @@ criteria.
 
 Additionally, if -n is passed in to get information about a single test case,
 it will only print the flags needed to setup that specific test case.
+
+The available test cases are cached in a catalog file (.testcase_catalog.json)
+next to this script. The catalog is rebuilt whenever a core, configuration,
+resolution or test directory, or any test XML file, is modified.
 """
 
 import os
 import fnmatch
 import argparse
 import xml.etree.ElementTree as ET
+import json
 import re
 
+catalog_file_name = '.testcase_catalog.json'
+catalog_version = 1
+
+# Catalogs that have already been loaded, keyed by script path.
+catalogs = dict()
+
 
 def print_case(quiet, args, core_dir, config_dir, res_dir, test_dir, case_num,
                print_num):  # {{{
@@ -41,6 +52,200 @@ def print_case(quiet, args, core_dir, config_dir, res_dir, test_dir, case_num,
 # }}}
 
 
+def get_core_dirs(script_path):  # {{{
+    core_dirs = list()
+    for core_dir in os.listdir(script_path):
+        if os.path.isdir('{}/{}'.format(script_path, core_dir)) and \
+                core_dir != '.git':
+            core_dirs.append(core_dir)
+    return core_dirs
+# }}}
+
+
+def build_catalog(script_path):  # {{{
+    # Walk the core/configuration/resolution/test tree and build a catalog of
+    # all test cases. Each case lists the XML files in its test directory,
+    # along with the tag of their root element.
+    #
+    # The modification times of every directory and XML file visited are
+    # stored, so the catalog can be checked for changes without parsing any
+    # XML files.
+    cases = list()
+    mtimes = dict()
+    core_dirs = get_core_dirs(script_path)
+
+    # Iterate over all cores
+    for core_dir in core_dirs:
+        mtimes[core_dir] = os.path.getmtime('{}/{}'.format(script_path,
+                                                           core_dir))
+        # Iterate over all configurations within a core
+        for config_dir in os.listdir('{}/{}'.format(script_path, core_dir)):
+            config_path = '{}/{}'.format(core_dir, config_dir)
+            if not os.path.isdir('{}/{}'.format(script_path, config_path)):
+                continue
+            mtimes[config_path] = os.path.getmtime(
+                '{}/{}'.format(script_path, config_path))
+            # Iterate over all resolutions within a configuration
+            for res_dir in os.listdir('{}/{}'.format(script_path,
+                                                     config_path)):
+                res_path = '{}/{}'.format(config_path, res_dir)
+                if not os.path.isdir('{}/{}'.format(script_path, res_path)):
+                    continue
+                mtimes[res_path] = os.path.getmtime(
+                    '{}/{}'.format(script_path, res_path))
+                # Iterate over all tests within a resolution
+                for test_dir in os.listdir('{}/{}'.format(script_path,
+                                                          res_path)):
+                    test_path = '{}/{}'.format(res_path, test_dir)
+                    if not os.path.isdir('{}/{}'.format(script_path,
+                                                        test_path)):
+                        continue
+                    mtimes[test_path] = os.path.getmtime(
+                        '{}/{}'.format(script_path, test_path))
+
+                    is_case = False
+                    files = list()
+                    # Iterate over all files within a test
+                    for case_file in os.listdir('{}/{}'.format(script_path,
+                                                               test_path)):
+                        if fnmatch.fnmatch(case_file, '*.xml'):
+                            file_path = '{}/{}'.format(test_path, case_file)
+                            mtimes[file_path] = os.path.getmtime(
+                                '{}/{}'.format(script_path, file_path))
+                            root = ET.parse('{}/{}'.format(
+                                script_path, file_path)).getroot()
+                            files.append({'name': case_file,
+                                          'type': root.tag})
+
+                            # Check to make sure the test is either a config
+                            # file or a driver_script file
+                            if root.tag == 'config' or \
+                                    root.tag == 'driver_script':
+                                is_case = True
+
+                    if is_case:
+                        cases.append({'number': len(cases) + 1,
+                                      'core': core_dir,
+                                      'configuration': config_dir,
+                                      'resolution': res_dir,
+                                      'test': test_dir,
+                                      'files': files})
+
+    return {'version': catalog_version,
+            'core_dirs': core_dirs,
+            'mtimes': mtimes,
+            'cases': cases}
+# }}}
+
+
+def catalog_is_current(catalog, script_path):  # {{{
+    if catalog.get('version') != catalog_version:
+        return False
+
+    # New cores only change the modification time of the top level directory,
+    # which also changes for unrelated reasons (e.g. writing the catalog), so
+    # compare the list of cores instead.
+    if catalog['core_dirs'] != get_core_dirs(script_path):
+        return False
+
+    for path, mtime in catalog['mtimes'].iteritems():
+        try:
+            if os.path.getmtime('{}/{}'.format(script_path, path)) != mtime:
+                return False
+        except OSError:
+            return False
+
+    return True
+# }}}
+
+
+def read_catalog(catalog_path):  # {{{
+    try:
+        catalog_file = open(catalog_path, 'r')
+        try:
+            catalog = json.load(catalog_file)
+        finally:
+            catalog_file.close()
+    except (IOError, ValueError):
+        return None
+
+    if not isinstance(catalog, dict):
+        return None
+
+    # Convert unicode strings back to plain strings, for use in paths and
+    # config options.
+    catalog['core_dirs'] = [str(core_dir) for core_dir in
+                            catalog.get('core_dirs', [])]
+    for case in catalog.get('cases', []):
+        for key in ['core', 'configuration', 'resolution', 'test']:
+            case[key] = str(case[key])
+        case['files'] = [{'name': str(case_file['name']),
+                          'type': str(case_file['type'])}
+                         for case_file in case['files']]
+    return catalog
+# }}}
+
+
+def write_catalog(catalog, catalog_path):  # {{{
+    # Write to a temporary file first and move it into place, so other
+    # processes never see a partially written catalog. The catalog is only a
+    # cache, so failing to write it (e.g. in a read-only checkout) is not an
+    # error.
+    temp_path = '{}.{:d}.tmp'.format(catalog_path, os.getpid())
+    try:
+        catalog_file = open(temp_path, 'w')
+        try:
+            json.dump(catalog, catalog_file)
+        finally:
+            catalog_file.close()
+        os.rename(temp_path, catalog_path)
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+# }}}
+
+
+def get_catalog(script_path=None):  # {{{
+    # Return the catalog of test cases, rebuilding it only if the test
+    # directories have changed since it was written.
+    if script_path is None:
+        script_path = os.path.dirname(os.path.realpath(__file__))
+    script_path = os.path.realpath(script_path)
+
+    if script_path in catalogs:
+        return catalogs[script_path]
+
+    catalog_path = '{}/{}'.format(script_path, catalog_file_name)
+    catalog = read_catalog(catalog_path)
+    if catalog is None or not catalog_is_current(catalog, script_path):
+        catalog = build_catalog(script_path)
+        write_catalog(catalog, catalog_path)
+
+    catalogs[script_path] = catalog
+    return catalog
+# }}}
+
+
+def get_test_cases(script_path=None):  # {{{
+    # Return a list of all test cases, in the order they are numbered.
+    return get_catalog(script_path)['cases']
+# }}}
+
+
+def get_test_case(case_num, script_path=None):  # {{{
+    # Return the test case with the given number, or None if there is no
+    # such test case.
+    cases = get_test_cases(script_path)
+    try:
+        case_num = int(case_num)
+    except ValueError:
+        return None
+    if case_num < 1 or case_num > len(cases):
+        return None
+    return cases[case_num - 1]
+# }}}
+
+
 if __name__ == "__main__":
     # Define and process input arguments
     parser = argparse.ArgumentParser(
@@ -78,47 +283,9 @@ if __name__ == "__main__":
     # Start case numbering at 1
     case_num = 1
 
-    script_path = os.path.dirname(os.path.realpath(__file__))
-    os.chdir(script_path)
-
-    # Iterate over all cores
-    for core_dir in os.listdir('.'):
-        if os.path.isdir(core_dir) and core_dir != '.git':
-            # Iterate over all configurations within a core
-            for config_dir in os.listdir(core_dir):
-                config_path = '{}/{}'.format(core_dir, config_dir)
-                if os.path.isdir(config_path):
-                    # Iterate over all resolutions within a configuration
-                    for res_dir in os.listdir(config_path):
-                        res_path = '{}/{}'.format(config_path, res_dir)
-                        if os.path.isdir(res_path):
-                            # Iterate over all tests within a resolution
-                            for test_dir in os.listdir(res_path):
-                                test_path = '{}/{}'.format(res_path, test_dir)
-                                if os.path.isdir(test_path):
-                                    do_print = False
-                                    # Iterate over all files within a test
-                                    for case_file in os.listdir(test_path):
-                                        if fnmatch.fnmatch(case_file, '*.xml'):
-                                            tree = ET.parse('{}/{}'.format(
-                                                test_path, case_file))
-                                            root = tree.getroot()
-
-                                            # Check to make sure the test is
-                                            # either a config file or a
-                                            # driver_script file
-                                            if root.tag == 'config' or \
-                                                    root.tag == \
-                                                    'driver_script':
-                                                do_print = True
-
-                                            del root
-                                            del tree
-
-                                    if do_print:
-                                        case_num = print_case(
-                                            quiet, args, core_dir, config_dir,
-                                            res_dir, test_dir, case_num,
-                                            print_num)
+    for case in get_test_cases():
+        case_num = print_case(quiet, args, case['core'],
+                              case['configuration'], case['resolution'],
+                              case['test'], case_num, print_num)
 
 # vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
@@ -19,20 +19,11 @@ import argparse
 import xml.etree.ElementTree as ET
 import subprocess
 
+from setup_testcase import get_setup_config, setup_cases, get_git_version
+import file_operations
 
-def process_test_setup(test_tag, config_file, work_dir, model_runtime,
-                       suite_script, baseline_dir, verbose):  # {{{
-
-    if verbose:
-        stdout = open(work_dir + '/manage_regression_suite.py.out', 'a')
-        stderr = stdout
-        print '     Script setup outputs to {}'.format(
-            work_dir + '/manage_regression_suite.py.out')
-    else:
-        dev_null = open('/dev/null', 'a')
-        stderr = dev_null
-        stdout = dev_null
 
+def get_test_info(test_tag):  # {{{
     # Process test attributes
     try:
         test_name = test_tag.attrib['name']
@@ -73,74 +64,98 @@ def process_test_setup(test_tag, config_file, work_dir, model_runtime,
         print "Exiting..."
         sys.exit(1)
 
-    # Determine the file name for the test case output
-    case_output_name = test_name.replace(' ', '_')
+    return test_name, test_core, test_configuration, test_resolution, \
+        test_test
+# }}}
 
-    # Setup test case
 
-    if baseline_dir == 'NONE':
-        subprocess.check_call(
-            ['./setup_testcase.py', '-q', '-f', config_file,
-             '--work_dir', work_dir, '-o', test_core, '-c', test_configuration,
-             '-r', test_resolution, '-t', test_test,  '-m', model_runtime],
-            stdout=stdout, stderr=stderr)
-    else:
-        subprocess.check_call(
-            ['./setup_testcase.py', '-q', '-f', config_file,
-             '--work_dir', work_dir, '-o', test_core, '-c', test_configuration,
-             '-r', test_resolution, '-t', test_test,  '-m', model_runtime,
-             '-b', baseline_dir], stdout=stdout, stderr=stderr)
+def process_test_setup(test_tag, suite_script):  # {{{
+    test_name, test_core, test_configuration, test_resolution, test_test = \
+        get_test_info(test_tag)
+
+    # Determine the file name for the test case output
+    case_output_name = test_name.replace(' ', '_')
 
     print "   -- Setup case '{}': -o {} -c {} -r {} -t {}".format(
         test_name, test_core, test_configuration, test_resolution, test_test)
 
-    # Write step into suite script to cd into the base of the regression suite
-    suite_script.write("os.chdir(base_path)\n")
-
-    # Write the step to define the output file
-    suite_script.write("case_output = open('case_outputs/{}', 'w')\n".format(
-        case_output_name))
-
-    # Write step to cd into test case directory
-    suite_script.write("os.chdir('{}/{}/{}/{}')\n".format(
-        test_core, test_configuration, test_resolution, test_test))
+    # Determine the resources needed by the test case, so the suite script
+    # can pack concurrently running tests into a core budget.
+    test_path = '{}/{}/{}/{}'.format(test_core, test_configuration,
+                                     test_resolution, test_test)
+    test_procs, test_threads, test_cores, test_cost = \
+        get_test_resources(test_path)
 
+    script_names = list()
     for script in test_tag:
         # Process test case script
         if script.tag == 'script':
             try:
-                script_name = script.attrib['name']
+                script_names.append(script.attrib['name'])
             except KeyError:
                 print "ERROR: <script> tag is missing 'name' attribute."
                 print 'Exiting...'
                 sys.exit(1)
 
-            command = "subprocess.check_call(['time', '-p', " \
-                      "'{}/{}/{}/{}/{}/{}']".format(
-                          work_dir, test_core, test_configuration,
-                          test_resolution, test_test, script_name)
-            command = '{}, stdout=case_output, stderr=case_output)'.format(
-                command)
-
-            # Write test case run step
-            suite_script.write("print ' ** Running case {}'\n".format(
-                test_name))
-            suite_script.write('try:\n')
-            suite_script.write('    {}\n'.format(command))
-            suite_script.write("    print '      PASS'\n")
-            suite_script.write('except subprocess.CalledProcessError:\n')
-            suite_script.write("    print '   ** FAIL (See case_outputs/{} "
-                               "for more information)'\n".format(
-                                       case_output_name))
-            suite_script.write("    test_failed = True\n")
-
-    # Finish writing test case output
-    suite_script.write("case_output.close()\n")
-    suite_script.write("\n")
+    # Write the test into the suite script's list of tests
+    suite_script.write("tests.append({{'name': {!r},\n"
+                       "              'case_output': {!r},\n"
+                       "              'path': {!r},\n"
+                       "              'scripts': {!r},\n"
+                       "              'cores': {:d},\n"
+                       "              'procs': {:d},\n"
+                       "              'threads': {:d},\n"
+                       "              'cost': {:d}}})\n".format(
+                           test_name, case_output_name, test_path,
+                           script_names, test_cores, test_procs,
+                           test_threads, test_cost))
+# }}}
+
+
+def setup_tests(test_tags, config_file, work_dir, model_runtime,
+                baseline_dir, verbose, setup_workers, force_setup):  # {{{
     if verbose:
-        stdout.close()
+        output = open(work_dir + '/manage_regression_suite.py.out', 'a')
+        print '     Script setup outputs to {}'.format(
+            work_dir + '/manage_regression_suite.py.out')
     else:
-        dev_null.close()
+        output = open('/dev/null', 'a')
+
+    cases = list()
+    for test_tag in test_tags:
+        test_info = get_test_info(test_tag)
+        cases.append(test_info[1:])
+
+    # Set up all test cases in this process, so the configuration, runtime
+    # definition and parsed XML files are shared between them. The output of
+    # the setup is redirected, as it was when setup_testcase.py was called
+    # for each test. As with the -q flag that was passed to
+    # setup_testcase.py, no command_history entry is written for each test
+    # case; the entry written at the end of main records the whole suite.
+    failed = False
+    stdout = sys.stdout
+    stderr = sys.stderr
+    sys.stdout = output
+    sys.stderr = output
+    try:
+        configs = get_setup_config(config_file, work_dir,
+                                   model_runtime=model_runtime,
+                                   baseline_dir=baseline_dir,
+                                   force_setup=force_setup)
+        setup_cases(cases, configs, setup_workers)
+    except SystemExit:
+        failed = True
+    finally:
+        sys.stdout = stdout
+        sys.stderr = stderr
+        output.close()
+
+    if failed:
+        print "ERROR: Setting up the test cases in the suite failed."
+        if not verbose:
+            print "       Use -v/--verbose to see the setup output."
+        print "Exiting..."
+        sys.exit(1)
 # }}}
 
 
@@ -202,7 +217,8 @@ def process_test_clean(test_tag, work_dir, suite_script):  # {{{
 
 
 def setup_suite(suite_tag, work_dir, model_runtime, config_file, baseline_dir,
-                verbose):
+                verbose, max_cores, setup_workers, force_setup, perf_history,
+                perf_sigma):
     # {{{
     try:
         suite_name = suite_tag.attrib['name']
@@ -214,61 +230,98 @@ def setup_suite(suite_tag, work_dir, model_runtime, config_file, baseline_dir,
     if not os.path.exists('{}'.format(work_dir)):
         os.makedirs('{}'.format(work_dir))
 
+    utility_scripts = '{}/utility_scripts'.format(
+        os.path.dirname(os.path.realpath(__file__)))
+
     # Create regression suite run script
     regression_script_name = '{}/{}.py'.format(work_dir, suite_name)
     regression_script = open('{}'.format(regression_script_name), 'w')
 
     # Write script header
     regression_script.write('#!/usr/bin/env python\n')
-    regression_script.write('\n')
-    regression_script.write('# This script was written by '
+    regression_script.write('"""\n')
+    regression_script.write('This script was written by '
                             'manage_regression_suite.py as part of a\n'
-                            '# regression_suite file\n')
+                            'regression_suite file\n')
+    regression_script.write('"""\n')
     regression_script.write('\n')
     regression_script.write('import sys\n')
     regression_script.write('import os\n')
-    regression_script.write('import subprocess\n')
-    regression_script.write('import numpy as np\n')
+    regression_script.write('import argparse\n')
     regression_script.write('\n')
-    regression_script.write("os.environ['PYTHONUNBUFFERED'] = '1'\n")
-    regression_script.write("test_failed = False\n")
+    regression_script.write("sys.path.insert(0, '{}')\n".format(
+        utility_scripts))
+    regression_script.write('from suite_runner import run_suite\n')
     regression_script.write('\n')
-    regression_script.write("if not os.path.exists('case_outputs'):\n")
-    regression_script.write("    os.makedirs('case_outputs')\n")
+    regression_script.write("os.environ['PYTHONUNBUFFERED'] = '1'\n")
+    regression_script.write('parser = argparse.ArgumentParser(\n'
+                            '        description=__doc__, '
+                            'formatter_class=argparse.RawTextHelpFormatter)\n')
+    regression_script.write('parser.add_argument("--max_cores", '
+                            'dest="max_cores", type=int,\n'
+                            '                    default={!r},\n'
+                            '                    help="If set, tests are run '
+                            'concurrently using at most "\n'
+                            '                         "this many cores.")\n'
+                            ''.format(max_cores))
+    regression_script.write('parser.add_argument("--perf_history", '
+                            'dest="perf_history",\n'
+                            '                    default={!r},\n'
+                            '                    help="If set, the timers and '
+                            'wall times of the tests "\n'
+                            '                         "are recorded in this '
+                            'performance history "\n'
+                            '                         "file.")\n'
+                            ''.format(perf_history))
+    regression_script.write('parser.add_argument("--perf_sigma", '
+                            'dest="perf_sigma", type=float,\n'
+                            '                    default={!r},\n'
+                            '                    help="If set, timer '
+                            'comparisons fail if a timer is "\n'
+                            '                         "more than this many '
+                            'standard deviations "\n'
+                            '                         "slower than in the '
+                            'performance history.")\n'
+                            ''.format(perf_sigma))
+    regression_script.write('parser.add_argument("--resume", dest="resume", '
+                            'action="store_true",\n'
+                            '                    help="If set, tests that '
+                            'passed in the previous run "\n'
+                            '                         "of the suite are not '
+                            'run again.")\n')
+    regression_script.write('parser.add_argument("--rerun_failed", '
+                            'dest="rerun_failed",\n'
+                            '                    action="store_true",\n'
+                            '                    help="If set, only tests '
+                            'that failed in the previous "\n'
+                            '                         "run of the suite are '
+                            'run again.")\n')
+    regression_script.write('args = parser.parse_args()\n')
     regression_script.write('\n')
     regression_script.write("base_path = '{}'\n".format(work_dir))
+    regression_script.write("suite_name = {!r}\n".format(suite_name))
+    regression_script.write("git_version = {!r}\n".format(
+        get_git_version(os.path.dirname(os.path.realpath(__file__)))))
+    regression_script.write('tests = list()\n')
 
     if verbose:
         # flush existing regression suite output file
         open(work_dir + '/manage_regression_suite.py.out', 'w').close()
 
-    for child in suite_tag:
-        # Process <test> tags within the test suite
-        if child.tag == 'test':
-            process_test_setup(child, config_file, work_dir, model_runtime,
-                               regression_script, baseline_dir, verbose)
-
-    regression_script.write("print 'TEST RUNTIMES:'\n")
-    regression_script.write("case_output = '/case_outputs/'\n")
-    regression_script.write("totaltime = 0\n")
-    regression_script.write("for _, _, files in os.walk(base_path + "
-                            "case_output):\n")
-    regression_script.write("    for afile in sorted(files):\n")
-    regression_script.write("        outputfile = base_path + case_output + "
-                            "afile\n")
-    regression_script.write("        runtime = np.ceil(float(subprocess."
-                            "check_output(\n"
-                            "                ['grep', 'real', outputfile])."
-                            "split('\\n')[-2].split()[1]))\n")
-    regression_script.write("        totaltime += runtime\n")
-    regression_script.write("        mins = int(np.floor(runtime/60.0))\n")
-    regression_script.write("        secs = int(np.ceil(runtime - mins*60))\n")
-    regression_script.write("        print '{:02d}:{:02d} {}'.format(mins, "
-                            "secs, afile)\n")
-    regression_script.write("mins = int(np.floor(totaltime/60.0))\n")
-    regression_script.write("secs = int(np.ceil(totaltime - mins*60))\n")
-    regression_script.write("print 'Total runtime {:02d}:{:02d}'.format(mins, "
-                            "secs)\n")
+    # Process <test> tags within the test suite
+    test_tags = [child for child in suite_tag if child.tag == 'test']
+    setup_tests(test_tags, config_file, work_dir, model_runtime, baseline_dir,
+                verbose, setup_workers, force_setup)
+    for test_tag in test_tags:
+        process_test_setup(test_tag, regression_script)
+
+    regression_script.write('\n')
+    regression_script.write('test_failed = run_suite(base_path, tests, '
+                            'args.max_cores, suite_name,\n'
+                            '                        git_version, '
+                            'args.perf_history, args.perf_sigma,\n'
+                            '                        args.resume, '
+                            'args.rerun_failed)\n')
     regression_script.write("\n")
 
     regression_script.write("if test_failed:\n")
@@ -277,11 +330,7 @@ def setup_suite(suite_tag, work_dir, model_runtime, config_file, baseline_dir,
     regression_script.write("    sys.exit(0)\n")
     regression_script.close()
 
-    dev_null = open('/dev/null', 'a')
-    subprocess.check_call(
-        ['chmod', 'a+x', '{}'.format(regression_script_name)],
-        stdout=dev_null, stderr=dev_null)
-    dev_null.close()
+    file_operations.make_executable(regression_script_name)
 # }}}
 
 
@@ -305,6 +354,58 @@ def clean_suite(suite_tag, work_dir):  # {{{
 # }}}
 
 
+def get_test_resources(test_path):  # {{{
+    # Determine the maximum number of MPI tasks, OpenMP threads, and total
+    # cores used by any <model_run> within the test case in test_path, and
+    # the total number of MPI tasks launched by all of them, which is used
+    # to estimate the cost of tests that have never been run.
+    max_procs = 1
+    max_threads = 1
+    max_cores = 1
+    total_procs = 0
+
+    # Loop over all files in test_path that have the .xml extension.
+    for file in os.listdir('{}'.format(test_path)):
+        if fnmatch.fnmatch(file, '*.xml'):
+            # Build full file name
+            config_file = '{}/{}'.format(test_path, file)
+
+            config_tree = ET.parse(config_file)
+            config_root = config_tree.getroot()
+
+            if config_root.tag == 'config':
+                for model_run in config_root.iter('model_run'):
+                    try:
+                        procs_str = model_run.attrib['procs']
+                        procs = int(procs_str)
+                    except (KeyError, ValueError):
+                        procs = 1
+
+                    try:
+                        threads_str = model_run.attrib['threads']
+                        threads = int(threads_str)
+                    except (KeyError, ValueError):
+                        threads = 1
+
+                    cores = threads * procs
+                    total_procs += procs
+
+                    if procs > max_procs:
+                        max_procs = procs
+
+                    if threads > max_threads:
+                        max_threads = threads
+
+                    if cores > max_cores:
+                        max_cores = cores
+
+            del config_root
+            del config_tree
+
+    return max_procs, max_threads, max_cores, max(total_procs, 1)
+# }}}
+
+
 def summarize_suite(suite_tag):  # {{{
 
     max_procs = 1
@@ -354,42 +455,11 @@ def summarize_suite(suite_tag):  # {{{
 
             test_path = '{}/{}/{}/{}'.format(test_core, test_configuration,
                                              test_resolution, test_test)
-            # Loop over all files in test_path that have the .xml extension.
-            for file in os.listdir('{}'.format(test_path)):
-                if fnmatch.fnmatch(file, '*.xml'):
-                    # Build full file name
-                    config_file = '{}/{}'.format(test_path, file)
-
-                    config_tree = ET.parse(config_file)
-                    config_root = config_tree.getroot()
-
-                    if config_root.tag == 'config':
-                        for model_run in config_root.iter('model_run'):
-                            try:
-                                procs_str = model_run.attrib['procs']
-                                procs = int(procs_str)
-                            except (KeyError, ValueError):
-                                procs = 1
-
-                            try:
-                                threads_str = model_run.attrib['threads']
-                                threads = int(threads_str)
-                            except (KeyError, ValueError):
-                                threads = 1
-
-                            cores = threads * procs
+            procs, threads, cores, _ = get_test_resources(test_path)
 
-                            if procs > max_procs:
-                                max_procs = procs
-
-                            if threads > max_threads:
-                                max_threads = threads
-
-                            if cores > max_cores:
-                                max_cores = cores
-
-                    del config_root
-                    del config_tree
+            max_procs = max(max_procs, procs)
+            max_threads = max(max_threads, threads)
+            max_cores = max(max_cores, cores)
 
     print "\n"
     print " Summary of test cases:"
@@ -428,6 +498,32 @@ if __name__ == "__main__":
                         help="If set, script will setup the test suite in "
                         "work_dir rather in this script's location.",
                         metavar="PATH")
+    parser.add_argument("--max_cores", dest="max_cores", type=int,
+                        help="If set, the generated suite script will run "
+                             "tests concurrently, packing them into at most "
+                             "this many cores. This can be overridden when "
+                             "running the suite script.", metavar="NUM")
+    parser.add_argument("--setup_workers", dest="setup_workers", type=int,
+                        help="If set, test cases are set up concurrently by "
+                             "this many processes.", metavar="NUM")
+    parser.add_argument("--force_setup", dest="force_setup",
+                        help="If set, all files in test cases are "
+                             "regenerated, even if their inputs haven't "
+                             "changed since the last setup.",
+                        action="store_true")
+    parser.add_argument("--perf_history", dest="perf_history",
+                        help="If set, the generated suite script records the "
+                             "timers and wall times of its tests in this "
+                             "performance history file, and timer "
+                             "comparisons are checked against it. This can "
+                             "be overridden when running the suite script.",
+                        metavar="FILE")
+    parser.add_argument("--perf_sigma", dest="perf_sigma", type=float,
+                        help="If set, timer comparisons in the generated "
+                             "suite script fail if a timer is more than this "
+                             "many standard deviations slower than its "
+                             "recent runs in the performance history.",
+                        metavar="NUM")
 
     args = parser.parse_args()
 
@@ -455,6 +551,9 @@ if __name__ == "__main__":
     if not args.baseline_dir:
         args.baseline_dir = 'NONE'
 
+    if args.perf_history:
+        args.perf_history = os.path.abspath(args.perf_history)
+
     if not args.setup and not args.clean:
         print 'WARNING: Neither the setup (-s/--setup) nor the clean ' \
               '(-c/--clean) flags were provided. Script will perform no ' \
@@ -478,7 +577,9 @@ if __name__ == "__main__":
             print "\n"
             print "Setting Up Test Cases:"
             setup_suite(suite_root, args.work_dir, args.model_runtime,
-                        args.config_file, args.baseline_dir, args.verbose)
+                        args.config_file, args.baseline_dir, args.verbose,
+                        args.max_cores, args.setup_workers,
+                        args.force_setup, args.perf_history, args.perf_sigma)
             summarize_suite(suite_root)
             if args.verbose:
                 cmd = ['cat',
@@ -491,12 +592,8 @@ if __name__ == "__main__":
     # provenance.
     if write_history:
         # Build variables for history output
-        old_dir = os.getcwd()
-        os.chdir(os.path.dirname(os.path.realpath(__file__)))
-        git_version = subprocess.check_output(
-            ['git', 'describe', '--tags', '--dirty'])
-        git_version = git_version.strip('\n')
-        os.chdir(old_dir)
+        git_version = get_git_version(
+            os.path.dirname(os.path.realpath(__file__)))
         calling_command = ""
         for arg in sys.argv:
             calling_command = "{}{} ".format(calling_command, arg)
@@ -10,73 +10,93 @@ import scipy.sparse.linalg
 import os.path
 
 
-def computeTransport():
-  transport = numpy.zeros(nEdges)
-  innerEdges = numpy.logical_and(cellsOnEdge[:,0] >= 0,cellsOnEdge[:,1] >= 0)
-  innerEdges = numpy.nonzero(innerEdges)[0]
-  for iEdge in innerEdges:
-    cell0 = cellsOnEdge[iEdge,0]
-    cell1 = cellsOnEdge[iEdge,1]
-    layerThicknessEdge = 0.5*(layerThickness[cell0,:] + layerThickness[cell1,:])
-    transport[iEdge] = dvEdge[iEdge]*numpy.sum(layerThicknessEdge*normalVelocity[iEdge,:])
-
-  return (innerEdges,transport)
-  
-def computeBSF():
+def buildTransportOperator():
+  # the layer thickness averaged from cells to each inner edge, times the
+  # length of the edge
+  nInnerEdges = len(innerEdges)
+  rows = numpy.repeat(numpy.arange(nInnerEdges), 2)
+  columns = cellsOnEdge[innerEdges,:].ravel()
+  data = 0.5*numpy.repeat(dvEdge[innerEdges], 2)
+  return scipy.sparse.csr_matrix((data,(rows,columns)),shape=(nInnerEdges,nCells))
+
+def computeTransport(normalVelocity, layerThickness):
+  # the transport across each inner edge at each time (the first dimension of
+  # normalVelocity and layerThickness), with a single sparse product
+  nTimes = layerThickness.shape[0]
+  layerThicknessCells = numpy.rollaxis(layerThickness, 1).reshape((nCells, -1))
+  layerThicknessEdge = transportOperator.dot(layerThicknessCells).reshape(
+    (len(innerEdges), nTimes, nVertLevels))
+  transport = numpy.sum(layerThicknessEdge
+                        *numpy.rollaxis(normalVelocity[:,innerEdges,:], 1), axis=2)
+
+  return transport
+
+def buildBSFOperator():
+  # The bsf is the least-squares solution of a system with a row for the
+  # difference of the bsf across each inner edge (the transport across it) and
+  # a row setting the bsf to zero at each boundary vertex.  The matrix only
+  # depends on the mesh, so it is built once, and the normal equations (which
+  # are symmetric positive definite) are factored once and reused for every
+  # time.
   boundaryVertices = numpy.logical_or(cellsOnVertex[:,0] ==-1,cellsOnVertex[:,1] ==-1)
   boundaryVertices = numpy.logical_or(boundaryVertices,cellsOnVertex[:,2] ==-1)
   boundaryVertices = numpy.nonzero(boundaryVertices)[0]
   nBoundaryVertices = len(boundaryVertices)
   nInnerEdges = len(innerEdges)
-  
-  rhs = numpy.zeros(nInnerEdges+nBoundaryVertices,dtype=float)
-  indices = numpy.zeros((2,2*nInnerEdges+nBoundaryVertices),dtype=int)
+
+  rows = numpy.zeros(2*nInnerEdges+nBoundaryVertices,dtype=int)
+  columns = numpy.zeros(2*nInnerEdges+nBoundaryVertices,dtype=int)
   data = numpy.zeros(2*nInnerEdges+nBoundaryVertices,dtype=float)
-  for index in range(nInnerEdges):
-  
-    iEdge = innerEdges[index]
-    v0 = verticesOnEdge[iEdge,0]
-    v1 = verticesOnEdge[iEdge,1]
-    
-    indices[0,2*index] = index
-    indices[1,2*index] = v1
-    data[2*index] = 1.
-    indices[0,2*index+1] = index
-    indices[1,2*index+1] = v0
-    data[2*index+1] = -1.
-    
-    rhs[index] = transport[iEdge]*1e-6 #in Sv
-  
-  for index in range(nBoundaryVertices):
-    iVertex = boundaryVertices[index]
-    indices[0,2*nInnerEdges+index] = nInnerEdges+index
-    indices[1,2*nInnerEdges+index] = iVertex
-    data[2*nInnerEdges+index] = 1. 
-    rhs[nInnerEdges+index] = 0. # bsf is zero at the boundaries
-  
-  M = scipy.sparse.csr_matrix((data,indices),shape=(nInnerEdges+nBoundaryVertices,nVertices))
-  
-  solution = scipy.sparse.linalg.lsqr(M,rhs)
-  
-  bsf = -solution[0]
+
+  rows[0:2*nInnerEdges:2] = numpy.arange(nInnerEdges)
+  columns[0:2*nInnerEdges:2] = verticesOnEdge[innerEdges,1]
+  data[0:2*nInnerEdges:2] = 1.
+  rows[1:2*nInnerEdges:2] = numpy.arange(nInnerEdges)
+  columns[1:2*nInnerEdges:2] = verticesOnEdge[innerEdges,0]
+  data[1:2*nInnerEdges:2] = -1.
+
+  # bsf is zero at the boundaries
+  rows[2*nInnerEdges:] = nInnerEdges + numpy.arange(nBoundaryVertices)
+  columns[2*nInnerEdges:] = boundaryVertices
+  data[2*nInnerEdges:] = 1.
+
+  M = scipy.sparse.csr_matrix((data,(rows,columns)),shape=(nInnerEdges+nBoundaryVertices,nVertices))
+
+  # only the inner edge rows have a nonzero right-hand side
+  MTransposeInner = M[0:nInnerEdges,:].transpose().tocsr()
+  factorization = scipy.sparse.linalg.splu(M.transpose().dot(M).tocsc())
+  return MTransposeInner, factorization
+
+def computeBSF(transport):
+  # solve for the bsf at one or more times (the columns of transport) with a
+  # back-substitution
+  rhs = MTransposeInner.dot(transport*1e-6) #in Sv
+  bsf = -factorization.solve(rhs)
   return bsf
 
- 
-def computeBSFCell(bsf):
-  bsfCell = numpy.zeros(nCells)
-  for iCell in range(nCells):
-    edgeCount = nEdgesOnCell[iCell]
-    edges = edgesOnCell[iCell,0:edgeCount]
-    verts = verticesOnCell[iCell,0:edgeCount]
-    areaEdge = dcEdge[edges]*dvEdge[edges]
-    indexM1 = numpy.mod(numpy.arange(-1,edgeCount-1),edgeCount)
-    areaVert = 0.5*(areaEdge+areaEdge[indexM1])
-    bsfCell[iCell] = numpy.sum(areaVert*bsf[verts])/numpy.sum(areaVert)
-  
-  return bsfCell
+def buildBSFCellOperator():
+  # the bsf on cells is the average of the bsf on their vertices, weighted by
+  # the area of the cell associated with each vertex
+  maxEdges = edgesOnCell.shape[1]
+  edgeCount = nEdgesOnCell[:,numpy.newaxis]
+  indices = numpy.arange(maxEdges)[numpy.newaxis,:]
+  valid = indices < edgeCount
+  indexM1 = numpy.mod(indices-1, edgeCount)
+
+  edges = numpy.where(valid, edgesOnCell, 0)
+  edgesM1 = edges[numpy.arange(nCells)[:,numpy.newaxis],indexM1]
+  areaEdge = dcEdge[edges]*dvEdge[edges]
+  areaEdgeM1 = dcEdge[edgesM1]*dvEdge[edgesM1]
+  areaVert = numpy.where(valid, 0.5*(areaEdge+areaEdgeM1), 0.)
+  weights = areaVert/numpy.sum(areaVert, axis=1)[:,numpy.newaxis]
+
+  rows = numpy.repeat(numpy.arange(nCells)[:,numpy.newaxis], maxEdges, axis=1)
+  return scipy.sparse.csr_matrix((weights[valid], (rows[valid], verticesOnCell[valid])),
+                                 shape=(nCells,nVertices))
 
 parser = OptionParser()
-           
+parser.add_option("--blockSize", type="int", default=12, dest="blockSize",
+                  help="number of times read and solved for together")
 options, args = parser.parse_args()
 
 folder=args[0]
@@ -137,22 +157,28 @@ else:
   outBSF = outFile.createVariable('barotropicStreamfunction',float,['Time','nVertices'])
   outBSFCell = outFile.createVariable('barotropicStreamfunctionCell',float,['Time','nCells'])
 
+innerEdges = numpy.logical_and(cellsOnEdge[:,0] >= 0,cellsOnEdge[:,1] >= 0)
+innerEdges = numpy.nonzero(innerEdges)[0]
+
+transportOperator = buildTransportOperator()
+MTransposeInner, factorization = buildBSFOperator()
+bsfCellOperator = buildBSFCellOperator()
+
 print nTimeOut, nTimeIn
-for tIndex in range(nTimeOut,nTimeIn):
-  print tIndex, nTimeIn
-  normalVelocity = inFile.variables['normalVelocity'][tIndex,:,:]
-  layerThickness = inFile.variables['layerThickness'][tIndex,:,:]
-  
+for blockStart in range(nTimeOut,nTimeIn,options.blockSize):
+  blockEnd = min(blockStart+options.blockSize,nTimeIn)
+  print blockStart, blockEnd, nTimeIn
+  normalVelocity = inFile.variables['normalVelocity'][blockStart:blockEnd,:,:]
+  layerThickness = inFile.variables['layerThickness'][blockStart:blockEnd,:,:]
 
-  (innerEdges,transport) = computeTransport()
-  
-  bsf = computeBSF()
-  
-  bsfCell = computeBSFCell(bsf)
-  
-  
-  outBSF[tIndex,:] = bsf
-  outBSFCell[tIndex,:] = bsfCell
+  transport = computeTransport(normalVelocity, layerThickness)
+
+  bsf = computeBSF(transport)
+
+  bsfCell = bsfCellOperator.dot(bsf)
+
+  outBSF[blockStart:blockEnd,:] = bsf.transpose()
+  outBSFCell[blockStart:blockEnd,:] = bsfCell.transpose()
 
 outFile.close()
 inFile.close()
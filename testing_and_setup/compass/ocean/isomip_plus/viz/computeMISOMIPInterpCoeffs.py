@@ -1,133 +1,217 @@
 #!/usr/bin/env python
 import numpy
 from netCDF4 import Dataset
-from shapely.geometry import Polygon, LineString
 
 from optparse import OptionParser
 
 from progressbar import ProgressBar, Percentage, Bar, ETA
 
+import multiprocessing
+
 import os.path
 
-def getTransectWeights(outFileName, axis):
+# The MPAS cells are convex polygons and the MISOMIP grid is regular, so the
+# intersections are computed analytically for many cell/grid-cell pairs at
+# once. The candidate grid cells of each MPAS cell are found directly from its
+# bounding box (the regular grid is its own spatial index).
+
+def getCandidateRange(corners, minVals, maxVals):
+  # the range of output cells [lower, upper) that may overlap each interval
+  # [minVal, maxVal]: lower is the last corner below minVal and upper is the
+  # first corner above maxVal
+  nOut = len(corners)-1
+  lower = numpy.maximum(numpy.searchsorted(corners, minVals, 'left')-1, 0)
+  upper = numpy.minimum(numpy.searchsorted(corners, maxVals, 'right'), nOut)
+  return lower, numpy.maximum(upper, lower)
+
+def getCandidatePairs(lowerX, upperX, lowerY, upperY):
+  # all (cell, xIndex, yIndex) triples within the candidate ranges, ordered by
+  # cell, then yIndex, then xIndex
+  nxCandidates = upperX - lowerX
+  counts = nxCandidates*(upperY - lowerY)
+  pairCells = numpy.repeat(numpy.arange(len(counts)), counts)
+  offsets = (numpy.arange(numpy.sum(counts))
+             - numpy.repeat(numpy.cumsum(counts) - counts, counts))
+  xIndices = lowerX[pairCells] + offsets % nxCandidates[pairCells]
+  yIndices = lowerY[pairCells] + offsets // nxCandidates[pairCells]
+  return pairCells, xIndices, yIndices
+
+def getIntersectionAreas(xVert, yVert, x0, x1, y0, y1):
+  # The area of the intersection of each polygon (rows of xVert, yVert, closed
+  # and counterclockwise) with the box [x0,x1] x [y0,y1].  By Green's theorem,
+  # this is the integral of (clip(x, x0, x1) - x0) dy around the parts of the
+  # polygon within y0 <= y <= y1.  Along each edge, the integrand is linear
+  # between the points where the edge crosses x0 and x1, so the trapezoidal
+  # rule between these points is exact.
+  xa = xVert[:,:-1]
+  xb = xVert[:,1:]
+  ya = yVert[:,:-1]
+  yb = yVert[:,1:]
+  x0 = x0[:,numpy.newaxis]
+  x1 = x1[:,numpy.newaxis]
+
+  lower = numpy.maximum(numpy.minimum(ya,yb), y0[:,numpy.newaxis])
+  upper = numpy.minimum(numpy.maximum(ya,yb), y1[:,numpy.newaxis])
+  valid = upper > lower
+  dy = numpy.where(valid, yb - ya, 1.)
+  dx = xb - xa
+  slope = numpy.where(valid, dx/dy, 0.)
+  vertical = dx == 0.
+  dx = numpy.where(vertical, 1., dx)
+
+  points = [lower, upper]
+  for xClip in [x0, x1]:
+    yClip = numpy.where(vertical, lower, ya + (xClip - xa)*dy/dx)
+    points.append(numpy.clip(yClip, lower, upper))
+  points = numpy.sort(numpy.array(points), axis=0)
 
-  pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=nCells).start()
+  integrand = numpy.clip(xa + (points - ya)*slope, x0, x1) - x0
+  integral = numpy.sum(0.5*(points[1:] - points[:-1])
+                       *(integrand[1:] + integrand[:-1]), axis=0)
+  integral = numpy.where(valid, numpy.sign(dy)*integral, 0.)
+  return numpy.abs(numpy.sum(integral, axis=1))
 
+def getSliceIndices(outIndices):
+  # intersections with the same output cell are put in different slices, in
+  # the order they were found (by MPAS cell), so each slice touches each output
+  # cell at most once
+  order = numpy.argsort(outIndices, kind='mergesort')
+  sortedOut = outIndices[order]
+  isFirst = numpy.ones(len(order), bool)
+  isFirst[1:] = sortedOut[1:] != sortedOut[:-1]
+  firstIndices = numpy.maximum.accumulate(numpy.where(isFirst,
+    numpy.arange(len(order)), 0))
+  sliceIndices = numpy.zeros(len(order), int)
+  sliceIndices[order] = numpy.arange(len(order)) - firstIndices
+  return sliceIndices
+
+def getAreaWeights(cellRange):
+  # the intersections of MPAS cells [start, end) with the MISOMIP grid
+  start, end = cellRange
+  xVert = xCellVerts[start:end,:]
+  yVert = yCellVerts[start:end,:]
+
+  xl, xu = getCandidateRange(x, numpy.amin(xVert, axis=1),
+                             numpy.amax(xVert, axis=1))
+  yl, yu = getCandidateRange(y, numpy.amin(yVert, axis=1),
+                             numpy.amax(yVert, axis=1))
+  pairCells, xIndices, yIndices = getCandidatePairs(xl, xu, yl, yu)
+
+  areas = getIntersectionAreas(xVert[pairCells,:], yVert[pairCells,:],
+                               x[xIndices], x[xIndices+1],
+                               y[yIndices], y[yIndices+1])
+  weights = areas/outDx**2
+
+  # drop round-off from polygons that only touch a grid cell
+  mask = weights > minWeight
+  return (pairCells[mask]+start, xIndices[mask], yIndices[mask],
+          weights[mask])
+
+def getTransectWeights(cellRange, axis):
+  # the intersections of MPAS cells [start, end) with the transect
+  start, end = cellRange
   if axis == 'x':
     slicePos = xTransect
-    outNOther = outNy
     outOtherAxis = y
+    sliceAxisVerts = xCellVerts[start:end,:]
+    otherAxisVerts = yCellVerts[start:end,:]
   else:
     slicePos = yTransect
-    outNOther = outNx
     outOtherAxis = x
+    sliceAxisVerts = yCellVerts[start:end,:]
+    otherAxisVerts = xCellVerts[start:end,:]
 
-  sliceCount = numpy.zeros(outNOther,int)
-  cellIndices = []
-  otherIndices = []
-  weights = []
-  sliceIndices = []
-
-  for iCell in range(nCells):
-    verts = verticesOnCell[iCell,0:nEdgesOnCell[iCell]]
-    verts = numpy.append(verts,verts[0])
-    xVert = xVertex[verts]
-    yVert = yVertex[verts]
-
-    if axis == 'x':
-      sliceAxisVerts = xVert
-      otherAxisVerts = yVert
-    else:
-      sliceAxisVerts = yVert
-      otherAxisVerts = xVert
-
-
-
-    if(numpy.amax(sliceAxisVerts) < slicePos) or (numpy.amin(sliceAxisVerts) > slicePos):
-      # this polygon doesn't intersect the slice
-      continue
-
-    mpasPolygon = Polygon(zip(xVert,yVert))
-
-    indices = numpy.nonzero(outOtherAxis < numpy.amin(otherAxisVerts))[0]
-    if len(indices) == 0:
-      lower = 0
-    else:
-      lower = indices[-1]
-
-    indices = numpy.nonzero(outOtherAxis > numpy.amax(otherAxisVerts))[0]
-    if len(indices) == 0:
-      upper = outNOther
-    else:
-      upper = indices[0]
-
-    for otherIndex in range(lower, upper):
-      if axis == 'x':
-        vertices = ((slicePos, outOtherAxis[otherIndex]),
-                    (slicePos, outOtherAxis[otherIndex+1]))
-      else:
-        vertices = ((outOtherAxis[otherIndex], slicePos),
-                    (outOtherAxis[otherIndex+1], slicePos))
-
-      line = LineString(vertices)
-      if not mpasPolygon.intersects(line):
-        continue
-      length = mpasPolygon.intersection(line).length
-      if length == 0.0:
-        continue
-
-      cellIndices.append(iCell)
-      otherIndices.append(otherIndex)
-  
-      weights.append(length/outDx)
-  
-      sliceIndex = sliceCount[otherIndex]
-      sliceCount[otherIndex] += 1
-      sliceIndices.append(sliceIndex)
-    pbar.update(iCell+1)
-  
-  pbar.finish()
+  # the transect crosses a convex polygon along the interval between the
+  # points where it crosses the polygon's edges
+  sa = sliceAxisVerts[:,:-1]
+  sb = sliceAxisVerts[:,1:]
+  oa = otherAxisVerts[:,:-1]
+  ob = otherAxisVerts[:,1:]
+  crosses = ((numpy.minimum(sa,sb) <= slicePos)
+             & (numpy.maximum(sa,sb) >= slicePos) & (sa != sb))
+  ds = numpy.where(crosses, sb - sa, 1.)
+  crossing = oa + (slicePos - sa)*(ob - oa)/ds
+  cells = numpy.nonzero(numpy.any(crosses, axis=1))[0]
+  crosses = crosses[cells,:]
+  crossing = crossing[cells,:]
+  minVals = numpy.amin(numpy.where(crosses, crossing, numpy.inf), axis=1)
+  maxVals = numpy.amax(numpy.where(crosses, crossing, -numpy.inf), axis=1)
 
-  cellIndices = numpy.array(cellIndices)
-  otherIndices = numpy.array(otherIndices)
-  sliceIndices = numpy.array(sliceIndices)
-  weights = numpy.array(weights)
-
-  # sort the intersections first by otherIndex, then by sliceIndex
-  # for efficiency
-  nSlices = numpy.amax(sliceCount)
-  sortedIndices = numpy.zeros(0,int)
-  pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=nSlices).start()
-  for sliceIndex in range(nSlices):
-    intersectionsInSlice = numpy.nonzero(sliceIndices == sliceIndex)[0]
-    indices = numpy.argsort(otherIndices[intersectionsInSlice])
-    sortedIndices = numpy.append(sortedIndices,intersectionsInSlice[indices])
-    pbar.update(sliceIndex+1)
+  lower, upper = getCandidateRange(outOtherAxis, minVals, maxVals)
+  counts = upper - lower
+  pairCells = numpy.repeat(numpy.arange(len(cells)), counts)
+  otherIndices = (lower[pairCells] + numpy.arange(numpy.sum(counts))
+                  - numpy.repeat(numpy.cumsum(counts) - counts, counts))
+
+  lengths = (numpy.minimum(maxVals[pairCells], outOtherAxis[otherIndices+1])
+             - numpy.maximum(minVals[pairCells], outOtherAxis[otherIndices]))
+  weights = lengths/outDx
+
+  mask = weights > 0.
+  return cells[pairCells[mask]]+start, otherIndices[mask], weights[mask]
+
+def getXTransectWeights(cellRange):
+  return getTransectWeights(cellRange, axis='x')
+
+def getYTransectWeights(cellRange):
+  return getTransectWeights(cellRange, axis='y')
+
+def computeWeights(function):
+  # compute the intersections of chunks of cells, in parallel if requested,
+  # and concatenate them in cell order
+  cellRanges = [(start, min(start+chunkSize, nCells))
+                for start in range(0, nCells, chunkSize)]
+
+  pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()],
+                     maxval=len(cellRanges)).start()
+  if options.nProcs > 1:
+    pool = multiprocessing.Pool(options.nProcs)
+    results = pool.imap(function, cellRanges)
+  else:
+    pool = None
+    results = (function(cellRange) for cellRange in cellRanges)
+
+  chunks = []
+  for result in results:
+    chunks.append(result)
+    pbar.update(len(chunks))
   pbar.finish()
-  
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  return [numpy.concatenate([chunk[index] for chunk in chunks])
+          for index in range(len(chunks[0]))]
+
+def writeWeights(outFileName, cellIndices, indices, sliceIndices, weights,
+                 outIndices):
+  # sort the intersections first by sliceIndex, then by output cell for
+  # efficiency
+  sortedIndices = numpy.lexsort((outIndices, sliceIndices))
+
   outFile = Dataset(outFileName,'w',format='NETCDF4')
   outFile.createDimension('nIntersections', len(cellIndices))
   outFile.createVariable('cellIndices','i4',('nIntersections',))
-  if axis == 'x':
-    outFile.createVariable('yIndices','i4',('nIntersections',))
-  else:
-    outFile.createVariable('xIndices','i4',('nIntersections',))
+  for indexName in indices:
+    outFile.createVariable(indexName,'i4',('nIntersections',))
   outFile.createVariable('sliceIndices','i4',('nIntersections',))
   outFile.createVariable('mpasToMisomipWeights','f8',('nIntersections',))
-  
+
   outVars = outFile.variables
   outVars['cellIndices'][:] = cellIndices[sortedIndices]
-  if axis == 'x':
-    outVars['yIndices'][:] = otherIndices[sortedIndices]
-  else:
-    outVars['xIndices'][:] = otherIndices[sortedIndices]
-
+  for indexName in indices:
+    outVars[indexName][:] = indices[indexName][sortedIndices]
   outVars['sliceIndices'][:] = sliceIndices[sortedIndices]
   outVars['mpasToMisomipWeights'][:] = weights[sortedIndices]
-  
+
   outFile.close()
 
 parser = OptionParser()
+parser.add_option("--nProcs", type="int", default=1, dest="nProcs",
+                  help="number of processes used to compute the weights")
+parser.add_option("--chunkSize", type="int", default=1000, dest="chunkSize",
+                  help="number of MPAS cells handled at a time")
 options, args = parser.parse_args()
 
 if(len(args) == 0):
@@ -150,6 +234,11 @@ outNx = 240
 outNy = 40
 outNz = 144
 
+# weights below this are round-off in the areas of cells that only touch
+minWeight = 1e-10
+
+chunkSize = options.chunkSize
+
 # x, y and z of corners of grid cells
 x = outX0 + outDx*(numpy.arange(outNx+1))
 y = outY0 + outDx*(numpy.arange(outNy+1))
@@ -166,117 +255,34 @@ xVertex = inVars['xVertex'][:]
 yVertex = inVars['yVertex'][:]
 
 inFile.close()
+
+# the closed polygon of each cell, padded by repeating its first vertex so
+# the padding adds only zero-length edges
+maxEdges = verticesOnCell.shape[1]
+verts = numpy.zeros((nCells, maxEdges+1), int)
+verts[:,0:maxEdges] = verticesOnCell
+verts[:,maxEdges] = verticesOnCell[:,0]
+padding = numpy.arange(maxEdges+1)[numpy.newaxis,:] >= nEdgesOnCell[:,numpy.newaxis]
+verts[padding] = numpy.repeat(verticesOnCell[:,0], maxEdges+1)[padding.ravel()]
+xCellVerts = xVertex[verts]
+yCellVerts = yVertex[verts]
+
 if(not os.path.exists(interpWeightsFileName)):
-  
-  cellIndices = []
-  xIndices = []
-  yIndices = []
-  weights = []
-  sliceIndices = []
-  
-  sliceCount = numpy.zeros((outNy,outNx),int)
-  
-  pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=nCells).start()
-  
-  for iCell in range(nCells):
-    verts = verticesOnCell[iCell,0:nEdgesOnCell[iCell]]
-    verts = numpy.append(verts,verts[0])
-    xVert = xVertex[verts]
-    yVert = yVertex[verts]
-    mpasPolygon = Polygon(zip(xVert,yVert))
-    #mpasArea = mpasPolygon.area
-  
-    # find the out indices that bound the MPAS polygon
-    indices = numpy.nonzero(x < numpy.amin(xVert))[0]
-    if len(indices) == 0:
-      xl = 0
-    else:
-      xl = indices[-1]
-  
-    indices = numpy.nonzero(x > numpy.amax(xVert))[0]
-    if len(indices) == 0:
-      xu = outNx
-    else:
-      xu = indices[0]
-  
-    indices = numpy.nonzero(y < numpy.amin(yVert))[0]
-    if len(indices) == 0:
-      yl = 0
-    else:
-      yl = indices[-1]
-  
-    indices = numpy.nonzero(y > numpy.amax(yVert))[0]
-    if len(indices) == 0:
-      yu = outNy
-    else:
-      yu = indices[0]
-  
-    for yIndex in range(yl, yu):
-      for xIndex in range(xl, xu):
-        vertices = ((x[xIndex], y[yIndex]),
-                    (x[xIndex+1], y[yIndex]),
-                    (x[xIndex+1], y[yIndex+1]),
-                    (x[xIndex], y[yIndex+1]),
-                    (x[xIndex], y[yIndex]))
-        outPoly = Polygon(vertices)
-        if not mpasPolygon.intersects(outPoly):
-          continue
-        intersectionArea = mpasPolygon.intersection(outPoly).area
-        if intersectionArea == 0.:
-          continue
-  
-        cellIndices.append(iCell)
-        xIndices.append(xIndex)
-        yIndices.append(yIndex)
-  
-        weights.append(intersectionArea/outDx**2)
-  
-        sliceIndex = sliceCount[yIndex,xIndex]
-        sliceCount[yIndex,xIndex] += 1
-        sliceIndices.append(sliceIndex)
-    pbar.update(iCell+1)
-  
-  pbar.finish()
-  
-  cellIndices = numpy.array(cellIndices)
-  xIndices = numpy.array(xIndices)
-  yIndices = numpy.array(yIndices)
-  sliceIndices = numpy.array(sliceIndices)
-  weights = numpy.array(weights)
-  
-  # sort the intersections first by xIndex, then by yIndex, then by sliceIndex
-  # for efficiency
-  nSlices = numpy.amax(sliceCount)
-  sortedIndices = numpy.zeros(0,int)
+  cellIndices, xIndices, yIndices, weights = computeWeights(getAreaWeights)
   xyIndices = xIndices + outNx*yIndices
-  pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=nSlices).start()
-  for sliceIndex in range(nSlices):
-    intersectionsInSlice = numpy.nonzero(sliceIndices == sliceIndex)[0]
-    indices = numpy.argsort(xyIndices[intersectionsInSlice])
-    sortedIndices = numpy.append(sortedIndices,intersectionsInSlice[indices])
-    pbar.update(sliceIndex+1)
-  pbar.finish()
-  
-  outFile = Dataset(interpWeightsFileName,'w',format='NETCDF4')
-  outFile.createDimension('nIntersections', len(cellIndices))
-  outFile.createVariable('cellIndices','i4',('nIntersections',))
-  outFile.createVariable('xIndices','i4',('nIntersections',))
-  outFile.createVariable('yIndices','i4',('nIntersections',))
-  outFile.createVariable('sliceIndices','i4',('nIntersections',))
-  outFile.createVariable('mpasToMisomipWeights','f8',('nIntersections',))
-  
-  outVars = outFile.variables
-  outVars['cellIndices'][:] = cellIndices[sortedIndices]
-  outVars['xIndices'][:] = xIndices[sortedIndices]
-  outVars['yIndices'][:] = yIndices[sortedIndices]
-  outVars['sliceIndices'][:] = sliceIndices[sortedIndices]
-  outVars['mpasToMisomipWeights'][:] = weights[sortedIndices]
-  
-  outFile.close()
+  sliceIndices = getSliceIndices(xyIndices)
+  writeWeights(interpWeightsFileName, cellIndices,
+               {'xIndices': xIndices, 'yIndices': yIndices}, sliceIndices,
+               weights, xyIndices)
 
 if(not os.path.exists(xTransectFileName)):
-  getTransectWeights(xTransectFileName, axis='x')
+  cellIndices, yIndices, weights = computeWeights(getXTransectWeights)
+  sliceIndices = getSliceIndices(yIndices)
+  writeWeights(xTransectFileName, cellIndices, {'yIndices': yIndices},
+               sliceIndices, weights, yIndices)
 
 if(not os.path.exists(yTransectFileName)):
-  getTransectWeights(yTransectFileName, axis='y')
-  
+  cellIndices, xIndices, weights = computeWeights(getYTransectWeights)
+  sliceIndices = getSliceIndices(xIndices)
+  writeWeights(yTransectFileName, cellIndices, {'xIndices': xIndices},
+               sliceIndices, weights, xIndices)
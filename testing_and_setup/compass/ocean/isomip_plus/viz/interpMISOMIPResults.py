@@ -2,85 +2,91 @@
 import numpy
 from netCDF4 import Dataset
 
+import scipy.sparse
+
 from optparse import OptionParser
 
 from progressbar import ProgressBar, Percentage, Bar, ETA
 
 import os.path
 
-def interpHoriz(field, normalize=True):
-  outField = numpy.zeros((outNy,outNx))
-  for sliceIndex in range(xyNSlices):
-    mask = xySliceIndices == sliceIndex
-    cellsSlice = xyCellIndices[mask]
-    fieldSlice = field[cellsSlice]*(maxLevelCell[cellsSlice] >= 0)
-    outField[xyYIndices[mask],xyXIndices[mask]] += (xyMpasToMisomipWeights[mask]
-      * fieldSlice)
-  if normalize:
-    outField[xyOceanMask] /= xyOceanFraction[xyOceanMask]
-    outField[xyOceanMask == False] = 0.
-  return outField
-
-def interpXZTransect(field, normalize=True):
-  outField = numpy.zeros((outNz,outNx))
-
-  for sliceIndex in range(xzNSlices):
-    mask = xzSliceIndices == sliceIndex
-    cellsSlice = xzCellIndices[mask]
-    xIndices = xzXIndices[mask]
-    weights = xzMpasToMisomipWeights[mask]
-    for index in range(len(cellsSlice)):
-      iCell = cellsSlice[index]
-      xIndex = xIndices[index]
-      weight = weights[index]
-      layerThick = layerThickness[iCell,:]
-      layerThick[maxLevelCell[iCell]+1:] = 0.
-      zInterface = numpy.zeros(2*nVertLevels)
-      fieldColumn = numpy.zeros(2*nVertLevels)
-      fieldColumn[0::2] = field[iCell,:]
-      fieldColumn[1::2] = field[iCell,:]
-      zInterface[0] = ssh[iCell]
-      zInterface[1::2] = ssh[iCell] - numpy.cumsum(layerThick[:])
-      zInterface[2::2] = ssh[iCell] - numpy.cumsum(layerThick[:-1])
-      outField[:,xIndex] += weight*numpy.interp(z, zInterface[::-1], fieldColumn[::-1],
-                                                left=0., right=0.)
+def buildHorizOperators():
+  # sparse matrices from MPAS cells to the MISOMIP grid (flattened in y, then
+  # x), which only include ocean cells.  The normalized operator also divides
+  # by the ocean fraction of each grid cell, and is zero outside the ocean
+  weights = xyMpasToMisomipWeights*(maxLevelCell[xyCellIndices] >= 0)
+  rows = xyXIndices + outNx*xyYIndices
+  weightsOperator = scipy.sparse.csr_matrix((weights, (rows, xyCellIndices)),
+                                            shape=(outNy*outNx, nCells))
+
+  oceanFraction = weightsOperator.dot(numpy.ones(nCells))
+  oceanMask = oceanFraction > 0.001
+  normalization = numpy.zeros(oceanFraction.shape)
+  normalization[oceanMask] = 1./oceanFraction[oceanMask]
+  normalizedOperator = scipy.sparse.diags(normalization).dot(
+    weightsOperator).tocsr()
+
+  return (weightsOperator, normalizedOperator,
+          oceanFraction.reshape((outNy,outNx)), oceanMask.reshape((outNy,outNx)))
 
+def interpHoriz(field, normalize=True):
   if normalize:
-    outField[xzOceanMask] /= xzOceanFraction[xzOceanMask]
-    outField[xzOceanMask == False] = 0.
-
-  return outField
-
-def interpYZTransect(field, normalize=True):
-  outField = numpy.zeros((outNz,outNy))
-
-  for sliceIndex in range(yzNSlices):
-    mask = yzSliceIndices == sliceIndex
-    cellsSlice = yzCellIndices[mask]
-    yIndices = yzYIndices[mask]
-    weights = yzMpasToMisomipWeights[mask]
-    for index in range(len(cellsSlice)):
-      iCell = cellsSlice[index]
-      yIndex = yIndices[index]
-      weight = weights[index]
-      layerThick = layerThickness[iCell,:]
-      layerThick[maxLevelCell[iCell]+1:] = 0.
-      zInterface = numpy.zeros(2*nVertLevels)
-      fieldColumn = numpy.zeros(2*nVertLevels)
-      fieldColumn[0::2] = field[iCell,:]
-      fieldColumn[1::2] = field[iCell,:]
-      zInterface[0] = ssh[iCell]
-      zInterface[1::2] = ssh[iCell] - numpy.cumsum(layerThick[:])
-      zInterface[2::2] = ssh[iCell] - numpy.cumsum(layerThick[:-1])
-      outField[:,yIndex] += weight*numpy.interp(z, zInterface[::-1], fieldColumn[::-1],
-                                                left=0., right=0.)
+    operator = xyNormalizedOperator
+  else:
+    operator = xyWeightsOperator
+  return operator.dot(numpy.asarray(field)).reshape((outNy,outNx))
 
+def interpHorizFields(fields, normalize=True):
+  # remap a dictionary of fields with a single sparse matrix product
   if normalize:
-    outField[yzOceanMask] /= yzOceanFraction[yzOceanMask]
-    outField[yzOceanMask == False] = 0.
-
-  return outField
-
+    operator = xyNormalizedOperator
+  else:
+    operator = xyWeightsOperator
+  names = sorted(fields.keys())
+  outFields = operator.dot(numpy.column_stack([numpy.asarray(fields[name])
+                                               for name in names]))
+  return dict((name, outFields[:,index].reshape((outNy,outNx)))
+              for index, name in enumerate(names))
+
+def buildTransectOperator(cellIndices, otherIndices, weights, nOther):
+  # sparse matrix from fields on MPAS cells and layers (flattened by cell, then
+  # level) to a transect in z and the other horizontal direction (flattened in
+  # z, then the other direction).  Each column is piecewise constant in its
+  # layers and is sampled at the z centers of the MISOMIP grid, so each
+  # intersection contributes the layer it contains at each z (if any)
+  thickness = layerThickness[cellIndices,:]*cellMask[cellIndices,:]
+  sshColumns = ssh[cellIndices]
+  zBottom = sshColumns[:,numpy.newaxis] - numpy.cumsum(thickness, axis=1)
+
+  # the layer containing each z is the number of layer bottoms above it
+  levels = numpy.sum(zBottom[:,numpy.newaxis,:]
+                     > z[numpy.newaxis,:,numpy.newaxis], axis=2)
+  valid = numpy.logical_and(z[numpy.newaxis,:] < sshColumns[:,numpy.newaxis],
+                            levels < nVertLevels)
+
+  intersections, zIndices = numpy.nonzero(valid)
+  rows = otherIndices[intersections] + nOther*zIndices
+  columns = (nVertLevels*cellIndices[intersections]
+             + levels[intersections,zIndices])
+  return scipy.sparse.csr_matrix((weights[intersections], (rows, columns)),
+                                 shape=(outNz*nOther, nCells*nVertLevels))
+
+def interpTransect(operator, nOther, fields):
+  # remap a list of fields with a single sparse matrix product, along with
+  # the ocean fraction the fields are normalized by
+  outFields = operator.dot(numpy.column_stack([numpy.asarray(field).ravel()
+                                               for field in [cellMask]+fields]))
+  oceanFraction = outFields[:,0].reshape((outNz,nOther))
+  oceanMask = oceanFraction > 0.001
+
+  normalizedFields = []
+  for index in range(1,len(fields)+1):
+    outField = outFields[:,index].reshape((outNz,nOther))
+    outField[oceanMask] /= oceanFraction[oceanMask]
+    outField[oceanMask == False] = 0.
+    normalizedFields.append(outField)
+
+  return oceanMask, normalizedFields
 
 def writeMetric(varName, metric):
   if(timeAverageFirst):
@@ -130,28 +136,22 @@ inVars = inFile.variables
 xyCellIndices = inVars['cellIndices'][:]
 xyXIndices = inVars['xIndices'][:]
 xyYIndices = inVars['yIndices'][:]
-xySliceIndices = inVars['sliceIndices'][:]
 xyMpasToMisomipWeights = inVars['mpasToMisomipWeights'][:]
 inFile.close()
-xyNSlices = numpy.amax(xySliceIndices)+1
 
 inFile = Dataset('%s/xTransectIntersections.nc'%folder,'r')
 inVars = inFile.variables
 yzCellIndices = inVars['cellIndices'][:]
 yzYIndices = inVars['yIndices'][:]
-yzSliceIndices = inVars['sliceIndices'][:]
 yzMpasToMisomipWeights = inVars['mpasToMisomipWeights'][:]
 inFile.close()
-yzNSlices = numpy.amax(yzSliceIndices)+1
 
 inFile = Dataset('%s/yTransectIntersections.nc'%folder,'r')
 inVars = inFile.variables
 xzCellIndices = inVars['cellIndices'][:]
 xzXIndices = inVars['xIndices'][:]
-xzSliceIndices = inVars['sliceIndices'][:]
 xzMpasToMisomipWeights = inVars['mpasToMisomipWeights'][:]
 inFile.close()
-xzNSlices = numpy.amax(xzSliceIndices)+1
 
 dynamicTopo = experiment in ['Ocean3', 'Ocean4', 'IceOcean1', 'IceOcean2']
 
@@ -302,8 +302,8 @@ for iCell in range(nCells):
   if (k >= 0):
     cellMask[iCell,0:k+1] = 1.0
 
-xyOceanFraction = interpHoriz(cellMask[:,0], normalize=False)
-xyOceanMask = xyOceanFraction > 0.001
+(xyWeightsOperator, xyNormalizedOperator, xyOceanFraction,
+ xyOceanMask) = buildHorizOperators()
 
 if not dynamicTopo and (nTimeOut == 0):
   vars['iceDraft'][:,:] = interpHoriz(outputVars['ssh'][0,:])
@@ -340,7 +340,6 @@ for timeIn in timesIn:
 
   freshwaterFlux = landIceVars['landIceFreshwaterFlux'][timeIn,:]
   fraction = landIceVars['landIceFraction'][timeIn,:]
-  cavityMask = interpHoriz(fraction) > 0.001
   meltRate = freshwaterFlux/rho_fw
 
   if not numpy.all(fraction == 0.):
@@ -362,12 +361,6 @@ for timeIn in timesIn:
 
   bsfCell = 1e6*bsfFile.variables['barotropicStreamfunctionCell'][timeIn,:]
 
-  writeVar('meltRate', interpHoriz(meltRate), cavityMask)
-  writeVar('thermalDriving', interpHoriz(thermalDriving), cavityMask)
-  writeVar('halineDriving', interpHoriz(halineDriving), cavityMask)
-  writeVar('frictionVelocity', interpHoriz(frictionVelocity), cavityMask)
-  writeVar('barotropicStreamfunction', interpHoriz(bsfCell), xyOceanMask)
-
   temperature = outputVars['temperature'][timeIn,:,:]
   salinity = outputVars['salinity'][timeIn,:,:]
   layerThickness = outputVars['layerThickness'][timeIn,:,:]
@@ -376,9 +369,6 @@ for timeIn in timesIn:
   bottomTemperature = temperature[indices,maxLevelCell]
   bottomSalinity = salinity[indices,maxLevelCell]
 
-  writeVar('bottomTemperature', interpHoriz(bottomTemperature), xyOceanMask)
-  writeVar('bottomSalinity', interpHoriz(bottomSalinity), xyOceanMask)
-
   writeMetric('meanTemperature', numpy.sum(cellMask*layerThickness*temperature)
                                 /numpy.sum(cellMask*layerThickness))
   writeMetric('meanSalinity', numpy.sum(cellMask*layerThickness*salinity)
@@ -386,23 +376,47 @@ for timeIn in timesIn:
 
   uTop = outputVars['velocityX'][timeIn,:,0]
   vTop = outputVars['velocityY'][timeIn,:,0]
-  writeVar('uBoundaryLayer', interpHoriz(uTop), cavityMask)
-  writeVar('vBoundaryLayer', interpHoriz(vTop), cavityMask)
+
+  # remap all of the horizontal fields at once
+  outFields = interpHorizFields({'landIceFraction': fraction,
+                                 'meltRate': meltRate,
+                                 'thermalDriving': thermalDriving,
+                                 'halineDriving': halineDriving,
+                                 'frictionVelocity': frictionVelocity,
+                                 'uBoundaryLayer': uTop,
+                                 'vBoundaryLayer': vTop,
+                                 'barotropicStreamfunction': bsfCell,
+                                 'bottomTemperature': bottomTemperature,
+                                 'bottomSalinity': bottomSalinity})
+  cavityMask = outFields['landIceFraction'] > 0.001
+
+  for varName in ['meltRate', 'thermalDriving', 'halineDriving',
+                  'frictionVelocity', 'uBoundaryLayer', 'vBoundaryLayer']:
+    writeVar(varName, outFields[varName], cavityMask)
+  for varName in ['barotropicStreamfunction', 'bottomTemperature',
+                  'bottomSalinity']:
+    writeVar(varName, outFields[varName], xyOceanMask)
 
   #writeVar('overturningStreamfunction', resampleXZ(sfOverturn),
   #                    resampleXZ(osfMask) > .999)
-  
-  xzOceanFraction = interpXZTransect(cellMask, normalize=False)
-  xzOceanMask = xzOceanFraction > 0.001
-
-  yzOceanFraction = interpYZTransect(cellMask, normalize=False)
-  yzOceanMask = yzOceanFraction > 0.001
-
-  writeVar('temperatureXZ', interpXZTransect(temperature), xzOceanMask)
-  writeVar('salinityXZ', interpXZTransect(salinity), xzOceanMask)
-  
-  writeVar('temperatureYZ', interpYZTransect(temperature), yzOceanMask)
-  writeVar('salinityYZ', interpYZTransect(salinity), yzOceanMask)
+
+  # the layer interfaces move with ssh and layerThickness, so the transect
+  # operators are rebuilt each time but shared by all fields and the mask
+  xzOperator = buildTransectOperator(xzCellIndices, xzXIndices,
+                                     xzMpasToMisomipWeights, outNx)
+  xzOceanMask, (temperatureXZ, salinityXZ) = interpTransect(
+    xzOperator, outNx, [temperature, salinity])
+
+  yzOperator = buildTransectOperator(yzCellIndices, yzYIndices,
+                                     yzMpasToMisomipWeights, outNy)
+  yzOceanMask, (temperatureYZ, salinityYZ) = interpTransect(
+    yzOperator, outNy, [temperature, salinity])
+
+  writeVar('temperatureXZ', temperatureXZ, xzOceanMask)
+  writeVar('salinityXZ', salinityXZ, xzOceanMask)
+
+  writeVar('temperatureYZ', temperatureYZ, yzOceanMask)
+  writeVar('salinityYZ', salinityYZ, yzOceanMask)
   pbar.update(timeIn+1)
 
 pbar.finish()
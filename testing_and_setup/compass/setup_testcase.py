@@ -21,18 +21,41 @@ import xml.etree.ElementTree as ET
 import subprocess
 import ConfigParser
 import textwrap
-import netCDF4
+import copy
+import errno
+import multiprocessing
+import hashlib
+import json
+import re
 
-try:
-    from collections import defaultdict
-except ImportError:
-    from utils import defaultdict
+from list_testcases import get_test_case
+import file_operations
+import file_fetcher
+
+# Parsed XML files, keyed by absolute path. See get_xml_root.
+xml_roots = dict()
+
+# Parsed namelist templates, keyed by absolute path. See get_namelist_template.
+namelist_templates = dict()
+
+# Expanded namelist and streams templates, keyed by template file and test.
+namelist_template_options = dict()
+stream_template_definitions = dict()
+
+# Name of the file in each case directory that records the inputs of the
+# generated files. See generate_if_changed.
+manifest_file_name = '.setup_manifest.json'
+
+# Sets of files read and written while generating outputs, and hashes of the
+# files read, keyed by absolute path. See start_tracking.
+input_trackers = list()
+output_trackers = list()
+input_hashes = dict()
 
 
 # *** Namelist setup functions *** # {{{
 def generate_namelist_files(config_file, case_path, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = get_xml_root(config_file)
 
     # Iterate over all namelists to be generated
     for namelists in config_root.iter('namelist'):
@@ -60,121 +83,146 @@ def generate_namelist_files(config_file, case_path, configs):  # {{{
 
         template_namelist = configs.get("namelists", namelist_mode)
 
-        # Ingest namelist template into a dictionary
-        namelist_dict = defaultdict(lambda: defaultdict(list))
-        ingest_namelist(template_namelist, namelist_dict)
+        # Start from a copy of the parsed namelist template
+        namelist = copy_namelist(get_namelist_template(template_namelist))
 
-        # Modify the dictionary to have the desired values
-        configure_namelist(namelist_dict, namelists, configs)
+        # Modify the namelist to have the desired values
+        configure_namelist(namelist, namelists, configs)
 
-        # Write the namelist using the template to determine the writing order.
-        write_namelist(namelist_dict, namelist_file, template_namelist)
-        del namelist_dict
+        # Write the namelist, in the same order as the template.
+        write_namelist(namelist, namelist_file)
 
-    del config_root
-    del config_tree
 # }}}
 
 
-def ingest_namelist(namelist_file, namelist_dict):  # {{{
-    # Read the template file
+def ingest_namelist(namelist_file):  # {{{
+    # Parse a namelist file into a dictionary with the following entries:
+    #   records: A list of (record line, option keys) in the order they
+    #            appear in the file, used to determine the writing order.
+    #   values: The value of each option, keyed by (record number, option).
+    #   index: The keys of all options with a given name, in any record.
     namelistfile = open(namelist_file, 'r')
     lines = namelistfile.readlines()
+    namelistfile.close()
 
-    record_name = 'NONE!!!'
+    records = list()
+    values = dict()
+    index = dict()
 
-    # Add each linke into the corresponding record / option entry in the
-    # dictionary.
+    # Add each line into the corresponding record / option entry.
     for line in lines:
         if line.find('&') >= 0:
-            record_name = line.strip().strip('&').strip('\n')
-            namelist_dict[record_name] = defaultdict(list)
+            records.append((line, list()))
         elif line.find('=') >= 0:
             opt, val = line.strip().strip('\n').split('=')
-            if record_name != "NONE!!!":
-                namelist_dict[record_name][opt].append(val)
+            if records:
+                key = (len(records) - 1, opt.strip())
+                records[-1][1].append(key)
+                # If an option is repeated within a record, the first
+                # value is used.
+                if key not in values:
+                    values[key] = val
+                    index.setdefault(key[1], list()).append(key)
+
+    return {'records': records, 'values': values, 'index': index}
+# }}}
+
+
+def get_namelist_template(namelist_file):  # {{{
+    # Return the parsed namelist template. Templates are only read once per
+    # setup invocation, and are shared by every case, so callers must modify
+    # a copy (see copy_namelist).
+    namelist_path = os.path.abspath(namelist_file)
+    if namelist_path not in namelist_templates:
+        namelist_templates[namelist_path] = ingest_namelist(namelist_path)
+
+    track_input(namelist_path)
+
+    return namelist_templates[namelist_path]
 # }}}
 
 
-def set_namelist_val(namelist_dict, option_name, option_val):  # {{{
-    # Set the value of the namelist option.
-    for record, opts in namelist_dict.items():
-        for opt, val in opts.items():
-            if opt.strip() == option_name:
-                val[0] = option_val
+def copy_namelist(namelist):  # {{{
+    # Only the values change once a namelist has been ingested, so the
+    # records and index can be shared with the copy.
+    return {'records': namelist['records'],
+            'values': dict(namelist['values']),
+            'index': namelist['index']}
 # }}}
 
 
-def configure_namelist(namelist_dict, namelist_tag, configs):  # {{{
+def set_namelist_val(namelist, option_name, option_val):  # {{{
+    # Set the value of the namelist option, in every record it appears in.
+    for key in namelist['index'].get(option_name, []):
+        namelist['values'][key] = option_val
+# }}}
+
+
+def configure_namelist(namelist, namelist_tag, configs):  # {{{
     # Iterate over all children within the namelist tag.
     for child in namelist_tag:
         # Process <option> tags
         if child.tag == 'option':
             option_name = child.attrib['name']
             option_val = child.text
-            set_namelist_val(namelist_dict, option_name, option_val)
+            set_namelist_val(namelist, option_name, option_val)
         # Process <template> tags
         elif child.tag == 'template':
-            apply_namelist_template(namelist_dict, child, configs)
+            apply_namelist_template(namelist, child, configs)
 
 # }}}
 
 
-def apply_namelist_template(namelist_dict, template_tag, configs):  # {{{
-    # Determine the template information, like it's path and the filename
-    template_info = get_template_info(template_tag, configs)
-
-    # Build the full filename for the template
-    template_file = '{}/{}'.format(template_info['template_path'],
-                                   template_info['template_file'])
-
-    # Parse the template
-    template_tree = ET.parse(template_file)
-    template_root = template_tree.getroot()
-
+def apply_namelist_template(namelist, template_tag, configs):  # {{{
     # Apply the template, by changing each option
-    for child in template_root:
-        if child.tag == 'namelist':
-            for grandchild in child:
-                if grandchild.tag == 'option':
-                    option_name = grandchild.attrib['name']
-                    option_val = grandchild.text
-                    set_namelist_val(namelist_dict, option_name, option_val)
-                elif grandchild.tag == 'template':
-                    apply_namelist_template(namelist_dict, grandchild, configs)
-
-    del template_root
-    del template_tree
-    del template_info
+    for option_name, option_val in get_namelist_template_options(template_tag,
+                                                                 configs):
+        set_namelist_val(namelist, option_name, option_val)
 # }}}
 
 
-def write_namelist(namelist_dict, outfilename, infilename):  # {{{
-    # Write the namelist out, using the infilename as a template to determine
-    # the writing order.
-    in_namelist = open(infilename, 'r')
-    lines = in_namelist.readlines()
-    in_namelist.close()
+def get_namelist_template_options(template_tag, configs):  # {{{
+    # Expand a namelist template, including any templates it references, into
+    # a list of (option, value) pairs. The expansion is cached, so each
+    # template is only expanded once for a test. The template files it read
+    # are cached with it, so they are tracked as inputs on every use.
+    template_file = get_template_file(template_tag, configs)
+    key = (template_file, configs.get('script_paths', 'test_dir'))
 
-    out_namelist = open(outfilename, 'w+')
+    if key not in namelist_template_options:
+        start_tracking()
+        options = list()
+        for child in get_xml_root(template_file):
+            if child.tag == 'namelist':
+                for grandchild in child:
+                    if grandchild.tag == 'option':
+                        options.append((grandchild.attrib['name'],
+                                        grandchild.text))
+                    elif grandchild.tag == 'template':
+                        options.extend(get_namelist_template_options(
+                            grandchild, configs))
+        inputs, _ = stop_tracking()
+        namelist_template_options[key] = (options, inputs)
+
+    options, inputs = namelist_template_options[key]
+    for path in inputs:
+        track_input(path)
+
+    return options
+# }}}
 
-    record_name = 'NONE!!!'
 
-    for line in lines:
-        if line.find('&') >= 0:
-            if record_name != "NONE!!!":
-                out_namelist.write('/\n')
-
-            record_name = line.strip().strip('&').strip('\n')
-            out_namelist.write(line)
-        elif line.find('=') >= 0:
-            opt, val = line.strip().strip('\n').split('=')
-            if record_name != "NONE!!!":
-                out_namelist.write('    {} = {}\n'.format(
-                        opt.strip(),
-                        namelist_dict[record_name][opt][0].strip()))
+def write_namelist(namelist, outfilename):  # {{{
+    # Write the namelist out, in the order of the template it was ingested
+    # from.
+    track_output(outfilename)
+    out_namelist = open(outfilename, 'w+')
 
-    if record_name != "NONE!!!":
+    for record_line, keys in namelist['records']:
+        out_namelist.write(record_line)
+        for key in keys:
+            out_namelist.write('    {} = {}\n'.format(
+                    key[1], namelist['values'][key].strip()))
         out_namelist.write('/\n')
 
     out_namelist.close()
@@ -185,8 +233,7 @@ def write_namelist(namelist_dict, outfilename, infilename):  # {{{
 # *** Streams setup functions *** # {{{
 
 def generate_streams_files(config_file, case_path, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = get_xml_root(config_file)
 
     # Iterate over all sterams files to be generated
     for streams in config_root:
@@ -211,9 +258,9 @@ def generate_streams_files(config_file, case_path, configs):  # {{{
 
             template_streams = configs.get("streams", streams_mode)
 
-            # Parse the template
-            streams_tree = ET.parse(template_streams)
-            streams_root = streams_tree.getroot()
+            # Copy the parsed template, since configuring the streams file
+            # modifies it.
+            streams_root = copy.deepcopy(get_xml_root(template_streams))
 
             # Configure the new streams file, using the template as a starting
             # place.
@@ -222,9 +269,6 @@ def generate_streams_files(config_file, case_path, configs):  # {{{
             # Write out the streams file
             write_streams_file(streams_root, config_file, streams_filename,
                                '{}'.format(case_path))
-
-            del streams_root
-            del streams_tree
 # }}}
 
 
@@ -326,36 +370,44 @@ def configure_streams_file(streams_file, streams_tag, configs):  # {{{
 
 
 def apply_stream_template(streams_file, template_tag, configs):  # {{{
-    # Determine template information, like path and filename
-    template_info = get_template_info(template_tag, configs)
-
-    # Build full path to template file
-    template_file = '{}/{}'.format(template_info['template_path'],
-                                   template_info['template_file'])
+    # Apply the streams portion of the template to the streams file
+    for stream_conf in get_stream_template_definitions(template_tag, configs):
+        modify_stream_definition(streams_file, stream_conf)
+# }}}
 
-    # Parse the template
-    template_tree = ET.parse(template_file)
-    template_root = template_tree.getroot()
 
-    # Apply the streams portion of the template to the streams file
-    for child in template_root:
-        if child.tag == 'streams':
-            for grandchild in child:
-                if grandchild.tag == 'stream':
-                    modify_stream_definition(streams_file, grandchild)
-                elif grandchild.tag == 'template':
-                    apply_stream_template(streams_file, grandchild, configs)
+def get_stream_template_definitions(template_tag, configs):  # {{{
+    # Expand the streams portion of a template, including any templates it
+    # references, into a list of <stream> tags. The expansion is cached, so
+    # each template is only expanded once for a test. The template files it
+    # read are cached with it, so they are tracked as inputs on every use.
+    template_file = get_template_file(template_tag, configs)
+    key = (template_file, configs.get('script_paths', 'test_dir'))
 
-    del template_tree
-    del template_root
-    del template_info
+    if key not in stream_template_definitions:
+        start_tracking()
+        definitions = list()
+        for child in get_xml_root(template_file):
+            if child.tag == 'streams':
+                for grandchild in child:
+                    if grandchild.tag == 'stream':
+                        definitions.append(grandchild)
+                    elif grandchild.tag == 'template':
+                        definitions.extend(get_stream_template_definitions(
+                            grandchild, configs))
+        inputs, _ = stop_tracking()
+        stream_template_definitions[key] = (definitions, inputs)
+
+    definitions, inputs = stream_template_definitions[key]
+    for path in inputs:
+        track_input(path)
+
+    return definitions
 # }}}
 
 
 def write_streams_file(streams, config_file, filename, init_path):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
-
+    track_output(filename)
     stream_file = open(filename, 'w')
 
     stream_file.write('<streams>\n')
@@ -438,18 +490,13 @@ def write_streams_file(streams, config_file, filename, init_path):  # {{{
 
     stream_file.write('\n')
     stream_file.write('</streams>\n')
-
-    del config_tree
-    del config_root
 # }}}
 # }}}
 
 
 # *** Script Generation Functions *** # {{{
 def generate_run_scripts(config_file, init_path, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
-    dev_null = open('/dev/null', 'r+')
+    config_root = get_xml_root(config_file)
 
     for run_script in config_root:
         # Process run_script
@@ -457,6 +504,7 @@ def generate_run_scripts(config_file, init_path, configs):  # {{{
             # Determine the name of the script, and create the file
             script_name = run_script.attrib['name']
             script_path = "{}/{}".format(init_path, script_name)
+            track_output(script_path)
             script = open(script_path, "w")
 
             # Write the script header
@@ -487,33 +535,26 @@ def generate_run_scripts(config_file, init_path, configs):  # {{{
             script.close()
 
             # Make the script executable
-            subprocess.check_call(['chmod', 'a+x', '{}'.format(script_path)],
-                                  stdout=dev_null, stderr=dev_null)
-
-    dev_null.close()
-    del config_tree
-    del config_root
+            file_operations.make_executable(script_path)
 # }}}
 
 
 def generate_driver_scripts(config_file, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
-    dev_null = open('/dev/null', 'r+')
+    config_root = get_xml_root(config_file)
 
     # init_path is where the driver script will live after it's generated.
-    init_path = '{}/{}'.format(config.get('script_paths', 'work_dir'),
-                               config.get('script_paths', 'config_path'))
+    init_path = '{}/{}'.format(configs.get('script_paths', 'work_dir'),
+                               configs.get('script_paths', 'config_path'))
 
     # Ensure we're in a <driver_script> tag
     if config_root.tag == 'driver_script':
         name = config_root.attrib['name']
 
         # Ensure work_dir exists before writing driver script there.
-        if not os.path.exists(init_path):
-            os.makedirs(init_path)
+        make_dirs(init_path)
 
         # Create script file
+        track_output('{}/{}'.format(init_path, name))
         script = open('{}/{}'.format(init_path, name), 'w')
 
         # Write script header
@@ -529,6 +570,10 @@ def generate_driver_scripts(config_file, configs):  # {{{
         script.write('import subprocess\n')
         script.write("import xml.etree.ElementTree as ET\n")
         script.write('import argparse\n')
+        script.write('\n')
+        script.write("sys.path.insert(0, '{}')\n".format(
+            configs.get('script_paths', 'utility_scripts')))
+        script.write('from case_runner import run_cases\n')
         script.write('\n\n')
         script.write('# This script was generated by setup_testcases.py as '
                      'part of a driver_script\n'
@@ -537,6 +582,12 @@ def generate_driver_scripts(config_file, configs):  # {{{
         script.write('parser = argparse.ArgumentParser(\n'
                      '        description=__doc__, '
                      'formatter_class=argparse.RawTextHelpFormatter)\n')
+        script.write('parser.add_argument("--max_cores", dest="max_cores", '
+                     'type=int,\n'
+                     '                    help="If set, cases that don\'t '
+                     'depend on each other are run "\n'
+                     '                         "concurrently using at most '
+                     'this many cores.")\n')
 
         case_dict = dict()
         for child in config_root:
@@ -572,27 +623,30 @@ def generate_driver_scripts(config_file, configs):  # {{{
         script.write('base_path = os.getcwd()\n')
         script.write("dev_null = open('/dev/null', 'w')\n")
         script.write('error = False\n')
-        script.write('\n')
+        script.write('\n\n')
 
-        # Process children of driver_script
-        for child in config_root:
-            # Process each case, by changing into that directory, and
-            # processing each step / define_env_var tag within it.
+        # Write a function for each case, which runs each step /
+        # define_env_var tag within it. Steps are run in the case directory,
+        # without changing the working directory of the script, so cases can
+        # run concurrently.
+        case_tags = [child for child in config_root if child.tag == 'case']
+        for case_tag in case_tags:
+            process_driver_case(case_tag, configs, script)
+
+        case_info = get_driver_case_info(config_file, case_tags, configs)
+
+        # Process children of driver_script. Consecutive <case> tags are
+        # run together by run_cases, in an order that respects their
+        # dependencies.
+        case_block = list()
+        for index, child in enumerate(config_root):
             if child.tag == 'case':
-                case = child.attrib['name']
-                script.write('if not args.no_{}:\n'.format(case))
-                script.write('    os.chdir(base_path)\n')
-                script.write('    os.chdir(' + "'{}')\n".format(case))
-                # Process children of <case> tag
-                for grandchild in child:
-                    # Process <step> tags
-                    if grandchild.tag == 'step':
-                        process_script_step(grandchild, configs, '    ',
-                                            script)
-                    # Process <define_env_var> tags
-                    elif grandchild.tag == 'define_env_var':
-                        process_env_define_step(grandchild, configs, '    ',
-                                                script)
+                case_block.append(child.attrib['name'])
+                if index + 1 < len(config_root) and \
+                        config_root[index + 1].tag == 'case':
+                    continue
+                process_driver_case_block(case_block, case_info, script)
+                case_block = list()
             # Process <step> tags
             elif child.tag == 'step':
                 script.write('os.chdir(base_path)\n')
@@ -630,13 +684,154 @@ def generate_driver_scripts(config_file, configs):  # {{{
         del case_dict
 
         # Make script executable
-        subprocess.check_call(['chmod', 'a+x',
-                               '{}/{}'.format(init_path, name)],
-                              stdout=dev_null, stderr=dev_null)
+        file_operations.make_executable('{}/{}'.format(init_path, name))
+# }}}
+
+
+def process_driver_case(case_tag, configs, script):  # {{{
+    case = case_tag.attrib['name']
+
+    script.write('def run_{}():\n'.format(case))
+    script.write("    case_path = os.path.join(base_path, '{}')\n".format(
+        case))
+
+    # Environment variables defined in a case only apply to that case.
+    extra_args = ', cwd=case_path'
+    if any([child.tag == 'define_env_var' for child in case_tag]):
+        script.write('    env = os.environ.copy()\n')
+        extra_args = '{}, env=env'.format(extra_args)
+
+    # Process children of <case> tag
+    for child in case_tag:
+        # Process <step> tags
+        if child.tag == 'step':
+            process_script_step(child, configs, '    ', script, extra_args)
+        # Process <define_env_var> tags
+        elif child.tag == 'define_env_var':
+            process_env_define_step(child, configs, '    ', script, 'env')
+    script.write('\n\n')
+# }}}
+
+
+def process_driver_case_block(case_names, case_info, script):  # {{{
+    script.write('cases = list()\n')
+    for case in case_names:
+        script.write('if not args.no_{}:\n'.format(case))
+        script.write("    cases.append({{'name': '{}', 'cores': {:d}, "
+                     "'run': run_{},\n"
+                     "                  'depends': {!r}}})\n".format(
+                         case, case_info[case]['cores'], case,
+                         case_info[case]['depends']))
+    script.write('if run_cases(cases, args.max_cores):\n')
+    script.write('    sys.exit(1)\n')
 # }}}
 
 
-def process_env_define_step(var_tag, configs, indentation, script_file):  # {{{
+def get_driver_case_info(config_file, case_tags, configs):  # {{{
+    # Determine the number of cores each case of a driver script uses, and
+    # the cases it depends on. Unless a <case> tag lists its dependencies
+    # explicitly (as a comma separated 'depends' attribute), a case depends
+    # on each earlier case whose directory it refers to (e.g. through an
+    # <add_link source="../case/file"> tag) or that refers to its directory.
+    # Cases that refer to the same directory that isn't a case (e.g. a
+    # shared ../restarts directory) also run in order.
+    case_names = [case_tag.attrib['name'] for case_tag in case_tags]
+
+    # Find the config file of each case in the test directory
+    config_roots = dict()
+    test_path = os.path.dirname(config_file)
+    for file in sorted(os.listdir(test_path)):
+        if fnmatch.fnmatch(file, '*.xml'):
+            root = get_xml_root('{}/{}'.format(test_path, file))
+            if root.tag == 'config':
+                config_roots[root.attrib['case']] = root
+
+    case_info = dict()
+    references = dict()
+    for index, case_tag in enumerate(case_tags):
+        case = case_names[index]
+        references[case] = get_directory_references(case_tag, configs)
+        cores = 1
+        if case in config_roots:
+            references[case].update(get_directory_references(
+                config_roots[case], configs))
+            cores = get_case_cores(config_roots[case])
+
+        if 'depends' in case_tag.attrib:
+            depends = [dep.strip() for dep in
+                       case_tag.attrib['depends'].split(',') if dep.strip()]
+            for dep in depends:
+                if dep not in case_names:
+                    print "ERROR: Case '{}' depends on '{}', which is not a " \
+                          "case in this driver script.".format(case, dep)
+                    print "Exiting..."
+                    sys.exit(1)
+        else:
+            shared = references[case].difference(case_names)
+            depends = list()
+            for earlier_case in case_names[0:index]:
+                if earlier_case in references[case] or \
+                        case in references[earlier_case] or \
+                        shared.intersection(references[earlier_case]):
+                    depends.append(earlier_case)
+
+        case_info[case] = {'cores': cores, 'depends': depends}
+
+    return case_info
+# }}}
+
+
+def get_directory_references(root, configs, visited=None):  # {{{
+    # Return the names of all sibling directories (paths starting with
+    # '../<name>/') referred to by the attributes or text of root, or of any
+    # templates it includes.
+    if visited is None:
+        visited = set()
+
+    names = set()
+    for element in root.iter():
+        values = element.attrib.values()
+        if element.text is not None:
+            values.append(element.text)
+        for value in values:
+            for name in re.findall(r'\.\./([^/\s\'"]+)/', value):
+                if name not in ['.', '..']:
+                    names.add(name)
+
+        if element.tag == 'template' and 'file' in element.attrib:
+            template_file = get_template_file(element, configs)
+            if template_file not in visited:
+                visited.add(template_file)
+                names.update(get_directory_references(
+                    get_xml_root(template_file), configs, visited))
+
+    return names
+# }}}
+
+
+def get_case_cores(config_root):  # {{{
+    # Determine the maximum number of cores used by any <model_run> in a
+    # case.
+    max_cores = 1
+    for model_run in config_root.iter('model_run'):
+        try:
+            procs = int(model_run.attrib['procs'])
+        except (KeyError, ValueError):
+            procs = 1
+
+        try:
+            threads = int(model_run.attrib['threads'])
+        except (KeyError, ValueError):
+            threads = 1
+
+        max_cores = max(max_cores, procs * threads)
+
+    return max_cores
+# }}}
+
+
+def process_env_define_step(var_tag, configs, indentation, script_file,
+                            environ='os.environ'):  # {{{
     try:
         var_name = var_tag.attrib['name']
     except KeyError:
@@ -652,13 +847,15 @@ def process_env_define_step(var_tag, configs, indentation, script_file):  # {{{
         sys.exit(1)
 
     # Write line to define the environment variable
-    script_file.write("{}os.environ['{}'] = '{}'\n".format(indentation,
-                                                           var_name,
-                                                           var_val))
+    script_file.write("{}{}['{}'] = '{}'\n".format(indentation, environ,
+                                                   var_name, var_val))
 # }}}
 
 
-def process_script_step(step, configs, indentation, script_file):  # {{{
+def process_script_step(step, configs, indentation, script_file,
+                        extra_args=''):  # {{{
+    # extra_args are additional keyword arguments to subprocess.check_call
+    # (e.g. ', cwd=case_path').
     # Determine step attributes.
     if 'executable_name' in step.attrib.keys() and 'executable' in \
             step.attrib.keys():
@@ -720,7 +917,8 @@ def process_script_step(step, configs, indentation, script_file):  # {{{
 
     # Build comment and command bases
     comment = wrap_subprocess_comment(command_args, indentation)
-    command = wrap_subprocess_command(command_args, indentation, quiet)
+    command = wrap_subprocess_command(command_args, indentation, quiet,
+                                      extra_args)
 
     # Write the comment, and the command. Also, ensure the command has the same
     # environment as the calling script.
@@ -771,131 +969,94 @@ def process_compare_fields_step(compare_tag, configs, script):  # {{{
         baseline_root = '{}/{}'.format(baseline_root,
                                        configs.get('script_paths', 'test_dir'))
 
-    for child in compare_tag:
-        # Process field comparisons
-        if child.tag == 'field':
-            if not (missing_file1 or missing_file2):
-                process_field_definition(child, configs, script, file1, file2,
-                                         False)
-
-            if not missing_file1 and baseline_root != 'NONE':
-                process_field_definition(child, configs, script, file1,
-                                         '{}/{}'.format(baseline_root, file1),
-                                         True)
-
-            if not missing_file2 and baseline_root != 'NONE':
-                process_field_definition(child, configs, script, file2,
-                                         '{}/{}'.format(baseline_root, file2),
-                                         True)
-        # Process field comparison template
-        elif child.tag == 'template':
-            apply_compare_fields_template(child, compare_tag, configs, script)
-# }}}
+    # All fields are compared in a single call for each pair of files.
+    field_tags = get_compare_fields_definitions(compare_tag, configs)
 
+    if not (missing_file1 or missing_file2):
+        process_field_definitions(field_tags, configs, script, file1, file2,
+                                  False)
 
-def apply_compare_fields_template(template_tag, compare_tag, configs, script):
-    # {{{
-    missing_file1 = False
-    missing_file2 = False
-    # Determine comparison attributes
-    try:
-        file1 = compare_tag.attrib['file1']
-    except KeyError:
-        missing_file1 = True
+    if not missing_file1 and baseline_root != 'NONE':
+        process_field_definitions(field_tags, configs, script, file1,
+                                  '{}/{}'.format(baseline_root, file1), True)
 
-    try:
-        file2 = compare_tag.attrib['file2']
-    except KeyError:
-        missing_file2 = True
+    if not missing_file2 and baseline_root != 'NONE':
+        process_field_definitions(field_tags, configs, script, file2,
+                                  '{}/{}'.format(baseline_root, file2), True)
+# }}}
 
-    if missing_file1 and missing_file2:
-        print "ERROR: <compare_fields> tag is missing both 'file1' and " \
-              "'file2' tags. At least one is required."
-        print "Exiting..."
-        sys.exit(1)
 
-    # Build the path to the baselines
-    baseline_root = configs.get('script_paths', 'baseline_dir')
-    if baseline_root != 'NONE':
-        baseline_root = '{}/{}'.format(baseline_root,
-                                       configs.get('script_paths', 'test_dir'))
+def get_compare_fields_definitions(compare_tag, configs):  # {{{
+    # Return the <field> tags within a <compare_fields> tag, including those
+    # in any templates, in order.
+    field_tags = list()
+    for child in compare_tag:
+        if child.tag == 'field':
+            field_tags.append(child)
+        # Process field comparison template
+        elif child.tag == 'template':
+            field_tags.extend(get_compare_fields_template(child, configs))
 
-    # Determine template information, like path and filename
-    template_info = get_template_info(template_tag, configs)
+    return field_tags
+# }}}
 
-    template_file = '{}/{}'.format(template_info['template_path'],
-                                   template_info['template_file'])
 
-    # Parse the template
-    template_tree = ET.parse(template_file)
-    template_root = template_tree.getroot()
+def get_compare_fields_template(template_tag, configs):  # {{{
+    # Get the parsed template
+    template_root = get_template_root(template_tag, configs)
 
     # Find a child tag that is validation->compare_fields->field, and add each
     # field
+    field_tags = list()
     for validation in template_root:
         if validation.tag == 'validation':
             for compare_fields in validation:
                 if compare_fields.tag == 'compare_fields':
-                    for field in compare_fields:
-                        if field.tag == 'field':
-                            if not (missing_file1 or missing_file2):
-                                process_field_definition(field, configs,
-                                                         script, file1, file2,
-                                                         False)
-
-                            if not missing_file1 and baseline_root != 'NONE':
-                                process_field_definition(
-                                    field, configs, script, file1,
-                                    '{}/{}'.format(baseline_root, file1), True)
-
-                            if not missing_file2 and baseline_root != 'NONE':
-                                process_field_definition(
-                                    field, configs, script, file2,
-                                    '{}/{}'.format(baseline_root, file2), True)
-                        elif field.tag == 'template':
-                            apply_compare_fields_template(field, compare_tag,
-                                                          configs, script)
+                    field_tags.extend(get_compare_fields_definitions(
+                        compare_fields, configs))
 
-    del template_root
-    del template_tree
-    del template_info
+    return field_tags
 # }}}
 
 
-def process_field_definition(field_tag, configs, script, file1, file2,
-                             baseline_comp):  # {{{
+def process_field_definitions(field_tags, configs, script, file1, file2,
+                              baseline_comp):  # {{{
+    if len(field_tags) == 0:
+        return
+
     # Build the path to the comparison script.
     compare_executable = '{}/compare_fields.py'.format(
         configs.get('script_paths', 'utility_scripts'))
 
-    field_name = field_tag.attrib['name']
+    # Build the base command to compare the fields. Comparisons against
+    # baselines only check for bit-for-bit identical fields, so their bytes
+    # are compared before computing any norms.
+    command_args = [compare_executable, '-q', '-1', file1, '-2', file2]
+    if baseline_comp:
+        command_args.append('--bfb')
 
-    # Build the base command to compare the fields
-    command_args = [compare_executable, '-q', '-1', file1, '-2', file2, '-v',
-                    field_name]
+    for field_tag in field_tags:
+        field_definition = [field_tag.attrib['name']]
 
-    # Determine norm thresholds
-    if baseline_comp:
-        command_args.extend(['--l1', '0.0', '--l2', '0.0', '--linf', '0.0'])
-    else:
-        if 'l1_norm' in field_tag.attrib.keys():
-            command_args.extend(['--l1', field_tag.attrib['l1_norm']])
-        if 'l2_norm' in field_tag.attrib.keys():
-            command_args.extend(['--l2', field_tag.attrib['l2_norm']])
-        if 'linf_norm' in field_tag.attrib.keys():
-            command_args.extend(['--linf', field_tag.attrib['linf_norm']])
+        # Determine norm thresholds
+        if baseline_comp:
+            field_definition.extend(['l1=0.0', 'l2=0.0', 'linf=0.0'])
+        else:
+            for norm in ['l1', 'l2', 'linf']:
+                if '{}_norm'.format(norm) in field_tag.attrib.keys():
+                    field_definition.append('{}={}'.format(
+                        norm, field_tag.attrib['{}_norm'.format(norm)]))
+
+        command_args.extend(['--field', ','.join(field_definition)])
 
     command = wrap_subprocess_command(command_args, indentation='    ',
                                       quiet=False)
 
-    # Write the pass/fail logic.
+    # Write the pass/fail logic. The comparison script reports the result
+    # of each field.
     script.write('try:\n')
     script.write('{}\n'.format(command))
-    script.write("    print ' ** PASS Comparison of {} between {} and\\n' \\\n"
-                 "          '    {}'\n".format(field_name, file1, file2))
     script.write('except subprocess.CalledProcessError:\n')
-    script.write("    print ' ** FAIL Comparison of {} between {} and\\n' \\\n"
-                 "          '    {}'\n".format(field_name, file1, file2))
     script.write('    error = True\n')
 # }}}
 # }}}
@@ -909,6 +1070,8 @@ def process_compare_timers_step(compare_tag, configs, script):  # {{{
 
     missing_rundir1 = True
     missing_rundir2 = True
+    rundir1 = None
+    rundir2 = None
 
     try:
         rundir1 = compare_tag.attrib['rundir1']
@@ -937,6 +1100,12 @@ def process_compare_timers_step(compare_tag, configs, script):  # {{{
                 process_timer_definition(
                     child, configs, script,
                     '{}/{}'.format(baseline_root, rundir2), rundir2)
+
+            process_timer_history_check(
+                child, configs, script,
+                [rundir for rundir, missing in [(rundir1, missing_rundir1),
+                                                (rundir2, missing_rundir2)]
+                 if not missing])
         elif child.tag == 'template':
             apply_compare_timers_template(child, compare_tag, configs, script)
 
@@ -952,6 +1121,8 @@ def apply_compare_timers_template(template_tag, compare_tag, configs, script):
 
     missing_rundir1 = True
     missing_rundir2 = True
+    rundir1 = None
+    rundir2 = None
 
     try:
         rundir1 = compare_tag.attrib['rundir1']
@@ -965,14 +1136,8 @@ def apply_compare_timers_template(template_tag, compare_tag, configs, script):
     except KeyError:
         missing_rundir2 = True
 
-    # Get the template information and build the template file
-    template_info = get_template_info(template_tag, configs)
-    template_file = '{}/{}'.format(template_info['template_path'],
-                                   template_info['template_file'])
-
-    # Parse template file
-    template_tree = ET.parse(template_file)
-    template_root = template_tree.getroot()
+    # Get the parsed template
+    template_root = get_template_root(template_tag, configs)
 
     for validation in template_root:
         if validation.tag == 'validation':
@@ -995,12 +1160,16 @@ def apply_compare_timers_template(template_tag, compare_tag, configs, script):
                                     timer, configs, script,
                                     '{}/{}'.format(baseline_root, rundir2),
                                     rundir2)
+
+                            process_timer_history_check(
+                                timer, configs, script,
+                                [rundir for rundir, missing in
+                                 [(rundir1, missing_rundir1),
+                                  (rundir2, missing_rundir2)]
+                                 if not missing])
                         elif timer.tag == 'template':
                             apply_compare_timers_template(timer, compare_tag,
                                                           configs, script)
-    del template_root
-    del template_tree
-    del template_info
 
 # }}}
 
@@ -1036,16 +1205,54 @@ def process_timer_definition(timer_tag, configs, script, basedir, compdir):
                                                    basedir))
     script.write("        error = True\n")
 # }}}
+
+
+def process_timer_history_check(timer_tag, configs, script, rundirs):  # {{{
+    # Check the timer in each run directory against the performance history,
+    # if the regression suite script running this driver records one.
+    compare_script = '{}/compare_timers.py'.format(
+        configs.get('script_paths', 'utility_scripts'))
+
+    try:
+        timer_name = timer_tag.attrib['name']
+    except KeyError:
+        print "ERROR: <timer> tag is missing the 'name' attribute."
+        print "Exiting..."
+        sys.exit(1)
+
+    if not rundirs:
+        return
+
+    check_args = ''
+    exists_checks = list()
+    for rundir in rundirs:
+        check_args = '{}, "-r", "{}"'.format(check_args, rundir)
+        exists_checks.append('os.path.exists("{}")'.format(rundir))
+
+    command = 'subprocess.check_call(["{}", "-t", "{}"{}])'.format(
+        compare_script, timer_name, check_args)
+
+    script.write('\n')
+    script.write("if 'COMPASS_PERF_HISTORY' in os.environ and \\\n"
+                 "        {}:\n".format(' and '.join(exists_checks)))
+    script.write('    try:\n')
+    script.write('        {}\n'.format(command))
+    script.write("        print ' ** PASS History check of timer {} in "
+                 "{}'\n".format(timer_name, ', '.join(rundirs)))
+    script.write('    except subprocess.CalledProcessError:\n')
+    script.write("        print ' ** FAIL History check of timer {} in "
+                 "{}'\n".format(timer_name, ', '.join(rundirs)))
+    script.write("        error = True\n")
+# }}}
 # }}}
 
 
 def process_model_run_step(model_run_tag, configs, script):  # {{{
     run_definition_file = configs.get('script_input_arguments',
                                       'model_runtime')
-    run_config_tree = ET.parse(run_definition_file)
-    run_config_root = run_config_tree.getroot()
-
-    dev_null = open('/dev/null', 'r+')
+    # Copy the parsed run definition, since the <model_run> attributes are
+    # substituted into it.
+    run_config_root = copy.deepcopy(get_xml_root(run_definition_file))
 
     try:
         executable_name = model_run_tag.attrib['executable']
@@ -1069,20 +1276,19 @@ def process_model_run_step(model_run_tag, configs, script):  # {{{
                     arg_text = grandchild.text
 
                     if arg_text == 'model':
-                        executable_full_path = config.get('executables',
-                                                          executable_name)
+                        executable_full_path = configs.get('executables',
+                                                           executable_name)
                         executable_parts = executable_full_path.split('/')
                         executable_link = \
                             executable_parts[len(executable_parts) - 1]
                         link_path = '{}/{}/{}'.format(
-                            config.get('script_paths', 'work_dir'),
-                            config.get('script_paths', 'case_dir'),
+                            configs.get('script_paths', 'work_dir'),
+                            configs.get('script_paths', 'case_dir'),
                             executable_link)
-                        subprocess.check_call(
-                            ['ln', '-sf',
-                             config.get('executables', executable_name),
-                             link_path],
-                            stdout=dev_null, stderr=dev_null)
+                        track_output(link_path)
+                        file_operations.symlink(
+                            configs.get('executables', executable_name),
+                            link_path, follow_dest=True)
                         grandchild.text = executable_link
                     elif arg_text.find('attr_') >= 0:
                         attr_array = arg_text.split('_')
@@ -1118,7 +1324,6 @@ def process_model_run_step(model_run_tag, configs, script):  # {{{
     script.write('print "     ** Finished model run step **"\n')
     script.write('print "     *****************************"\n')
     script.write('print "\\n"\n')
-    dev_null.close()
 # }}}
 
 
@@ -1132,12 +1337,13 @@ def wrap_subprocess_comment(command_args, indentation):  # {{{
 # }}}
 
 
-def wrap_subprocess_command(command_args, indentation, quiet):  # {{{
+def wrap_subprocess_command(command_args, indentation, quiet,
+                            extra_args=''):  # {{{
     # Setup command redirection
     if quiet:
-        redirect = ", stdout=dev_null, stderr=dev_null"
+        redirect = "{}, stdout=dev_null, stderr=dev_null".format(extra_args)
     else:
-        redirect = ""
+        redirect = extra_args
 
     prefix = "{}subprocess.check_call(".format(indentation)
     command = textwrap.wrap("'{}'".format("', '".join(command_args)), width=79,
@@ -1158,12 +1364,12 @@ def wrap_subprocess_command(command_args, indentation, quiet):  # {{{
 
 # *** General Utility Functions *** #{{{
 def add_links(config_file, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = get_xml_root(config_file)
 
     case = config_root.attrib['case']
 
-    dev_null = open('/dev/null', 'r+')
+    # Links are queued, and created together once all tags are processed.
+    operations = list()
 
     # Determine the path for the case directory
     test_path = '{}/{}'.format(configs.get('script_paths', 'test_dir'), case)
@@ -1232,13 +1438,9 @@ def add_links(config_file, configs):  # {{{
                 source_file = '{}'.format(source)
 
             dest = child.attrib['dest']
-            old_cwd = os.getcwd()
-            os.chdir(base_path)
 
-            subprocess.check_call(['ln', '-sfn', '{}'.format(source_file),
-                                   '{}'.format(dest)],
-                                  stdout=dev_null, stderr=dev_null)
-            os.chdir(old_cwd)
+            operations.append((file_operations.symlink, source_file,
+                               '{}/{}'.format(base_path, dest)))
             del source
             del dest
         # Process an <add_executable> tag
@@ -1252,40 +1454,35 @@ def add_links(config_file, configs):  # {{{
             else:
                 source = configs.get("executables", source_attr)
 
-            subprocess.check_call(['ln', '-sf', '{}'.format(source),
-                                   '{}/{}'.format(base_path, dest)],
-                                  stdout=dev_null, stderr=dev_null)
+            operations.append((file_operations.symlink, source,
+                               '{}/{}'.format(base_path, dest), True))
             del source_attr
             del source
             del dest
 
-    del config_tree
-    del config_root
-    dev_null.close()
+    for operation in operations:
+        track_output(file_operations.get_link_path(*operation[1:]))
+    file_operations.apply_operations(operations)
 # }}}
 
 
 def make_case_dir(config_file, base_path):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = get_xml_root(config_file)
 
     case_name = config_root.attrib['case']
 
     # Build the case directory, if it doesn't already exist
-    if not os.path.exists('{}/{}'.format(base_path, case_name)):
-        os.makedirs('{}/{}'.format(base_path, case_name))
-
-    del config_root
-    del config_tree
+    make_dirs('{}/{}'.format(base_path, case_name))
 
     return case_name
 # }}}
 
 
-def get_defined_files(config_file, init_path, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
-    dev_null = open('/dev/null', 'w')
+def get_file_requests(config_file, configs):  # {{{
+    # Determine where the file of each <get_file> tag in config_file belongs.
+    # Returns a list of (get_file tag, dest_path, file_name) tuples.
+    config_root = get_xml_root(config_file)
+    requests = list()
 
     for get_file in config_root:
         # Process <get_file> tag
@@ -1344,115 +1541,151 @@ def get_defined_files(config_file, init_path, configs):  # {{{
                     print " Exiting..."
                     sys.exit(1)
 
-            # if the dest_path doesn't exist, create it
-            if not os.path.exists(dest_path):
-                os.makedirs(dest_path)
-
-            # If the file doesn't exist in dest_path, process it's mirrors
-            if not os.path.exists('{}/{}'.format(dest_path, file_name)):
-                file_found = False
-                if not file_found:
-                    for mirror in get_file:
-                        # Process each mirror
-                        if mirror.tag == 'mirror':
-                            # Determine the protocol for the mirror
-                            try:
-                                protocol = mirror.attrib['protocol']
-                            except KeyError:
-                                print "Mirror is missing the 'protocol' " \
-                                      "attribute."
-                                print "Exiting..."
-                                sys.exit(1)
-
-                            # Process a wget mirror
-                            if protocol == 'wget':
-                                if config.get('script_input_arguments',
-                                              'no_download') == 'no':
-                                    try:
-                                        path = '{}/{}'.format(
-                                            mirror.attrib['url'], file_name)
-                                    except KeyError:
-                                        print " Mirror with protocol 'wget' " \
-                                              "is missing a 'url' attribute"
-                                        print " Exiting..."
-                                        sys.exit(1)
-
-                                    try:
-                                        subprocess.check_call(
-                                            ['wget', '-q', '{}'.format(path)],
-                                            stdout=dev_null, stderr=dev_null)
-                                    except subprocess.CalledProcessError:
-                                        print " Wget failed...."
-
-                                    try:
-                                        subprocess.check_call(
-                                            ['mv', '{}'.format(file_name),
-                                             '{}/{}'.format(dest_path,
-                                                            file_name)],
-                                            stdout=dev_null, stderr=dev_null)
-                                    except subprocess.CalledProcessError:
-                                        print "  -- Web mirror attempt " \
-                                              "failed. Trying other mirrors..."
-
-                        # If the file exists in dest_path, determine if it
-                        # should be validated
-                        if os.path.exists('{}/{}'.format(dest_path,
-                                          file_name)):
-                            try:
-                                expected_hash = get_file.attrib['hash']
-                                validate_file = True
-                            except KeyError:
-                                validate_file = False
-
-                            # Validate the file, if requested (i.e. file had a
-                            # hash attribute)
-                            if validate_file:
-                                if os.path.exists('{}/{}'.format(dest_path,
-                                                                 file_name)):
-                                    nc = netCDF4.Dataset('{}/{}'.format(
-                                        dest_path, file_name), 'r')
-                                    try:
-                                        file_hash = nc.file_id
-                                    except AttributeError:
-                                        nc.close()
-                                        print " Downloaded file '{}' does " \
-                                              "not have a 'file_id' " \
-                                              "attribute.".format(file_name)
-                                        print " Deleting file and exiting..."
-                                        subprocess.check_call(
-                                            ['rm', '-f',
-                                             '{}/{}'.format(dest_path,
-                                                            file_name)],
-                                            stdout=dev_null, stderr=dev_null)
-                                        sys.exit(1)
-
-                                    nc.close()
-
-                                    if file_hash.strip() != \
-                                            expected_hash.strip():
-                                        print "*** ERROR: Base mesh has " \
-                                              "hash of '{}' which does not " \
-                                              "match expected hash of " \
-                                              "'{}'.".format(file_hash,
-                                                             expected_hash)
-                                        print " Deleting file..."
-                                        subprocess.check_call(
-                                            ['rm', '-f',
-                                             '{}/{}'.format(dest_path,
-                                                            file_name)],
-                                            stdout=dev_null, stderr=dev_null)
-
-                    # IF validation valied, exit.
-                    if not os.path.exists('{}/{}'.format(dest_path,
-                                                         file_name)):
-                        print " Failed to acquire required file '{}'.".format(
-                            file_name)
+            requests.append((get_file, dest_path, file_name))
+
+    return requests
+# }}}
+
+
+def get_mirror_urls(get_file, file_name, configs):  # {{{
+    # Build the URLs of the file from each mirror of a <get_file> tag. There
+    # are none if downloads are disabled.
+    urls = list()
+    for mirror in get_file:
+        # Process each mirror
+        if mirror.tag == 'mirror':
+            # Determine the protocol for the mirror
+            try:
+                protocol = mirror.attrib['protocol']
+            except KeyError:
+                print "Mirror is missing the 'protocol' attribute."
+                print "Exiting..."
+                sys.exit(1)
+
+            # Process a wget mirror
+            if protocol == 'wget':
+                if configs.get('script_input_arguments',
+                               'no_download') == 'no':
+                    try:
+                        urls.append('{}/{}'.format(mirror.attrib['url'],
+                                                   file_name))
+                    except KeyError:
+                        print " Mirror with protocol 'wget' is missing a " \
+                              "'url' attribute"
                         print " Exiting..."
                         sys.exit(1)
 
-    del config_tree
-    del config_root
-    dev_null.close()
+    return urls
+# }}}
+
+
+def validate_file(get_file, file_path):  # {{{
+    # Validate a downloaded file, if its <get_file> tag has a hash attribute.
+    # Files that don't match are deleted, so the file is downloaded from the
+    # next mirror. Returns True if the file is valid.
+    try:
+        expected_hash = get_file.attrib['hash']
+    except KeyError:
+        return True
+
+    file_hash = file_fetcher.get_file_hash(file_path)
+    if file_hash is None:
+        print " Downloaded file '{}' does not have a 'file_id' " \
+              "attribute.".format(os.path.basename(file_path))
+        print " Deleting file..."
+        file_operations.remove(file_path)
+        file_operations.remove(file_fetcher.get_sidecar_path(file_path))
+        return False
+
+    if file_hash.strip() != expected_hash.strip():
+        print "*** ERROR: Base mesh has hash of '{}' which does not match " \
+              "expected hash of '{}'.".format(file_hash, expected_hash)
+        print " Deleting file..."
+        file_operations.remove(file_path)
+        file_operations.remove(file_fetcher.get_sidecar_path(file_path))
+        return False
+
+    return True
+# }}}
+
+
+def check_existing_file(get_file, file_path):  # {{{
+    # Files that already exist are not validated, since that would mean
+    # opening them on every setup. If the file_id of the file was recorded
+    # when it was downloaded, warn if it no longer matches the hash attribute
+    # (e.g. the file has been updated since).
+    try:
+        expected_hash = get_file.attrib['hash']
+    except KeyError:
+        return
+
+    file_hash = file_fetcher.get_recorded_file_hash(file_path)
+    if file_hash is not None and file_hash.strip() != expected_hash.strip():
+        print " WARNING: File '{}' has hash of '{}' which does not match " \
+              "expected hash of '{}'.".format(file_path, file_hash,
+                                              expected_hash)
+# }}}
+
+
+def get_defined_files(config_file, init_path, configs):  # {{{
+    for get_file, dest_path, file_name in get_file_requests(config_file,
+                                                            configs):
+        # if the dest_path doesn't exist, create it
+        make_dirs(dest_path)
+
+        file_path = '{}/{}'.format(dest_path, file_name)
+        if os.path.exists(file_path):
+            check_existing_file(get_file, file_path)
+            continue
+
+        # If the file doesn't exist in dest_path, try each of its mirrors
+        # until one of them gives a valid file.
+        urls = get_mirror_urls(get_file, file_name, configs)
+        file_fetcher.fetch_file(
+            file_path, urls, lambda path: validate_file(get_file, path))
+
+        # IF validation valied, exit.
+        if not os.path.exists(file_path):
+            print " Failed to acquire required file '{}'.".format(file_name)
+            print " Exiting..."
+            sys.exit(1)
+# }}}
+
+
+def prefetch_files(cases, configs):  # {{{
+    # Download the missing files of all cases concurrently, before any case
+    # is set up. Files that can't be downloaded are reported when the case
+    # that needs them is set up.
+    if configs.get('script_input_arguments', 'no_download') != 'no':
+        return
+
+    files = list()
+    get_file_tags = dict()
+    for case in cases:
+        set_case_paths(case[0], case[1], case[2], case[3], configs)
+        test_path = configs.get('script_paths', 'test_dir')
+        for file in os.listdir(test_path):
+            if not fnmatch.fnmatch(file, '*.xml'):
+                continue
+            config_file = '{}/{}'.format(test_path, file)
+            if get_config_file_type(config_file) != 'config':
+                continue
+
+            configs.set('script_paths', 'case_dir',
+                        '{}/{}'.format(test_path, get_case_name(config_file)))
+            for get_file, dest_path, file_name in get_file_requests(
+                    config_file, configs):
+                file_path = '{}/{}'.format(dest_path, file_name)
+                if not os.path.exists(file_path):
+                    make_dirs(dest_path)
+                    files.append((file_path, get_mirror_urls(
+                        get_file, file_name, configs)))
+                    get_file_tags[os.path.abspath(file_path)] = get_file
+
+    if files:
+        file_fetcher.fetch_files(
+            files, validate=lambda path: validate_file(
+                get_file_tags[os.path.abspath(path)], path))
 # }}}
 
 
@@ -1512,33 +1745,452 @@ def get_template_info(template, configs):  # {{{
 # }}}
 
 
+def get_xml_root(xml_file):  # {{{
+    # Return the root of a parsed XML file. Files are only parsed once per
+    # setup invocation, and the parsed tree is shared by every generator, so
+    # callers that modify the tree must work on a copy.
+    xml_path = os.path.abspath(xml_file)
+    if xml_path not in xml_roots:
+        xml_roots[xml_path] = ET.parse(xml_path).getroot()
+
+    track_input(xml_path)
+
+    return xml_roots[xml_path]
+# }}}
+
+
+def get_template_file(template, configs):  # {{{
+    # Determine the full path to the file of a <template> tag.
+    template_info = get_template_info(template, configs)
+
+    return '{}/{}'.format(template_info['template_path'],
+                          template_info['template_file'])
+# }}}
+
+
+def get_template_root(template, configs):  # {{{
+    return get_xml_root(get_template_file(template, configs))
+# }}}
+
+
 def get_config_file_type(config_file):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = get_xml_root(config_file)
 
     # Determine file type
     file_type = config_root.tag
 
-    del config_root
-    del config_tree
-
     return file_type
 # }}}
 
 
 def get_case_name(config_file):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = get_xml_root(config_file)
 
     # Determine file type
     if config_root.tag == 'config':
         name = config_root.attrib['case']
 
-    del config_root
-    del config_tree
-
     return name
 # }}}
+
+
+def make_dirs(path):  # {{{
+    # Create a directory and its parents, if they don't already exist. Cases
+    # may be set up concurrently, so another process creating the directory
+    # first is not an error.
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+# }}}
+
+
+def get_git_version(script_path):  # {{{
+    git_version = subprocess.check_output(
+        ['git', 'describe', '--tags', '--dirty'], cwd=script_path)
+    return git_version.strip('\n')
+# }}}
+# }}}
+
+
+# *** Incremental Setup Functions *** # {{{
+def track_input(path):  # {{{
+    # Record that a file was read by the outputs that are being generated.
+    for inputs in input_trackers:
+        inputs.add(os.path.abspath(path))
+# }}}
+
+
+def track_output(path):  # {{{
+    # Record that a file was written by the outputs that are being generated.
+    for outputs in output_trackers:
+        outputs.add(os.path.abspath(path))
+# }}}
+
+
+def start_tracking():  # {{{
+    input_trackers.append(set())
+    output_trackers.append(set())
+# }}}
+
+
+def stop_tracking():  # {{{
+    # Returns the sets of files read and written since the matching call to
+    # start_tracking.
+    return input_trackers.pop(), output_trackers.pop()
+# }}}
+
+
+def get_input_hash(path):  # {{{
+    # Return the hash of the contents of a file, or None if it doesn't exist.
+    # Each file is only hashed once per setup invocation.
+    if path not in input_hashes:
+        try:
+            input_file = open(path, 'rb')
+            try:
+                input_hashes[path] = hashlib.sha1(input_file.read()).hexdigest()
+            finally:
+                input_file.close()
+        except IOError:
+            input_hashes[path] = None
+
+    return input_hashes[path]
+# }}}
+
+
+def get_config_hash(configs):  # {{{
+    # Hash all configuration options (including the paths of the current
+    # case), along with this script, since changing either can change every
+    # generated file. Whether setup was forced doesn't affect the outputs.
+    config_hash = hashlib.sha1()
+    for section in sorted(configs.sections()):
+        config_hash.update('[{}]\n'.format(section))
+        for option, value in sorted(configs.items(section, raw=True)):
+            if (section, option) != ('script_input_arguments', 'force_setup'):
+                config_hash.update('{} = {}\n'.format(option, value))
+    config_hash.update(get_input_hash(os.path.abspath(__file__.replace(
+        '.pyc', '.py'))) or '')
+    return config_hash.hexdigest()
+# }}}
+
+
+def get_output_state(path):  # {{{
+    # Return what is recorded about a generated file in the manifest: the
+    # target of a link, or the size and modification time of a file, so
+    # outputs that were edited or truncated since they were generated are
+    # noticed. Returns None if the file doesn't exist.
+    if os.path.islink(path):
+        return {'link': os.readlink(path)}
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+# }}}
+
+
+def read_manifest(path):  # {{{
+    # Read the setup manifest in the directory path. The manifest records,
+    # for each generated set of outputs, the hashes of the inputs and
+    # configuration used to generate them, and the state of each output.
+    try:
+        manifest_file = open('{}/{}'.format(path, manifest_file_name), 'r')
+        try:
+            manifest = json.load(manifest_file)
+        finally:
+            manifest_file.close()
+    except (IOError, ValueError):
+        return dict()
+
+    if not isinstance(manifest, dict):
+        return dict()
+    return manifest
+# }}}
+
+
+def write_manifest(path, manifest):  # {{{
+    manifest_path = '{}/{}'.format(path, manifest_file_name)
+    temp_path = '{}.{:d}.tmp'.format(manifest_path, os.getpid())
+    manifest_file = open(temp_path, 'w')
+    try:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    finally:
+        manifest_file.close()
+    os.rename(temp_path, manifest_path)
+# }}}
+
+
+def manifest_entry_is_current(entry, config_hash):  # {{{
+    # The outputs are current if the configuration and all inputs are
+    # unchanged, and all outputs still exist as they were generated.
+    try:
+        if entry['config'] != config_hash:
+            return False
+        for path, input_hash in entry['inputs'].iteritems():
+            if get_input_hash(path) != input_hash:
+                return False
+        for path, output_state in entry['outputs'].iteritems():
+            if output_state is None or \
+                    get_output_state(path) != output_state:
+                return False
+    except (KeyError, TypeError, AttributeError):
+        return False
+
+    return True
+# }}}
+
+
+def generate_if_changed(manifest, key, configs, generator, *args):  # {{{
+    # Call generator(*args), unless the manifest entry for key shows that
+    # the outputs it generated last time are still current. The files read
+    # and written by the generator are recorded in the manifest. Returns True
+    # if the generator was called.
+    config_hash = get_config_hash(configs)
+    if configs.get('script_input_arguments', 'force_setup') == 'no' and \
+            key in manifest and \
+            manifest_entry_is_current(manifest[key], config_hash):
+        return False
+
+    start_tracking()
+    try:
+        generator(*args)
+    finally:
+        inputs, outputs = stop_tracking()
+
+    manifest[key] = {'config': config_hash,
+                     'inputs': dict([(path, get_input_hash(path))
+                                     for path in inputs]),
+                     'outputs': dict([(path, get_output_state(path))
+                                      for path in outputs])}
+    return True
+# }}}
+# }}}
+
+# *** Test Case Setup Functions *** # {{{
+def get_setup_config(config_file, work_dir, model_runtime=None,
+                     baseline_dir=None, no_download=False,
+                     force_setup=False):  # {{{
+    # Read the setup configuration file, and add the configuation information
+    # needed to set up test cases. This allows passing configs around with all
+    # of the config options needed to build paths, and determine options.
+    #
+    # The result can be shared by any number of calls to setup_case, which
+    # fill in the options that are specific to each test case.
+    configs = ConfigParser.SafeConfigParser()
+    configs.read(config_file)
+
+    configs.add_section('script_input_arguments')
+    configs.add_section('script_paths')
+
+    if baseline_dir:
+        configs.set('script_paths', 'baseline_dir', baseline_dir)
+    else:
+        configs.set('script_paths', 'baseline_dir', 'NONE')
+
+    if no_download:
+        configs.set('script_input_arguments', 'no_download', 'yes')
+    else:
+        configs.set('script_input_arguments', 'no_download', 'no')
+
+    # Unless forced, files are only regenerated if their inputs have changed
+    if force_setup:
+        configs.set('script_input_arguments', 'force_setup', 'yes')
+    else:
+        configs.set('script_input_arguments', 'force_setup', 'no')
+
+    configs.set('script_paths', 'script_path',
+                os.path.dirname(os.path.realpath(__file__)))
+    configs.set('script_paths', 'work_dir', os.path.abspath(work_dir))
+    configs.set('script_paths', 'utility_scripts',
+                '{}/utility_scripts'.format(configs.get('script_paths',
+                                                        'script_path')))
+
+    if not model_runtime:
+        configs.set('script_input_arguments', 'model_runtime',
+                    '{}/runtime_definitions/mpirun.xml'.format(
+                        configs.get('script_paths', 'script_path')))
+        print ' WARNING: No runtime definition selected. Using the default ' \
+              'of {}'.format(configs.get('script_input_arguments',
+                                         'model_runtime'))
+    else:
+        configs.set('script_input_arguments', 'model_runtime',
+                    model_runtime)
+
+    return configs
+# }}}
+
+
+def set_case_paths(core, configuration, resolution, test, configs):  # {{{
+    configs.set('script_input_arguments', 'core', core)
+    configs.set('script_input_arguments', 'configuration', configuration)
+    configs.set('script_input_arguments', 'resolution', resolution)
+    configs.set('script_input_arguments', 'test', test)
+
+    # Set paths to core, configuration, resolution, and case for use in
+    # functions
+    test_path = '{}/{}/{}/{}'.format(core, configuration, resolution, test)
+    configs.set('script_paths', 'core_dir', core)
+    configs.set('script_paths', 'configuration_dir',
+                '{}/{}'.format(core, configuration))
+    configs.set('script_paths', 'resolution_dir',
+                '{}/{}/{}'.format(core, configuration, resolution))
+    configs.set('script_paths', 'test_dir', test_path)
+    configs.set('script_paths', 'config_path', test_path)
+# }}}
+
+
+def setup_case(core, configuration, resolution, test, configs):  # {{{
+    # Set up all cases and driver scripts of a single test case. The paths of
+    # the test case are stored in configs for use by the setup functions.
+    # Returns True if anything was set up.
+    set_case_paths(core, configuration, resolution, test, configs)
+
+    # Setup each xml file in the configuration directory:
+    test_path = configs.get('script_paths', 'test_dir')
+    work_dir = '{}/{}'.format(configs.get('script_paths', 'work_dir'),
+                              test_path)
+
+    # Only write history if we did something...
+    did_setup = False
+
+    # Loop over all files in test_path that have the .xml extension.
+    for file in os.listdir('{}'.format(test_path)):
+        if fnmatch.fnmatch(file, '*.xml'):
+            # Build full file name
+            config_file = '{}/{}'.format(test_path, file)
+
+            # Determine the type of the config file
+            # Could be config, driver_script, template, etc.
+            # The type is defined by the parent tag.
+            config_type = get_config_file_type(config_file)
+
+            # Process config files
+            if config_type == 'config':
+                did_setup = True
+                # Ensure the case directory exists
+                case_dir = make_case_dir(config_file, work_dir)
+                case_name = get_case_name(config_file)
+
+                # Set case_dir path for function calls
+                configs.set('script_paths', 'case_dir',
+                            '{}/{}'.format(test_path, case_name))
+
+                case_path = '{}/{}'.format(work_dir, case_dir)
+
+                # Outputs whose inputs haven't changed since the case was
+                # last set up are skipped.
+                manifest = read_manifest(case_path)
+                skipped = list()
+
+                # Generate all namelists for this case
+                if not generate_if_changed(
+                        manifest, '{}:namelists'.format(file), configs,
+                        generate_namelist_files, config_file, case_path,
+                        configs):
+                    skipped.append('namelists')
+
+                # Generate all streams files for this case
+                if not generate_if_changed(
+                        manifest, '{}:streams'.format(file), configs,
+                        generate_streams_files, config_file, case_path,
+                        configs):
+                    skipped.append('streams')
+
+                # Ensure required files exist for this case
+                get_defined_files(config_file, '{}'.format(case_path),
+                                  configs)
+
+                # Process all links for this case
+                if not generate_if_changed(
+                        manifest, '{}:links'.format(file), configs,
+                        add_links, config_file, configs):
+                    skipped.append('links')
+
+                # Generate run scripts for this case.
+                if not generate_if_changed(
+                        manifest, '{}:run_scripts'.format(file), configs,
+                        generate_run_scripts, config_file,
+                        '{}'.format(case_path), configs):
+                    skipped.append('run scripts')
+
+                write_manifest(case_path, manifest)
+
+                print " -- Set up case: {}/{}".format(work_dir, case_dir)
+                if skipped:
+                    print "    Skipped unchanged {}".format(
+                        ', '.join(skipped))
+            # Process driver scripts
+            elif config_type == 'driver_script':
+                did_setup = True
+
+                # Generate driver scripts, unless they haven't changed.
+                make_dirs(work_dir)
+                manifest = read_manifest(work_dir)
+                if generate_if_changed(manifest,
+                                       '{}:driver_script'.format(file),
+                                       configs, generate_driver_scripts,
+                                       config_file, configs):
+                    write_manifest(work_dir, manifest)
+                    print " -- Set up driver script in {}".format(work_dir)
+                else:
+                    print " -- Skipped unchanged driver script in " \
+                          "{}".format(work_dir)
+
+    return did_setup
+# }}}
+
+
+def setup_case_worker(case_and_configs):  # {{{
+    # Set up a single test case in a worker process. Errors in the setup
+    # functions exit with sys.exit, which would otherwise kill the worker and
+    # leave the pool waiting for a result forever. Returns None on failure.
+    case, configs = case_and_configs
+    try:
+        return setup_case(case[0], case[1], case[2], case[3], configs)
+    except SystemExit:
+        return None
+    finally:
+        sys.stdout.flush()
+# }}}
+
+
+def setup_cases(cases, configs, workers=None):  # {{{
+    # Set up a list of test cases, each given as a tuple of (core,
+    # configuration, resolution, test). All cases share configs, along with
+    # the cache of parsed XML files, so every file is only read once.
+    #
+    # If workers is greater than one, the cases are set up concurrently by a
+    # pool of that many processes. Returns a list of flags, one per case, that
+    # are True if anything was set up for the case.
+    if len(cases) > 1:
+        prefetch_files(cases, configs)
+
+    if not workers or workers <= 1 or len(cases) <= 1:
+        return [setup_case(case[0], case[1], case[2], case[3], configs)
+                for case in cases]
+
+    sys.stdout.flush()
+    pool = multiprocessing.Pool(min(workers, len(cases)))
+    try:
+        results = pool.map(setup_case_worker,
+                           [(case, configs) for case in cases], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = False
+    for case, result in zip(cases, results):
+        if result is None:
+            failed = True
+            print "ERROR: Failed to set up test case: " \
+                  "-o {} -c {} -r {} -t {}".format(*case)
+    if failed:
+        print "Exiting..."
+        sys.exit(1)
+
+    return results
+# }}}
 # }}}
 
 
@@ -1580,6 +2232,14 @@ if __name__ == "__main__":
                         help="If set, script will create case directories in "
                              "work_dir rather than the current directory.",
                         metavar="PATH")
+    parser.add_argument("--force_setup", dest="force_setup",
+                        help="If set, all files are regenerated, even if "
+                             "their inputs haven't changed since the last "
+                             "setup.", action="store_true")
+    parser.add_argument("--file_operation_log", dest="file_operation_log",
+                        help="If set, links, permission changes, moves and "
+                             "removals performed during setup are logged to "
+                             "this file.", metavar="FILE")
 
     args = parser.parse_args()
 
@@ -1610,170 +2270,48 @@ if __name__ == "__main__":
     if args.case_num:
         use_case_list = True
         case_list = args.case_num.split(',')
+        for case_num in case_list:
+            if get_test_case(case_num) is None:
+                parser.error(' Invalid case number {}. See list_testcases.py '
+                             'for the available test cases.'.format(case_num))
     else:
         use_case_list = False
         case_list = list()
         case_list.append(0)
 
-    config = ConfigParser.SafeConfigParser()
-    config.read(args.config_file)
-
-    if not args.no_download:
-        args.no_download = False
-
     if not args.work_dir:
         args.work_dir = os.getcwd()
 
-    # Add configuation information to the config object.
-    # This allows passing config around with all of the config options needed
-    # to build paths, and determine options.
-    config.add_section('script_input_arguments')
-    config.add_section('script_paths')
-
-    if not use_case_list:
-        config.set('script_input_arguments', 'core', args.core)
-        config.set('script_input_arguments', 'configuration',
-                   args.configuration)
-        config.set('script_input_arguments', 'resolution', args.resolution)
-        config.set('script_input_arguments', 'test', args.test)
-
-    if args.baseline_dir:
-        config.set('script_paths', 'baseline_dir', args.baseline_dir)
-    else:
-        config.set('script_paths', 'baseline_dir', 'NONE')
+    if args.file_operation_log:
+        file_operations.set_log(open(args.file_operation_log, 'a'))
 
-    if args.no_download:
-        config.set('script_input_arguments', 'no_download', 'yes')
-    else:
-        config.set('script_input_arguments', 'no_download', 'no')
-
-    config.set('script_paths', 'script_path',
-               os.path.dirname(os.path.realpath(__file__)))
-    config.set('script_paths', 'work_dir', os.path.abspath(args.work_dir))
-    config.set('script_paths', 'utility_scripts',
-               '{}/utility_scripts'.format(config.get('script_paths',
-                                                      'script_path')))
-
-    if not args.model_runtime:
-        config.set('script_input_arguments', 'model_runtime',
-                   '{}/runtime_definitions/mpirun.xml'.format(
-                       config.get('script_paths', 'script_path')))
-        print ' WARNING: No runtime definition selected. Using the default ' \
-              'of {}'.format(config.get('script_input_arguments',
-                                        'model_runtime'))
-    else:
-        config.set('script_input_arguments', 'model_runtime',
-                   args.model_runtime)
+    config = get_setup_config(args.config_file, args.work_dir,
+                              model_runtime=args.model_runtime,
+                              baseline_dir=args.baseline_dir,
+                              no_download=args.no_download,
+                              force_setup=args.force_setup)
 
     # Build variables for history output
-    old_dir = os.getcwd()
-    os.chdir(config.get('script_paths', 'script_path'))
-    git_version = subprocess.check_output(
-        ['git', 'describe', '--tags', '--dirty'])
-    git_version = git_version.strip('\n')
+    git_version = get_git_version(config.get('script_paths', 'script_path'))
     calling_command = ""
     for arg in sys.argv:
         calling_command = "{}{} ".format(calling_command, arg)
-    os.chdir(old_dir)
 
-    # Iterate over all cases in the case_list.
+    # Build the list of cases to set up.
     # There is only one if the (-o, -c, -r) options were used in place of (-n)
-    for case_num in case_list:
+    cases = list()
+    if use_case_list:
+        for case_num in case_list:
+            case = get_test_case(case_num, config.get('script_paths',
+                                                      'script_path'))
+            cases.append((case['core'], case['configuration'],
+                          case['resolution'], case['test']))
+    else:
+        cases.append((args.core, args.configuration, args.resolution,
+                      args.test))
 
-        # If we're using a case_list, determine the core, configuration, and
-        # resolution for the current test case.
-        if use_case_list:
-            core_configuration = subprocess.check_output(
-                ['{}/list_testcases.py'.format(config.get('script_paths',
-                                                          'script_path')),
-                 '-n', '{:d}'.format(int(case_num))])
-            config_options = core_configuration.strip('\n').split(' ')
-            config.set('script_input_arguments', 'core', config_options[1])
-            config.set('script_input_arguments', 'configuration',
-                       config_options[3])
-            config.set('script_input_arguments', 'resolution',
-                       config_options[5])
-            config.set('script_input_arguments', 'test', config_options[7])
-
-        # Setup each xml file in the configuration directory:
-        test_path = '{}/{}/{}/{}'.format(
-            config.get('script_input_arguments', 'core'),
-            config.get('script_input_arguments', 'configuration'),
-            config.get('script_input_arguments', 'resolution'),
-            config.get('script_input_arguments', 'test'))
-        work_dir = '{}/{}'.format(config.get('script_paths', 'work_dir'),
-                                  test_path)
-
-        # Set paths to core, configuration, resolution, and case for use in
-        # functions
-        config.set('script_paths', 'core_dir',
-                   config.get('script_input_arguments', 'core'))
-        config.set('script_paths', 'configuration_dir',
-                   '{}/{}'.format(config.get('script_paths', 'core_dir'),
-                                  config.get('script_input_arguments',
-                                             'configuration')))
-        config.set('script_paths', 'resolution_dir',
-                   '{}/{}'.format(config.get('script_paths',
-                                             'configuration_dir'),
-                                  config.get('script_input_arguments',
-                                             'resolution')))
-        config.set('script_paths', 'test_dir', test_path)
-        config.set('script_paths', 'config_path', test_path)
-
-        # Only write history if we did something...
-        write_history = False
-
-        # Loop over all files in test_path that have the .xml extension.
-        for file in os.listdir('{}'.format(test_path)):
-            if fnmatch.fnmatch(file, '*.xml'):
-                # Build full file name
-                config_file = '{}/{}'.format(test_path, file)
-
-                # Determine the type of the config file
-                # Could be config, driver_script, template, etc.
-                # The type is defined by the parent tag.
-                config_type = get_config_file_type(config_file)
-
-                # Process config files
-                if config_type == 'config':
-                    write_history = True
-                    # Ensure the case directory exists
-                    case_dir = make_case_dir(config_file, work_dir)
-                    case_name = get_case_name(config_file)
-
-                    # Set case_dir path for function calls
-                    config.set('script_paths', 'case_dir',
-                               '{}/{}'.format(config.get('script_paths',
-                                                         'test_dir'),
-                                              case_name))
-
-                    case_path = '{}/{}'.format(work_dir, case_dir)
-
-                    # Generate all namelists for this case
-                    generate_namelist_files(config_file, case_path, config)
-
-                    # Generate all streams files for this case
-                    generate_streams_files(config_file, case_path, config)
-
-                    # Ensure required files exist for this case
-                    get_defined_files(config_file, '{}'.format(case_path),
-                                      config)
-
-                    # Process all links for this case
-                    add_links(config_file, config)
-
-                    # Generate run scripts for this case.
-                    generate_run_scripts(config_file, '{}'.format(case_path),
-                                         config)
-
-                    print " -- Set up case: {}/{}".format(work_dir, case_dir)
-                # Process driver scripts
-                elif config_type == 'driver_script':
-                    write_history = True
-
-                    # Generate driver scripts.
-                    generate_driver_scripts(config_file, config)
-                    print " -- Set up driver script in {}".format(work_dir)
+    # Only write history if we did something...
+    write_history = any(setup_cases(cases, config))
 
     # Write the history of this command to the command_history file, for
     # provenance.
@@ -1793,17 +2331,15 @@ if __name__ == "__main__":
         history_file.write('setup the following cases:\n')
         if use_case_list:
             for case_num in case_list:
-                core_configuration = subprocess.check_output(
-                    ['./list_testcases.py', '-n',
-                     '{:d}'.format(int(case_num))])
-                config_options = core_configuration.strip('\n').split(' ')
+                case = get_test_case(case_num, config.get('script_paths',
+                                                          'script_path'))
                 history_file.write('\n')
-                history_file.write('    core: {}\n'.format(config_options[1]))
+                history_file.write('    core: {}\n'.format(case['core']))
                 history_file.write('    configuration: {}\n'.format(
-                    config_options[3]))
+                    case['configuration']))
                 history_file.write('    resolution: {}\n'.format(
-                    config_options[5]))
-                history_file.write('    test: {}\n'.format(config_options[7]))
+                    case['resolution']))
+                history_file.write('    test: {}\n'.format(case['test']))
         else:
             history_file.write('core: {}\n'.format(
                 config.get('script_input_arguments', 'core')))
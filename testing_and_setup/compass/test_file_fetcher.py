@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+Tests for file_fetcher, downloading from mirrors served by local HTTP servers.
+
+Run with:
+    python test_file_fetcher.py
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+from StringIO import StringIO
+
+import file_fetcher
+
+
+class MirrorHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):  # {{{
+    # Serves the files in the server's directory. Depending on the server's
+    # settings, range requests are supported or ignored, HEAD requests are
+    # answered slowly and downloads are cut short.
+
+    def translate_path(self, path):  # {{{
+        return os.path.join(self.server.directory, path.lstrip('/'))
+    # }}}
+
+    def log_message(self, format, *args):  # {{{
+        pass
+    # }}}
+
+    def do_HEAD(self):  # {{{
+        time.sleep(self.server.head_delay)
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+    # }}}
+
+    def send_head(self):  # {{{
+        range_header = self.headers.getheader('Range')
+        if self.command == 'GET':
+            self.server.ranges.append(range_header)
+
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        status = 200
+        start = 0
+        if self.server.support_ranges and range_header is not None:
+            start = int(range_header.split('=')[1].rstrip('-'))
+            if start >= len(data):
+                self.send_error(416)
+                return None
+            status = 206
+
+        body = data[start:]
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {:d}-{:d}/{:d}'.format(
+                start, len(data) - 1, len(data)))
+        self.end_headers()
+
+        if self.server.truncate:
+            body = body[:len(body) // 2]
+        return StringIO(body)
+    # }}}
+# }}}
+
+
+class MirrorServer(SocketServer.ThreadingMixIn,
+                   BaseHTTPServer.HTTPServer):  # {{{
+    daemon_threads = True
+
+    def __init__(self, directory, support_ranges=True, head_delay=0.,
+                 truncate=False):  # {{{
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           MirrorHandler)
+        self.directory = directory
+        self.support_ranges = support_ranges
+        self.head_delay = head_delay
+        self.truncate = truncate
+        # The Range header of each GET request (None if there wasn't one)
+        self.ranges = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+    # }}}
+
+    def url(self, file_name):  # {{{
+        return 'http://127.0.0.1:{:d}/{}'.format(self.server_address[1],
+                                                 file_name)
+    # }}}
+
+    def stop(self):  # {{{
+        self.shutdown()
+        self.server_close()
+    # }}}
+# }}}
+
+
+class TestFetchFile(unittest.TestCase):  # {{{
+
+    file_name = 'mesh.nc'
+    contents = ''.join(chr(i % 251) for i in range(100000))
+
+    def setUp(self):  # {{{
+        self.work_dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.work_dir, self.file_name)
+        self.part_path = '{}.part'.format(self.dest)
+        self.servers = []
+        self.log = file_fetcher.log
+        file_fetcher.log = lambda message: None
+    # }}}
+
+    def tearDown(self):  # {{{
+        file_fetcher.log = self.log
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.work_dir)
+    # }}}
+
+    def start_mirror(self, contents=None, **kwargs):  # {{{
+        # Start a server with its own copy of the file
+        directory = tempfile.mkdtemp(dir=self.work_dir)
+        if contents is None:
+            contents = self.contents
+        with open(os.path.join(directory, self.file_name), 'wb') as f:
+            f.write(contents)
+        server = MirrorServer(directory, **kwargs)
+        self.servers.append(server)
+        return server
+    # }}}
+
+    def write_part(self, contents):  # {{{
+        with open(self.part_path, 'wb') as f:
+            f.write(contents)
+    # }}}
+
+    def assert_downloaded(self):  # {{{
+        self.assertFalse(os.path.exists(self.part_path))
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+    # }}}
+
+    def test_download(self):  # {{{
+        mirror = self.start_mirror()
+        self.assertTrue(file_fetcher.fetch_file(
+            self.dest, [mirror.url(self.file_name)]))
+        self.assert_downloaded()
+        self.assertEqual(mirror.ranges, [None])
+    # }}}
+
+    def test_resume_partial_download(self):  # {{{
+        mirror = self.start_mirror()
+        self.write_part(self.contents[:30000])
+        self.assertTrue(file_fetcher.fetch_file(
+            self.dest, [mirror.url(self.file_name)]))
+        self.assert_downloaded()
+        self.assertEqual(mirror.ranges, ['bytes=30000-'])
+    # }}}
+
+    def test_range_ignored(self):  # {{{
+        # The mirror answers the range request with the whole file (200), so
+        # the partial file must be overwritten rather than appended to
+        mirror = self.start_mirror(support_ranges=False)
+        self.write_part('x' * 30000)
+        self.assertTrue(file_fetcher.fetch_file(
+            self.dest, [mirror.url(self.file_name)]))
+        self.assert_downloaded()
+        self.assertEqual(mirror.ranges, ['bytes=30000-'])
+    # }}}
+
+    def test_range_not_satisfiable(self):  # {{{
+        # The partial file is longer than the file, so the mirror answers 416
+        # and the download starts again
+        mirror = self.start_mirror()
+        self.write_part('x' * (len(self.contents) + 10))
+        self.assertTrue(file_fetcher.fetch_file(
+            self.dest, [mirror.url(self.file_name)]))
+        self.assert_downloaded()
+        self.assertEqual(mirror.ranges,
+                         ['bytes={:d}-'.format(len(self.contents) + 10),
+                          None])
+    # }}}
+
+    def test_interrupted_download_is_kept(self):  # {{{
+        mirror = self.start_mirror(truncate=True)
+        self.assertFalse(file_fetcher.fetch_file(
+            self.dest, [mirror.url(self.file_name)]))
+        self.assertFalse(os.path.exists(self.dest))
+        with open(self.part_path, 'rb') as f:
+            self.assertEqual(f.read(), self.contents[:len(self.contents) // 2])
+
+        mirror.truncate = False
+        self.assertTrue(file_fetcher.fetch_file(
+            self.dest, [mirror.url(self.file_name)]))
+        self.assert_downloaded()
+        self.assertEqual(mirror.ranges[-1],
+                         'bytes={:d}-'.format(len(self.contents) // 2))
+    # }}}
+
+    def test_fall_back_to_next_mirror(self):  # {{{
+        good = self.start_mirror(head_delay=0.5)
+        missing = self.start_mirror()
+        self.assertTrue(file_fetcher.fetch_file(
+            self.dest, [missing.url('other.nc'), good.url(self.file_name)]))
+        self.assert_downloaded()
+    # }}}
+
+    def test_fall_back_when_invalid(self):  # {{{
+        # The corrupt mirror answers first, so its file is downloaded and
+        # rejected before the good mirror is tried
+        good = self.start_mirror(head_delay=0.5)
+        corrupt = self.start_mirror(contents='corrupt')
+        validated = []
+
+        def validate(path):
+            with open(path, 'rb') as f:
+                validated.append(f.read())
+            return validated[-1] == self.contents
+
+        self.assertTrue(file_fetcher.fetch_file(
+            self.dest, [good.url(self.file_name), corrupt.url(self.file_name)],
+            validate))
+        self.assert_downloaded()
+        self.assertEqual(validated, ['corrupt', self.contents])
+    # }}}
+
+    def test_all_mirrors_invalid(self):  # {{{
+        corrupt = self.start_mirror(contents='corrupt')
+        self.assertFalse(file_fetcher.fetch_file(
+            self.dest, [corrupt.url(self.file_name)], lambda path: False))
+        self.assertFalse(os.path.exists(self.dest))
+    # }}}
+
+    def test_fetch_files(self):  # {{{
+        good = self.start_mirror(head_delay=0.5)
+        corrupt = self.start_mirror(contents='corrupt')
+        other_dest = os.path.join(self.work_dir, 'other', self.file_name)
+        os.mkdir(os.path.dirname(other_dest))
+        urls = [good.url(self.file_name), corrupt.url(self.file_name)]
+
+        def validate(path):
+            with open(path, 'rb') as f:
+                return f.read() == self.contents
+
+        exists = file_fetcher.fetch_files([(self.dest, urls),
+                                           (other_dest, urls)],
+                                          validate=validate)
+        self.assertEqual(exists, {self.dest: True, other_dest: True})
+        self.assert_downloaded()
+        with open(other_dest, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+    # }}}
+# }}}
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+This module runs the cases of a test case. It is imported by the driver
+scripts generated by setup_testcase.py.
+
+Each case is described by a dictionary with the following keys:
+    * name: The name of the case (and its directory) within the test case.
+    * cores: The maximum number of cores the case uses at any one time.
+    * depends: A list of names of cases that must be run before this one,
+               because this case uses their outputs.
+    * run: A function that runs the case, raising an exception on failure.
+
+If a core budget is given, cases whose dependencies have finished are run
+concurrently and packed into that budget, and a failed case only stops the
+cases that depend on it. Otherwise, cases are run one after another, in the
+order they are given, and the first failure stops the script.
+"""
+
+from task_scheduler import schedule_tasks
+
+
+def run_cases(cases, max_cores=None):  # {{{
+    # Run all cases, and return True if any of them failed or could not be
+    # run.
+    if max_cores is None:
+        # Exceptions from a failed case are not caught, so the script stops
+        # there, as when its cases were run with check_call one at a time.
+        for case in cases:
+            case['run']()
+        return False
+
+    names = [case['name'] for case in cases]
+
+    # Dependencies on cases that aren't being run (e.g. they were disabled
+    # with --no_<case>) are assumed to have been run before.
+    tasks = list()
+    for case in cases:
+        tasks.append({'name': case['name'],
+                      'cores': case['cores'],
+                      'depends': [dep for dep in case['depends']
+                                  if dep in names],
+                      'run': lambda case=case: case['run']() or True})
+
+    results = schedule_tasks(tasks, max_cores)
+
+    failed = False
+    for name in names:
+        if results[name] is None:
+            print ' ** Skipped {}, since a case it depends on ' \
+                  'failed'.format(name)
+            failed = True
+        elif not results[name]:
+            print ' ** FAIL {}'.format(name)
+            failed = True
+    return failed
+# }}}
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
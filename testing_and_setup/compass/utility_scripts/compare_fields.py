@@ -1,170 +1,333 @@
 #!/usr/bin/env python
-import sys, os, glob, shutil
+"""
+Compare fields between two netCDF files, computing the L1, L2 and L_Infinity
+norms of their difference at each time level.
+
+Any number of fields can be compared in one invocation, either with -v and the
+--l1, --l2 and --linf thresholds, or with one --field option per field, e.g.
+    --field temperature,l1=0.0,l2=0.0,linf=0.0
+Each file is only opened once. A comparison passes if all of the thresholds
+given for it are met. The script returns 1 if any comparison fails.
+
+Fields are read in chunks along their first dimension (after Time), so at most
+about --buffer_size MB is held in memory at once, whatever the size of the
+field. With -q, only whether each comparison passes is of interest, so the
+comparison of a field stops as soon as one of its thresholds is exceeded.
+
+With --bfb, the raw bytes of each field are compared first, and the norms are
+only computed if they differ. This makes checking that a field is bit-for-bit
+identical (e.g. against a baseline) about as cheap as reading it.
+"""
+import sys, os
 import numpy as np
 
-from netCDF4 import *
 from netCDF4 import Dataset as NetCDFFile
 import argparse
 
-parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument("-1", "--file1", dest="filename1", help="first input file", metavar="FILE")
-parser.add_argument("-2", "--file2", dest="filename2", help="second input file", metavar="FILE")
-parser.add_argument("-v", "--var", dest="variable", help="variable to compute error with", metavar="VAR")
-parser.add_argument("--l2", dest="l2_norm", help="value of L2 norm for a pass.", metavar="VAL")
-parser.add_argument("--l1", dest="l1_norm", help="value of L1 norm for a pass.", metavar="VAL")
-parser.add_argument("--linf", dest="linf_norm", help="value of L_Infinity norm for a pass.", metavar="VAL")
-parser.add_argument("-q", "--quiet", dest="quiet", help="turns off printing if diff passes test.", action="store_true")
-
-args = parser.parse_args()
-
-if not args.filename1:
-	parser.error("Two filenames are required inputs.")
-
-if not args.filename2:
-	parser.error("Two filenames are required inputs.")
-
-if not args.variable:
-	parser.error("Variable is a required input.")
-
-if (not args.l2_norm) and (not args.l1_norm) and (not args.linf_norm):
-	print "WARNING: Script will pass since no norm values have been defined."
-
-files_exist = True
-
-if not os.path.exists(args.filename1):
-	print "ERROR: File %s does not exist. Comparison will FAIL."%(args.filename1)
-	files_exist = False
-
-if not os.path.exists(args.filename2):
-	print "ERROR: File %s does not exist. Comparison will FAIL."%(args.filename2)
-	files_exist = False
-
-if not files_exist:
-	sys.exit(1)
-
-f1 = NetCDFFile(args.filename1,'r')
-f2 = NetCDFFile(args.filename2,'r')
-
-try:
-	time_length = f1.variables['xtime'].shape[0]
-except:
-	time_length = 1
-
-try:
-	field1 = f1.variables[args.variable]
-	field2 = f2.variables[args.variable]
-except:
-	print "ERROR: Field '%s' does not exist in both"%(args.variable)
-	print "           file1: %s"%(args.filename1)
-	print "       and file2: %s"%(args.filename2)
-	print "Exiting with a failed comparision, since no comparision can be done but a comparison was requested."
-	sys.exit(1)
-
-if not field1.shape == field2.shape:
-	print "ERROR: Field sizes don't match in different files."
-	sys.exit(1)
-
-linf_norm = -(sys.float_info.max)
+default_buffer_size = 256
+
+def parse_field(field_definition):#{{{
+	# Parse a field definition of the form name,l1=VAL,l2=VAL,linf=VAL into
+	# the name of the field and a dictionary of thresholds. Thresholds that
+	# aren't given are None.
+	items = field_definition.split(',')
+	name = items[0].strip()
+	thresholds = {'l1': None, 'l2': None, 'linf': None}
+	for item in items[1:]:
+		try:
+			norm, value = item.split('=')
+			norm = norm.strip()
+			if norm not in thresholds:
+				raise ValueError
+			thresholds[norm] = float(value)
+		except ValueError:
+			raise ValueError("Invalid threshold '%s' for field '%s'. Expected l1=VAL, l2=VAL or linf=VAL."%(item, name))
+
+	if name == '':
+		raise ValueError("Field definition '%s' is missing a field name."%(field_definition))
+
+	return name, thresholds
+#}}}
+
+def read_chunks(field1, field2, t, buffer_size):#{{{
+	# Yield matching chunks of time level t of two variables (or of all of
+	# them, if t is None), split along their first dimension so each chunk,
+	# its difference and the square of the difference fit in buffer_size
+	# bytes. Only the first entry of 1D variables without a Time dimension is
+	# compared.
+	if t is None:
+		if len(field1.dimensions) < 2:
+			yield field1[0], field2[0]
+			return
+		level_shape = field1.shape
+	else:
+		level_shape = field1.shape[1:]
+		if len(level_shape) == 0:
+			yield field1[t], field2[t]
+			return
+
+	row_bytes = field1.dtype.itemsize * int(np.prod(level_shape[1:]))
+	rows = max(1, buffer_size // (4 * row_bytes))
+	for start in range(0, level_shape[0], rows):
+		end = min(start + rows, level_shape[0])
+		if t is None:
+			yield field1[start:end], field2[start:end]
+		else:
+			yield field1[t, start:end], field2[t, start:end]
+#}}}
+
+def fields_identical(field1, field2, time_levels, buffer_size):#{{{
+	# Return True if the raw bytes of the parts of two variables that would
+	# be compared are identical. Values are read without masking or scaling,
+	# and compared one chunk at a time, stopping at the first difference.
+	if field1.dtype != field2.dtype:
+		return False
+
+	field1.set_auto_maskandscale(False)
+	field2.set_auto_maskandscale(False)
+	try:
+		for t in time_levels:
+			for chunk1, chunk2 in read_chunks(field1, field2, t, buffer_size):
+				if np.asarray(chunk1).tostring() != np.asarray(chunk2).tostring():
+					return False
+	finally:
+		field1.set_auto_maskandscale(True)
+		field2.set_auto_maskandscale(True)
+
+	return True
+#}}}
+
+def compute_norms(field1, field2, t, normalization, limits, buffer_size):#{{{
+	# Accumulate the L1 and L2 norms and the largest absolute difference of
+	# time level t of two variables, one chunk at a time. If limits (a
+	# dictionary of thresholds) is given, stop as soon as a norm is known to
+	# exceed its threshold, since the norms can only grow. Returns the norms
+	# and whether the computation stopped early.
+	sum_abs = 0.0
+	sum_sq = 0.0
+	max_abs = -(sys.float_info.max)
+
+	for chunk1, chunk2 in read_chunks(field1, field2, t, buffer_size):
+		diff = np.absolute(chunk1 - chunk2)
+		sum_abs += np.sum(diff)
+		sum_sq += np.sum(diff * diff)
+		if np.amax(diff) > max_abs:
+			max_abs = np.amax(diff)
+		del diff
 
-pass_val = True
+		if limits is not None:
+			if (limits['l1'] is not None and limits['l1'] < sum_abs / normalization) or \
+					(limits['l2'] is not None and limits['l2'] < np.sqrt(sum_sq)) or \
+					(limits['linf'] is not None and limits['linf'] < max_abs):
+				return sum_abs / normalization, np.sqrt(sum_sq), max_abs, True
+
+	return sum_abs / normalization, np.sqrt(sum_sq), max_abs, False
+#}}}
+
+def compare_field(f1, f2, variable, thresholds, quiet, buffer_size=default_buffer_size*1024*1024, bfb=False):#{{{
+	# Compare one field between two open netCDF files. Returns a dictionary
+	# with the largest norms over all time levels and whether all thresholds
+	# were met. If bfb is True, the norms are only computed if the field
+	# isn't bit-for-bit identical.
+	result = {'pass': True, 'l1': None, 'l2': None, 'linf': None}
+
+	if thresholds['l1'] is None and thresholds['l2'] is None and thresholds['linf'] is None:
+		print "WARNING: Comparison of '%s' will pass since no norm values have been defined."%(variable)
+
+	try:
+		time_length = f1.variables['xtime'].shape[0]
+	except:
+		time_length = 1
+
+	field1 = f1.variables[variable]
+	field2 = f2.variables[variable]
+
+	if not field1.shape == field2.shape:
+		print "ERROR: Field sizes don't match in different files."
+		result['pass'] = False
+		return result
+
+	print "Beginning variable comparisons for all time levels of field '%s'. Note any time levels reported are 0-based."%(variable)
+	if thresholds['l1'] is not None or thresholds['l2'] is not None or thresholds['linf'] is not None:
+		print "    Pass thresholds are:"
+		if thresholds['l1'] is not None:
+			print "       L1: %16.14e"%(thresholds['l1'])
+		if thresholds['l2'] is not None:
+			print "       L2: %16.14e"%(thresholds['l2'])
+		if thresholds['linf'] is not None:
+			print "       L_Infinity: %16.14e"%(thresholds['linf'])
+
+	field_dims = field1.dimensions
+
+	# Fields with a Time dimension are compared one time level at a time.
+	# The L1 norm is normalized by the sum of the dimension sizes of a time
+	# level, and the L_Infinity norm is the largest difference over all time
+	# levels so far. Fields without a Time dimension are compared once.
+	if "Time" in field_dims:
+		time_levels = range(0, time_length)
+		level_shape = field1.shape[1:]
+	else:
+		time_levels = [None]
+		level_shape = field1.shape
 
-print "Beginning variable comparisons for all time levels of field '%s'. Note any time levels reported are 0-based."%(args.variable)
-if ( args.l2_norm or args.l1_norm or args.linf_norm ):
-	print "    Pass thresholds are:"
-	if ( args.l1_norm ):
-		print "       L1: %16.14e"%(float(args.l1_norm))
-	if ( args.l2_norm ):
-		print "       L2: %16.14e"%(float(args.l2_norm))
-	if ( args.linf_norm ):
-		print "       L_Infinity: %16.14e"%(float(args.linf_norm))
+	if len(field_dims) >= 2:
+		normalization = np.sum(level_shape)
+	else:
+		normalization = 1
+
+	if bfb and fields_identical(field1, field2, time_levels, buffer_size):
+		if not quiet:
+			print "    Field is bit-for-bit identical, so all norms are 0."
+		for norm in ['l1', 'l2', 'linf']:
+			result[norm] = 0.0
+			if thresholds[norm] is not None and thresholds[norm] < 0.0:
+				result['pass'] = False
+		return result
+
+	if quiet:
+		limits = thresholds
+	else:
+		limits = None
 
-field_dims = field1.dimensions
+	linf_norm = -(sys.float_info.max)
 
-if "Time" in field_dims:
-	for t in range( 0, time_length):
+	for t in time_levels:
 		pass_time = True
-		if len(field_dims) >= 2:
-			diff = np.absolute(field1[t][:] - field2[t][:])
-		else:
-			diff = np.absolute(field1[t] - field2[t])
-
-		l2_norm = np.sum(diff * diff)
-		l2_norm = np.sqrt(l2_norm)
-
-		l1_norm = np.sum(diff)
-		if len(field_dims) >= 2:
-			l1_norm = l1_norm / np.sum(field1[t][:].shape)
-		l1_norm = np.max(l1_norm)
+		l1_norm, l2_norm, max_abs, stopped = compute_norms(field1, field2, t, normalization, limits, buffer_size)
 
-		if np.amax(diff) > linf_norm:
-			linf_norm = np.amax(diff)
+		if max_abs > linf_norm:
+			linf_norm = max_abs
 
-		diff_str = '%d: '%(t)
-		if args.l1_norm:
-			if float(args.l1_norm) < l1_norm:
+		if t is None:
+			diff_str = ''
+		else:
+			diff_str = '%d: '%(t)
+		if thresholds['l1'] is not None:
+			if thresholds['l1'] < l1_norm:
 				pass_time = False
 		diff_str = '%s l1: %16.14e '%(diff_str, l1_norm)
 
-		if args.l2_norm:
-			if float(args.l2_norm) < l2_norm:
+		if thresholds['l2'] is not None:
+			if thresholds['l2'] < l2_norm:
 				pass_time = False
 		diff_str = '%s l2: %16.14e '%(diff_str, l2_norm)
 
-		if args.linf_norm:
-			if float(args.linf_norm) < linf_norm:
+		if thresholds['linf'] is not None:
+			if thresholds['linf'] < linf_norm:
 				pass_time = False
 		diff_str = '%s linf: %16.14e '%(diff_str, linf_norm)
 
-		if not args.quiet:
+		if stopped:
+			diff_str = '%s (comparison stopped when a threshold was exceeded)'%(diff_str)
+
+		if not quiet:
 			print diff_str
 		elif not pass_time:
 			print diff_str
 
 		if not pass_time:
+			result['pass'] = False
+
+		result['l1'] = max(result['l1'], float(l1_norm))
+		result['l2'] = max(result['l2'], float(l2_norm))
+		result['linf'] = float(linf_norm)
+
+		if stopped:
+			break
+
+	return result
+#}}}
+
+def compare_files(filename1, filename2, fields, quiet=False, buffer_size=default_buffer_size*1024*1024, bfb=False):#{{{
+	# Compare a list of fields, given as (name, thresholds) pairs, between
+	# two files. Returns a list with a dictionary of the result of each
+	# comparison, in the same order as fields.
+	files_exist = True
+
+	if not os.path.exists(filename1):
+		print "ERROR: File %s does not exist. Comparison will FAIL."%(filename1)
+		files_exist = False
+
+	if not os.path.exists(filename2):
+		print "ERROR: File %s does not exist. Comparison will FAIL."%(filename2)
+		files_exist = False
+
+	results = list()
+	if not files_exist:
+		for name, thresholds in fields:
+			results.append({'name': name, 'pass': False, 'l1': None, 'l2': None, 'linf': None})
+		return results
+
+	f1 = NetCDFFile(filename1,'r')
+	f2 = NetCDFFile(filename2,'r')
+	try:
+		for name, thresholds in fields:
+			if name in f1.variables and name in f2.variables:
+				result = compare_field(f1, f2, name, thresholds, quiet, buffer_size, bfb)
+			else:
+				print "ERROR: Field '%s' does not exist in both"%(name)
+				print "           file1: %s"%(filename1)
+				print "       and file2: %s"%(filename2)
+				print "Failing the comparision, since no comparision can be done but a comparison was requested."
+				result = {'pass': False, 'l1': None, 'l2': None, 'linf': None}
+			result['name'] = name
+			results.append(result)
+	finally:
+		f1.close()
+		f2.close()
+
+	return results
+#}}}
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+	parser.add_argument("-1", "--file1", dest="filename1", help="first input file", metavar="FILE")
+	parser.add_argument("-2", "--file2", dest="filename2", help="second input file", metavar="FILE")
+	parser.add_argument("-v", "--var", dest="variable", help="variable to compute error with", metavar="VAR")
+	parser.add_argument("--l2", dest="l2_norm", help="value of L2 norm for a pass.", metavar="VAL")
+	parser.add_argument("--l1", dest="l1_norm", help="value of L1 norm for a pass.", metavar="VAL")
+	parser.add_argument("--linf", dest="linf_norm", help="value of L_Infinity norm for a pass.", metavar="VAL")
+	parser.add_argument("--field", dest="fields", help="a field to compare, with the norm thresholds for a pass,\ne.g. temperature,l1=0.0,l2=0.0,linf=0.0. Can be given more than once.", metavar="FIELD", action="append", default=[])
+	parser.add_argument("-q", "--quiet", dest="quiet", help="turns off printing if diff passes test.", action="store_true")
+	parser.add_argument("--bfb", dest="bfb", help="compare the raw bytes of each field first, and only compute\nnorms if they differ.", action="store_true")
+	parser.add_argument("--buffer_size", dest="buffer_size", help="approximate maximum memory to use when reading fields, in MB\n(default: %d).", metavar="MB", type=float, default=default_buffer_size)
+
+	args = parser.parse_args()
+
+	if not args.filename1:
+		parser.error("Two filenames are required inputs.")
+
+	if not args.filename2:
+		parser.error("Two filenames are required inputs.")
+
+	if not args.variable and not args.fields:
+		parser.error("Variable is a required input.")
+
+	fields = list()
+	if args.variable:
+		thresholds = {'l1': None, 'l2': None, 'linf': None}
+		for norm, value in [('l1', args.l1_norm), ('l2', args.l2_norm), ('linf', args.linf_norm)]:
+			if value:
+				thresholds[norm] = float(value)
+		fields.append((args.variable, thresholds))
+
+	for field_definition in args.fields:
+		try:
+			fields.append(parse_field(field_definition))
+		except ValueError as e:
+			parser.error(str(e))
+
+	results = compare_files(args.filename1, args.filename2, fields, args.quiet, int(args.buffer_size*1024*1024), args.bfb)
+
+	pass_val = True
+	for result in results:
+		if result['pass']:
+			print ' ** PASS Comparison of %s between %s and\n    %s'%(result['name'], args.filename1, args.filename2)
+		else:
+			print ' ** FAIL Comparison of %s between %s and\n    %s'%(result['name'], args.filename1, args.filename2)
 			pass_val = False
 
-		del diff
-else:
-	if len(field_dims) >= 2:
-		diff = np.absolute(field1[:] - field2[:])
+	if pass_val:
+		sys.exit(0)
 	else:
-		diff = np.absolute(field1[0] - field2[0])
-
-	l2_norm = np.sum(diff * diff)
-	l2_norm = np.sqrt(l2_norm)
-
-	l1_norm = np.sum(diff)
-	if len(field_dims) >= 2:
-		l1_norm = l1_norm / np.sum(field1[:].shape)
-	l1_norm = np.max(l1_norm)
-
-	if np.amax(diff) > linf_norm:
-		linf_norm = np.amax(diff)
-
-	diff_str = ''
-	if args.l1_norm:
-		if float(args.l1_norm) < l1_norm:
-			pass_val = False
-	diff_str = '%s l1: %16.14e '%(diff_str, l1_norm)
-
-	if args.l2_norm:
-		if float(args.l2_norm) < l2_norm:
-			pass_val = False
-	diff_str = '%s l2: %16.14e '%(diff_str, l2_norm)
-
-	if args.linf_norm:
-		if float(args.linf_norm) < linf_norm:
-			pass_val = False
-	diff_str = '%s linf: %16.14e '%(diff_str, linf_norm)
-
-	if not args.quiet:
-		print diff_str
-	elif not pass_val:
-		print diff_str
-
-	del diff
-
-if pass_val:
-	sys.exit(0)
-else:
-	sys.exit(1)
+		sys.exit(1)
@@ -1,76 +1,123 @@
 #!/usr/bin/env python
+"""
+Compare timers between two run directories.
 
-import sys, os, fnmatch
+Timers are read once per run directory with the mpas_timers module, which
+caches them next to the log files. Timer names are matched exactly, either by
+name (e.g. 'time integration') or by the path of names from the top level
+timer (e.g. 'total time/time integration'). More than one timer can be
+compared by giving -t more than once.
+
+If a performance history file (see perf_history.py) is given, the timers of
+each run directory given with -r are compared to their recent history. If a
+number of standard deviations is also given, the script fails if any of them
+is a regression. These default to the COMPASS_PERF_HISTORY and COMPASS_PERF_SIGMA
+environment variables, which are set by regression suite scripts.
+"""
+
+import os
+import sys
 import argparse
-import re
-
-def find_timer_value(timer_name, directory):#{{{
-	# Build a regular expression for any two characters with a space between them.
-	regex = re.compile(r'(\S) (\S)')
-
-	sub_timer_name = timer_name.replace(' ', '_')
-
-	timer = 0.0
-	timer_found = False
-	for file in os.listdir(directory):
-		if not timer_found:
-			process_file = False
-			# Compare files written using built in MPAS timers
-			if fnmatch.fnmatch(file, "log.*.out"):
-				timer_line_size = 6
-				name_index = 0
-				total_index = 1
-				process_file = True
-			# Compare files written using GPTL timers
-			elif fnmatch.fnmatch(file, "timing.*"):
-				timer_line_size = 6
-				name_index = 0
-				total_index = 3
-				process_file = True
-
-			if process_file:
-				stats_file = open('%s/%s'%(directory, file), "r")
-				for block in iter(lambda: stats_file.readline(), ""):
-					new_block = regex.sub(r"\1_\2", block[2:])
-					new_block_arr = new_block.split()
-					if len(new_block_arr) >= timer_line_size:
-						if sub_timer_name.find(new_block_arr[name_index]) >= 0:
-							try:
-								timer = timer + float(new_block_arr[total_index])
-								timer_found = True
-							except ValueError:
-								timer = timer
-						del new_block
-					del new_block_arr
-
-	return timer_found, timer
-#}}}
 
-# Define and process input arguments
-parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument('-b', '--base_directory', dest="base_directory", help="Directory with the baseline timer information.", required=True)
-parser.add_argument('-c', '--comparison_directory', dest="comparison_directory", help="Directory with the comparison timer information.", required=True)
-parser.add_argument('-t', '--timer', dest="timer", help="Name of the timer to compare", required=True)
-parser.add_argument('-s', '--speedup', dest="speedup", help="If set, only speedup will be printed. This is useful when making speedup plots.", action="store_true")
+from mpas_timers import get_timer_total
+from perf_history import check_timer, default_window, default_min_samples, default_min_change
 
-args = parser.parse_args()
+def compare_timer(timer_name, base_directory, comparison_directory, speedup_only):#{{{
+	# Print the comparison of one timer. Returns False if the timer wasn't
+	# found in both directories.
+	timer1_found, timer1 = get_timer_total(base_directory, timer_name)
+	timer2_found, timer2 = get_timer_total(comparison_directory, timer_name)
 
-timer1_found, timer1 = find_timer_value(args.timer, args.base_directory)
-timer2_found, timer2 = find_timer_value(args.timer, args.comparison_directory)
+	if not (timer1_found and timer2_found):
+		if not timer1_found:
+			print "WARNING: Timer %s was not found in %s"%(timer_name, base_directory)
+		if not timer2_found:
+			print "WARNING: Timer %s was not found in %s"%(timer_name, comparison_directory)
+		return False
 
-if timer1_found and timer2_found:
 	try:
 		speedup = timer1 / timer2
 	except:
 		speedup = 1.0
 
-	percent = (timer2 - timer1) / timer1
+	try:
+		percent = (timer2 - timer1) / timer1
+	except:
+		percent = 0.0
 
-	if not args.speedup:
-		print "Comparing timer %s:"%(args.timer)
+	if not speedup_only:
+		print "Comparing timer %s:"%(timer_name)
 		print "             Base: %lf"%(timer1)
 		print "          Compare: %lf"%(timer2)
 		print "   Percent Change: %lf%%"%(percent*100)
 		print "          Speedup: %lf"%(speedup)
 	else:
 		print "%lf"%(speedup)
+
+	return True
+#}}}
+
+def check_timer_history(timer_name, directory, history_file, sigma, window, min_samples, min_change):#{{{
+	# Check one timer of a run directory against the performance history.
+	# Returns False if the timer is a regression.
+	timer_found, timer = get_timer_total(directory, timer_name)
+	if not timer_found:
+		return True
+
+	stats = check_timer(history_file, directory, timer_name, timer, sigma, window, min_samples, min_change)
+	if stats is None:
+		print "Timer %s in %s has too little history to check for regressions."%(timer_name, directory)
+		return True
+
+	if sigma is None:
+		print "Timer %s in %s compared to its history:"%(timer_name, directory)
+	elif stats['regression']:
+		print " ** FAIL Timer %s in %s regressed:"%(timer_name, directory)
+	else:
+		print "    PASS Timer %s in %s is within its history:"%(timer_name, directory)
+	print "          Current: %lf"%(timer)
+	print "     History Mean: %lf"%(stats['mean'])
+	print "      History Std: %lf (%d runs)"%(stats['std'], stats['samples'])
+	return not stats['regression']
+#}}}
+
+if __name__ == "__main__":
+	# Define and process input arguments
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+	parser.add_argument('-b', '--base_directory', dest="base_directory", help="Directory with the baseline timer information.")
+	parser.add_argument('-c', '--comparison_directory', dest="comparison_directory", help="Directory with the comparison timer information.")
+	parser.add_argument('-t', '--timer', dest="timers", help="Name of the timer to compare. Can be given more than once.", required=True, action="append")
+	parser.add_argument('-s', '--speedup', dest="speedup", help="If set, only speedup will be printed. This is useful when making speedup plots.", action="store_true")
+	parser.add_argument('-r', '--check_directory', dest="check_directories", help="Run directory whose timers are checked against the performance history. Can be given more than once.", action="append", default=[])
+	parser.add_argument('--history', dest="history", help="Performance history file to check timers against.", default=os.environ.get('COMPASS_PERF_HISTORY'))
+	parser.add_argument('--sigma', dest="sigma", type=float, help="Number of standard deviations above the history mean at which a timer is a regression.", default=os.environ.get('COMPASS_PERF_SIGMA'))
+	parser.add_argument('--window', dest="window", type=int, help="Number of recent runs in the history to compare to.", default=default_window)
+	parser.add_argument('--min_samples', dest="min_samples", type=int, help="Minimum number of runs in the history needed to check a timer.", default=default_min_samples)
+	parser.add_argument('--min_change', dest="min_change", type=float, help="Minimum fractional slowdown relative to the history mean for a timer to be a regression.", default=default_min_change)
+
+	args = parser.parse_args()
+
+	if (args.base_directory is None) != (args.comparison_directory is None):
+		parser.error("The base (-b) and comparison (-c) directories must be given together.")
+
+	if args.base_directory is None and not args.check_directories:
+		parser.error("Either directories to compare (-b and -c) or to check against the history (-r) are required.")
+
+	if args.base_directory is not None:
+		for timer_name in args.timers:
+			compare_timer(timer_name, args.base_directory, args.comparison_directory, args.speedup)
+
+	regression = False
+	if args.sigma is not None:
+		args.sigma = float(args.sigma)
+
+	if args.history:
+		for directory in args.check_directories:
+			for timer_name in args.timers:
+				if not check_timer_history(timer_name, directory, args.history, args.sigma, args.window, args.min_samples, args.min_change):
+					regression = True
+
+	if regression:
+		sys.exit(1)
+	else:
+		sys.exit(0)
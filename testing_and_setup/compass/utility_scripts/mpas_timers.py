@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+This module reads the timer tables written by MPAS into the log files of a
+run directory, using either the native MPAS timers (log.*.out) or GPTL
+(timing.*).
+
+The timers are read into a list of dictionaries, in the order they are
+printed (depth first), with the following keys:
+    * name: The name of the timer.
+    * path: The names of the timer and its parents, joined by '/'
+            (e.g. 'total time/time integration').
+    * parent: The index of the parent timer in the list, or None.
+    * level: The nesting level of the timer, starting at 1.
+    * calls: The number of times the timer was started and stopped.
+    * total: The total time spent in the timer (the max across ranks for
+             native timers).
+    * min, max, avg: The min, max and average time spent in a single call
+                     (native timers), or the min and max across threads and
+                     ranks (GPTL). None if not available.
+
+The parsed timers of each run directory are cached in a JSON file
+(.mpas_timers.json) in that directory, which is used until any of the files
+it was read from change, so a run directory is only parsed once no matter how
+many timers are compared.
+"""
+
+import os
+import re
+import json
+import fnmatch
+
+cache_file_name = '.mpas_timers.json'
+cache_version = 1
+
+# Timers that have already been read, keyed by absolute directory path.
+directory_timers = dict()
+
+# Columns of a native timer line, written by mpas_timer_write with the format
+# (i2, 1x, a45, f15.5, i10, 3f15.5, 1x, f8.2, 3x, f8.2, 3x, f8.2)
+native_columns = [('level', 0, 2), ('name', 3, 48), ('total', 48, 63),
+                  ('calls', 63, 73), ('min', 73, 88), ('max', 88, 103),
+                  ('avg', 103, 118)]
+
+# A GPTL timer line: an optional '*' (for timers with multiple parents), the
+# indented name, then the calls, recursion, wallclock, max and min columns.
+gptl_regex = re.compile(r'^(?P<marker>\*?)(?P<indent> *)(?P<name>\S.*?)\s+'
+                        r'(?P<calls>\d+)\s+(?P<recurse>-|\d+)\s+'
+                        r'(?P<total>[-+.\deE]+)\s+(?P<max>[-+.\deE]+)\s+'
+                        r'(?P<min>[-+.\deE]+)(\s|$)')
+
+
+def add_timer(timers, parents, name, level, values):  # {{{
+    # Add a timer at the given level, whose parent is the last timer added one
+    # level up.
+    del parents[level - 1:]
+    if parents:
+        parent = parents[-1]
+        path = '{}/{}'.format(timers[parent]['path'], name)
+    else:
+        parent = None
+        path = name
+
+    timer = {'name': name, 'path': path, 'parent': parent, 'level': level,
+             'calls': None, 'total': None, 'min': None, 'max': None,
+             'avg': None}
+    timer.update(values)
+    parents.append(len(timers))
+    timers.append(timer)
+# }}}
+
+
+def parse_native_timers(filename):  # {{{
+    # Read the timer table from a log file written with native MPAS timers.
+    timers = list()
+    parents = list()
+    with open(filename, 'r') as log_file:
+        for line in log_file:
+            line = line.rstrip('\n')
+            if len(line) < native_columns[-1][2]:
+                continue
+
+            try:
+                values = dict()
+                for key, start, end in native_columns:
+                    values[key] = line[start:end]
+                level = int(values.pop('level'))
+                name = values.pop('name').strip()
+                values['calls'] = int(values['calls'])
+                for key in ['total', 'min', 'max', 'avg']:
+                    values[key] = float(values[key])
+            except ValueError:
+                continue
+
+            if level < 1 or name == '' or level > len(parents) + 1:
+                continue
+
+            add_timer(timers, parents, name, level, values)
+
+    return timers
+# }}}
+
+
+def parse_gptl_timers(filename):  # {{{
+    # Read the timers of the first thread from a GPTL timing file. Nesting is
+    # given by the indentation of the names.
+    timers = list()
+    parents = list()
+    indents = list()
+    with open(filename, 'r') as timing_file:
+        for line in timing_file:
+            # Stop at the end of the table for the first thread
+            if timers and (line.startswith('Stats for thread') or
+                           line.strip() == ''):
+                break
+
+            match = gptl_regex.match(line)
+            if match is None:
+                continue
+
+            # Indentation increases by a fixed amount per level.
+            indent = len(match.group('marker')) + len(match.group('indent'))
+            while indents and indent <= indents[-1]:
+                indents.pop()
+            indents.append(indent)
+            level = len(indents)
+            if level > len(parents) + 1:
+                continue
+
+            values = {'calls': int(match.group('calls')),
+                      'total': float(match.group('total')),
+                      'max': float(match.group('max')),
+                      'min': float(match.group('min'))}
+            add_timer(timers, parents, match.group('name'), level, values)
+
+    return timers
+# }}}
+
+
+def get_timer_files(directory):  # {{{
+    # The files in directory that may contain timers, native ones first.
+    files = sorted(os.listdir(directory))
+    native_files = [name for name in files
+                    if fnmatch.fnmatch(name, 'log.*.out')]
+    gptl_files = [name for name in files if fnmatch.fnmatch(name, 'timing.*')]
+    return native_files, gptl_files
+# }}}
+
+
+def get_file_stats(directory, names):  # {{{
+    stats = dict()
+    for name in names:
+        stat = os.stat('{}/{}'.format(directory, name))
+        stats[name] = [stat.st_size, stat.st_mtime]
+    return stats
+# }}}
+
+
+def parse_timers(directory):  # {{{
+    # Parse the timers of the first file in directory that has any.
+    native_files, gptl_files = get_timer_files(directory)
+    for name in native_files:
+        timers = parse_native_timers('{}/{}'.format(directory, name))
+        if timers:
+            return timers
+    for name in gptl_files:
+        timers = parse_gptl_timers('{}/{}'.format(directory, name))
+        if timers:
+            return timers
+    return list()
+# }}}
+
+
+def read_cache(cache_path):  # {{{
+    try:
+        with open(cache_path, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        return None
+
+    if not isinstance(cache, dict) or \
+            cache.get('version') != cache_version:
+        return None
+
+    # Convert unicode strings back to plain strings
+    for timer in cache['timers']:
+        timer['name'] = str(timer['name'])
+        timer['path'] = str(timer['path'])
+    return cache
+# }}}
+
+
+def write_cache(cache, cache_path):  # {{{
+    # Write to a temporary file first and move it into place, so other
+    # processes never see a partially written cache. The cache is optional,
+    # so failing to write it (e.g. in a read-only baseline) is not an error.
+    temp_path = '{}.{:d}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(temp_path, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+# }}}
+
+
+def read_timers(directory):  # {{{
+    # Return the list of timers in directory, parsing its log files only if
+    # they have changed since the timers were cached.
+    directory = os.path.abspath(directory)
+    if directory in directory_timers:
+        return directory_timers[directory]
+
+    native_files, gptl_files = get_timer_files(directory)
+    sources = get_file_stats(directory, native_files + gptl_files)
+
+    cache_path = '{}/{}'.format(directory, cache_file_name)
+    cache = read_cache(cache_path)
+    if cache is None or cache['sources'] != sources:
+        cache = {'version': cache_version,
+                 'sources': sources,
+                 'timers': parse_timers(directory)}
+        write_cache(cache, cache_path)
+
+    directory_timers[directory] = cache['timers']
+    return cache['timers']
+# }}}
+
+
+def find_timers(timers, name):  # {{{
+    # Return the timers whose name or path is exactly name. A timer nested
+    # within another matching timer is not included, so its time isn't
+    # counted twice.
+    matches = list()
+    matched = set()
+    for index, timer in enumerate(timers):
+        if timer['name'] != name and timer['path'] != name:
+            continue
+        parent = timer['parent']
+        while parent is not None and parent not in matched:
+            parent = timers[parent]['parent']
+        if parent is None:
+            matched.add(index)
+            matches.append(timer)
+    return matches
+# }}}
+
+
+def get_timer_total(directory, name):  # {{{
+    # Return whether the timer was found in directory, and its total time,
+    # summed over all of the places it was called from.
+    matches = find_timers(read_timers(directory), name)
+    total = sum([timer['total'] for timer in matches])
+    return len(matches) > 0, total
+# }}}
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
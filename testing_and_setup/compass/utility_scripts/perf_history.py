@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""
+This module keeps a history of the performance of regression suite runs in a
+sqlite database, and detects performance regressions against it.
+
+Each time a regression suite script is run with a performance history file,
+it records the git version, the wall time, procs, threads and cores of each
+test, and the timers of each run directory within the tests (see
+mpas_timers.py).
+
+Run directories are identified by their last five path components
+(core/configuration/resolution/test/case), so runs of a suite in different
+work directories share their history.
+
+A timer is a regression if its total time is more than a number of standard
+deviations (sigma) above the mean of its most recent recorded runs, and also
+more than a minimum fraction above that mean, so timers that barely vary
+aren't flagged for insignificant changes.
+
+When run as a script, this prints a report of the trends of the timers and
+wall times in a history file.
+"""
+
+import os
+import re
+import sys
+import time
+import math
+import socket
+import sqlite3
+import argparse
+
+from mpas_timers import get_timer_files, read_timers
+
+default_window = 10
+default_min_samples = 3
+default_min_change = 0.05
+
+# Pseudo timer name used for the wall time of a whole test.
+wall_time_name = 'wall time'
+
+schema = """
+create table if not exists runs (
+    id integer primary key,
+    suite text,
+    time real,
+    git_version text,
+    host text);
+create table if not exists tests (
+    run integer,
+    test text,
+    path text,
+    success integer,
+    wall_time real,
+    procs integer,
+    threads integer,
+    cores integer);
+create table if not exists timers (
+    run integer,
+    key text,
+    name text,
+    path text,
+    calls integer,
+    total real);
+create index if not exists timers_key on timers (key, name);
+create index if not exists timers_key_path on timers (key, path);
+"""
+
+
+def open_history(history_file):  # {{{
+    connection = sqlite3.connect(history_file, timeout=60)
+    connection.executescript(schema)
+    return connection
+# }}}
+
+
+def get_run_key(directory):  # {{{
+    # The key of a run directory is its last five path components, i.e.
+    # core/configuration/resolution/test/case.
+    path = os.path.realpath(directory)
+    return '/'.join(path.split(os.sep)[-5:])
+# }}}
+
+
+def get_run_directories(test_path):  # {{{
+    # Find all directories within a test that contain timer output.
+    directories = list()
+    for directory, subdirectories, files in os.walk(test_path):
+        subdirectories.sort()
+        native_files, gptl_files = get_timer_files(directory)
+        if native_files or gptl_files:
+            directories.append(directory)
+    return directories
+# }}}
+
+
+def record_run(history_file, suite, git_version, base_path, tests,
+               results):  # {{{
+    # Record a run of a regression suite. tests is the list of tests of the
+    # suite (see suite_runner.py), and results maps the name of each test to
+    # a dictionary with whether it succeeded and its wall time.
+    connection = open_history(history_file)
+    try:
+        with connection:
+            cursor = connection.execute(
+                'insert into runs (suite, time, git_version, host) '
+                'values (?, ?, ?, ?)',
+                (suite, time.time(), git_version, socket.gethostname()))
+            run = cursor.lastrowid
+
+            for test in tests:
+                if test['name'] not in results:
+                    continue
+                result = results[test['name']]
+                connection.execute(
+                    'insert into tests values (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (run, test['name'], test['path'], int(result['success']),
+                     result['wall_time'], test.get('procs'),
+                     test.get('threads'), test['cores']))
+
+                # Only the timers of successful tests are representative.
+                if not result['success']:
+                    continue
+
+                connection.execute(
+                    'insert into timers values (?, ?, ?, ?, ?, ?)',
+                    (run, test['path'], wall_time_name, wall_time_name, 1,
+                     result['wall_time']))
+
+                test_path = '{}/{}'.format(base_path, test['path'])
+                for directory in get_run_directories(test_path):
+                    key = get_run_key(directory)
+                    for timer in read_timers(directory):
+                        connection.execute(
+                            'insert into timers values (?, ?, ?, ?, ?, ?)',
+                            (run, key, timer['name'], timer['path'],
+                             timer['calls'], timer['total']))
+    finally:
+        connection.close()
+# }}}
+
+
+def sum_matching_timers(rows, name):  # {{{
+    # Sum the totals of timers (given as (path, total) pairs from one run)
+    # whose name or path is name, skipping timers nested in another match,
+    # as in mpas_timers.find_timers.
+    matched_paths = [path for path, total in rows]
+    total = 0.0
+    for path, timer_total in rows:
+        nested = False
+        for other in matched_paths:
+            if path.startswith('{}/'.format(other)):
+                nested = True
+        if not nested:
+            total += timer_total
+    return total
+# }}}
+
+
+def get_timer_history(connection, key, name, window=default_window):  # {{{
+    # Return the totals of a timer in the most recent window runs in which it
+    # was recorded, oldest first.
+    rows = connection.execute(
+        'select run, path, total from timers where key = ? and '
+        '(name = ? or path = ?) order by run', (key, name, name)).fetchall()
+
+    runs = list()
+    run_rows = dict()
+    for run, path, total in rows:
+        if run not in run_rows:
+            runs.append(run)
+            run_rows[run] = list()
+        run_rows[run].append((path, total))
+
+    runs = runs[-window:]
+    return [sum_matching_timers(run_rows[run], name) for run in runs]
+# }}}
+
+
+def get_test_runtimes(history_file, window=default_window):  # {{{
+    # Return the mean wall time of each test (keyed by its path) over its
+    # most recent window successful runs.
+    connection = open_history(history_file)
+    try:
+        rows = connection.execute(
+            'select path, wall_time from tests where success = 1 '
+            'order by run').fetchall()
+    finally:
+        connection.close()
+
+    wall_times = dict()
+    for path, wall_time in rows:
+        wall_times.setdefault(path, list()).append(wall_time)
+
+    runtimes = dict()
+    for path in wall_times:
+        values = wall_times[path][-window:]
+        runtimes[path] = sum(values) / len(values)
+    return runtimes
+# }}}
+
+
+def get_statistics(values):  # {{{
+    mean = sum(values) / len(values)
+    variance = sum([(value - mean)**2 for value in values]) / len(values)
+    return mean, math.sqrt(variance)
+# }}}
+
+
+def check_timer(history_file, directory, name, value, sigma,
+                window=default_window, min_samples=default_min_samples,
+                min_change=default_min_change):  # {{{
+    # Check a timer total from a run directory against its history. Returns
+    # None if there isn't enough history, and otherwise a dictionary with
+    # the mean and standard deviation of the history, the number of samples
+    # and whether the timer is a regression (never, if sigma is None).
+    if not os.path.exists(history_file):
+        return None
+
+    connection = open_history(history_file)
+    try:
+        values = get_timer_history(connection, get_run_key(directory), name,
+                                   window)
+    finally:
+        connection.close()
+
+    if len(values) < min_samples:
+        return None
+
+    mean, std = get_statistics(values)
+    regression = sigma is not None and value > mean + sigma * std and \
+        value > mean * (1.0 + min_change)
+    return {'mean': mean, 'std': std, 'samples': len(values),
+            'regression': regression}
+# }}}
+
+
+def print_report(history_file, key_pattern=None, timer_pattern=None,
+                 window=default_window):  # {{{
+    # Print the trend of each timer: the latest value, and the mean and
+    # standard deviation of the window runs before it.
+    connection = open_history(history_file)
+    try:
+        runs = connection.execute(
+            'select id, time, git_version from runs order by id').fetchall()
+        series = connection.execute(
+            'select distinct key, name from timers order by key, name'
+        ).fetchall()
+
+        if not runs:
+            print 'No runs have been recorded in {}'.format(history_file)
+            return
+
+        first = runs[0]
+        last = runs[-1]
+        print 'Performance history of {} runs, from {} ({}) to {} ' \
+              '({})'.format(len(runs), time.ctime(first[1]), first[2],
+                            time.ctime(last[1]), last[2])
+        print ''
+        print '{:>12s} {:>12s} {:>12s} {:>8s} {:>5s}  {}'.format(
+            'latest', 'mean', 'std', 'change', 'runs', 'timer')
+
+        current_key = None
+        for key, name in series:
+            if key_pattern is not None and not re.search(key_pattern, key):
+                continue
+            if timer_pattern is not None and \
+                    not re.search(timer_pattern, name):
+                continue
+
+            values = get_timer_history(connection, key, name, window + 1)
+            if key != current_key:
+                print key
+                current_key = key
+
+            latest = values[-1]
+            previous = values[:-1]
+            if previous:
+                mean, std = get_statistics(previous)
+                if mean != 0.0:
+                    change = '{:+7.1f}%'.format(100.0 * (latest - mean) / mean)
+                else:
+                    change = '{:>8s}'.format('-')
+                print '{:12.4f} {:12.4f} {:12.4f} {} {:5d}  {}'.format(
+                    latest, mean, std, change, len(values), name)
+            else:
+                print '{:12.4f} {:>12s} {:>12s} {:>8s} {:5d}  {}'.format(
+                    latest, '-', '-', '-', len(values), name)
+    finally:
+        connection.close()
+# }}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-f", "--history_file", dest="history_file",
+                        help="Performance history file to report on.",
+                        metavar="FILE", required=True)
+    parser.add_argument("-k", "--key", dest="key",
+                        help="Regular expression for the run directories "
+                             "(core/configuration/resolution/test/case) to "
+                             "report on.", metavar="REGEX")
+    parser.add_argument("-t", "--timer", dest="timer",
+                        help="Regular expression for the timers to report "
+                             "on.", metavar="REGEX")
+    parser.add_argument("-n", "--window", dest="window", type=int,
+                        default=default_window,
+                        help="Number of previous runs to compare the latest "
+                             "run to.", metavar="NUM")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.history_file):
+        print "ERROR: Performance history file {} does not exist.".format(
+            args.history_file)
+        print "Exiting..."
+        sys.exit(1)
+
+    print_report(args.history_file, args.key, args.timer, args.window)
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
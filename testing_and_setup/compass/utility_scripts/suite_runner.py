@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+"""
+This module runs the tests in a regression suite. It is imported by the
+regression suite scripts generated by manage_regression_suite.py.
+
+Each test is described by a dictionary with the following keys:
+    * name: The name of the test within the regression suite.
+    * case_output: The name of the file in case_outputs that the output of
+                   the test is written to.
+    * path: The path of the test, relative to the base of the suite.
+    * scripts: A list of scripts (relative to path) that perform the test.
+    * cores: The maximum number of cores the test uses at any one time.
+    * procs, threads: (optional) The maximum number of MPI tasks and OpenMP
+                      threads used by the test, which are recorded in the
+                      performance history.
+    * cost: (optional) The total number of MPI tasks launched by the test,
+            used to estimate its runtime if it has never been run.
+
+If a core budget is given, tests are run concurrently and packed into that
+budget. Otherwise, tests are run one after another, in the order they are
+given. When running concurrently, the longest tests are started first, so
+that a long test doesn't run on its own at the end of the suite. The runtime
+of each test is taken from the performance history if there is one, or else
+from the results of the previous run of the suite. Tests that have never
+been run are assumed to take as long per MPI task (see cost) as the tests
+that have.
+
+The wall time and user and system CPU time of each test are measured from its
+scripts' processes, including any processes they wait for (e.g. mpirun and the
+model). The peak memory of a test (max_process_rss) is the largest peak
+resident set size of any single one of these processes, not the total of the
+processes running at once, so for a test with many MPI tasks it is roughly the
+memory of one task. After the suite has run, a summary of the runtimes is
+printed, and the results of all tests are written to <suite>_results.json and,
+in JUnit XML format, to <suite>_junit.xml in the base of the suite.
+
+The state of each test (pending, running, passed or failed), with the times
+it started and finished, its case output and its results, is kept up to date
+in <suite>_state.json in the base of the suite while it runs. If the suite is
+run with resume, tests that passed in the previous run are not run again, so
+an interrupted suite only runs the tests that failed or didn't finish. With
+rerun_failed, only the tests that failed in the previous run are run again.
+
+If a performance history file is given, the wall time of each test and the
+timers of its runs are recorded in it after the suite has run (see
+perf_history.py). Timer comparisons in the tests check their timers against
+this history, and fail if a timer is more than perf_sigma standard deviations
+slower than its recent runs.
+"""
+
+import os
+import sys
+import json
+import time
+import math
+import socket
+import threading
+import subprocess
+import xml.etree.ElementTree as ET
+
+from task_scheduler import schedule_tasks
+from perf_history import record_run, get_test_runtimes
+
+
+def run_script(command, cwd, output):  # {{{
+    # Run a script and return its exit code, wall time and resource usage.
+    # The CPU times from wait4 are totals over all descendants of the script
+    # that were waited for, but ru_maxrss is the peak of the largest one.
+    start_time = time.time()
+    process = subprocess.Popen(command, cwd=cwd, stdout=output,
+                               stderr=output)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.time() - start_time
+
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    # The process has been reaped, so Popen must not wait for it.
+    process.returncode = returncode
+
+    # ru_maxrss is in kilobytes, except on macOS where it is in bytes.
+    max_process_rss = usage.ru_maxrss / 1024.0
+    if sys.platform == 'darwin':
+        max_process_rss /= 1024.0
+
+    return {'returncode': returncode,
+            'wall_time': wall_time,
+            'user_time': usage.ru_utime,
+            'sys_time': usage.ru_stime,
+            'max_process_rss': max_process_rss}
+# }}}
+
+
+def read_state(state_file):  # {{{
+    # Return the state of each test from a previous run of the suite, keyed
+    # by test name.
+    try:
+        with open(state_file, 'r') as json_file:
+            return json.load(json_file)['tests']
+    except (IOError, ValueError, KeyError):
+        return dict()
+# }}}
+
+
+def write_state(state):  # {{{
+    # Write to a temporary file first and move it into place, so the state
+    # file is complete even if the suite is killed while writing it.
+    temp_file = '{}.tmp'.format(state['file'])
+    with open(temp_file, 'w') as json_file:
+        json.dump({'tests': state['tests']}, json_file, indent=4,
+                  sort_keys=True)
+    os.rename(temp_file, state['file'])
+# }}}
+
+
+def update_test_state(state, test, status, result=None):  # {{{
+    # Record a change in the state of a test. Tests run concurrently, so the
+    # state is updated under a lock.
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    with state['lock']:
+        entry = {'state': status,
+                 'case_output': 'case_outputs/{}'.format(
+                     test['case_output']),
+                 'start_time': None,
+                 'end_time': None,
+                 'result': result}
+        if status == 'running':
+            entry['start_time'] = now
+        elif status in ['passed', 'failed']:
+            entry['start_time'] = state['tests'][test['name']]['start_time']
+            entry['end_time'] = now
+        state['tests'][test['name']] = entry
+        write_state(state)
+# }}}
+
+
+def run_test(base_path, test, results, state):  # {{{
+    test_path = '{}/{}'.format(base_path, test['path'])
+    output_path = '{}/case_outputs/{}'.format(base_path, test['case_output'])
+
+    print ' ** Running case {}'.format(test['name'])
+    update_test_state(state, test, 'running')
+
+    start_time = time.time()
+    result = {'success': True, 'wall_time': 0.0, 'user_time': 0.0,
+              'sys_time': 0.0, 'max_process_rss': 0.0, 'scripts': list()}
+    case_output = open(output_path, 'w')
+    for script_name in test['scripts']:
+        try:
+            usage = run_script(['{}/{}'.format(test_path, script_name)],
+                               test_path, case_output)
+        except OSError as error:
+            case_output.write('ERROR: Could not run {}: {}\n'.format(
+                script_name, error))
+            usage = {'returncode': None, 'wall_time': 0.0, 'user_time': 0.0,
+                     'sys_time': 0.0, 'max_process_rss': 0.0}
+        usage['name'] = script_name
+        result['scripts'].append(usage)
+
+        if usage['returncode'] != 0:
+            result['success'] = False
+        result['user_time'] += usage['user_time']
+        result['sys_time'] += usage['sys_time']
+        result['max_process_rss'] = max(result['max_process_rss'],
+                                        usage['max_process_rss'])
+    case_output.close()
+    result['wall_time'] = time.time() - start_time
+    results[test['name']] = result
+
+    success = result['success']
+    if success:
+        update_test_state(state, test, 'passed', result)
+    else:
+        update_test_state(state, test, 'failed', result)
+
+    if success:
+        print '      PASS {}'.format(test['name'])
+    else:
+        print '   ** FAIL {} (See case_outputs/{} for more ' \
+              'information)'.format(test['name'], test['case_output'])
+    return success
+# }}}
+
+
+def read_previous_runtimes(results_file):  # {{{
+    # Return the wall time of each test that succeeded in a previous run of
+    # the suite, keyed by the test's path.
+    try:
+        with open(results_file, 'r') as json_file:
+            suite = json.load(json_file)
+    except (IOError, ValueError):
+        return dict()
+
+    runtimes = dict()
+    for test in suite['tests']:
+        result = test['result']
+        if result is not None and result['success']:
+            runtimes[str(test['path'])] = result['wall_time']
+    return runtimes
+# }}}
+
+
+def order_tests(tests, runtimes):  # {{{
+    # Order tests longest first, by their runtimes (keyed by path), or by an
+    # estimate from their cost if they have no runtime. Tests with the same
+    # runtime keep their order.
+    known_time = 0.0
+    known_cost = 0
+    for test in tests:
+        if test['path'] in runtimes:
+            known_time += runtimes[test['path']]
+            known_cost += test.get('cost', 1)
+
+    if known_cost > 0:
+        time_per_cost = known_time / known_cost
+    else:
+        time_per_cost = 1.0
+
+    def get_runtime(test):
+        if test['path'] in runtimes:
+            return runtimes[test['path']]
+        return test.get('cost', 1) * time_per_cost
+
+    return sorted(tests, key=lambda test: -get_runtime(test))
+# }}}
+
+
+def run_suite(base_path, tests, max_cores=None, suite_name=None,
+              git_version=None, perf_history=None, perf_sigma=None,
+              resume=False, rerun_failed=False):  # {{{
+    # Run all tests in the suite, and return True if any of them failed or
+    # were not run.
+    if not os.path.exists('{}/case_outputs'.format(base_path)):
+        os.makedirs('{}/case_outputs'.format(base_path))
+
+    results_name = '{}/{}'.format(base_path, suite_name)
+
+    # Determine which tests to run, keeping the state and results of those
+    # that aren't run again.
+    state = {'file': '{}_state.json'.format(results_name),
+             'lock': threading.Lock(),
+             'tests': dict()}
+    previous_state = dict()
+    if resume or rerun_failed:
+        previous_state = read_state(state['file'])
+        if not previous_state:
+            print 'WARNING: No state from a previous run was found in {}. ' \
+                  'Running all tests.'.format(state['file'])
+
+    run_tests = list()
+    previous_results = dict()
+    for test in tests:
+        entry = previous_state.get(test['name'])
+        if entry is None:
+            run = not (rerun_failed and previous_state)
+        elif rerun_failed:
+            run = entry['state'] == 'failed'
+        else:
+            run = entry['state'] != 'passed'
+
+        if run:
+            run_tests.append(test)
+            state['tests'][test['name']] = {
+                'state': 'pending',
+                'case_output': 'case_outputs/{}'.format(test['case_output']),
+                'start_time': None,
+                'end_time': None,
+                'result': None}
+        else:
+            if entry is not None:
+                state['tests'][test['name']] = entry
+                if entry['result'] is not None:
+                    previous_results[test['name']] = entry['result']
+            if rerun_failed:
+                print ' ** Skipping case {}, which did not fail in the ' \
+                      'previous run'.format(test['name'])
+            else:
+                print ' ** Skipping case {}, which passed in the previous ' \
+                      'run'.format(test['name'])
+    write_state(state)
+
+    if max_cores is not None:
+        print 'Running tests concurrently on at most {:d} ' \
+              'cores'.format(max_cores)
+        for test in tests:
+            if test['cores'] > max_cores:
+                print 'WARNING: Test {} needs {:d} cores, which is more ' \
+                      'than the budget. It will run on its own.'.format(
+                          test['name'], test['cores'])
+
+    # The timer comparisons in the tests' driver scripts find the history
+    # through the environment.
+    if perf_history:
+        perf_history = os.path.abspath(perf_history)
+        os.environ['COMPASS_PERF_HISTORY'] = perf_history
+        if perf_sigma is not None:
+            os.environ['COMPASS_PERF_SIGMA'] = '{}'.format(perf_sigma)
+
+    run_order = run_tests
+    if max_cores is not None and run_tests:
+        runtimes = read_previous_runtimes(
+            '{}_results.json'.format(results_name))
+        if perf_history and os.path.exists(perf_history):
+            runtimes.update(get_test_runtimes(perf_history))
+        run_order = order_tests(run_tests, runtimes)
+        print 'Running tests longest first, with runtimes of {:d} of {:d} ' \
+              'tests from previous runs'.format(
+                  len([test for test in run_tests
+                       if test['path'] in runtimes]),
+                  len(run_tests))
+
+    test_results = dict()
+    tasks = list()
+    for test in run_order:
+        tasks.append({'name': test['name'],
+                      'cores': test['cores'],
+                      'run': lambda test=test: run_test(base_path, test,
+                                                        test_results, state)})
+
+    start_time = time.time()
+    schedule_tasks(tasks, max_cores)
+    wall_time = time.time() - start_time
+
+    # Report on the whole suite, including the results of tests that passed
+    # in a previous run.
+    all_results = dict(previous_results)
+    all_results.update(test_results)
+
+    print_runtimes(tests, all_results)
+
+    write_json_results('{}_results.json'.format(results_name), suite_name,
+                       git_version, wall_time, tests, all_results)
+    write_junit_results('{}_junit.xml'.format(results_name), suite_name,
+                        wall_time, tests, all_results)
+
+    if perf_history:
+        print 'Recording performance history in {}'.format(perf_history)
+        record_run(perf_history, suite_name, git_version, base_path, tests,
+                   test_results)
+
+    return not all([state['tests'].get(test['name'], {}).get('state') ==
+                    'passed' for test in tests])
+# }}}
+
+
+def format_runtime(runtime):  # {{{
+    # Format a runtime in seconds as mm:ss, rounding up.
+    runtime = math.ceil(runtime)
+    mins = int(math.floor(runtime / 60.0))
+    secs = int(math.ceil(runtime - mins * 60))
+    return '{:02d}:{:02d}'.format(mins, secs)
+# }}}
+
+
+def print_runtimes(tests, results):  # {{{
+    print 'TEST RUNTIMES:'
+    total_time = 0.0
+    for test in sorted(tests, key=lambda test: test['case_output']):
+        if test['name'] not in results:
+            continue
+        result = results[test['name']]
+        total_time += math.ceil(result['wall_time'])
+        print '{} {} (cpu: {:.1f} s, peak memory of largest process: ' \
+              '{:.1f} MB)'.format(
+                  format_runtime(result['wall_time']), test['case_output'],
+                  result['user_time'] + result['sys_time'],
+                  result['max_process_rss'])
+    print 'Total runtime {}'.format(format_runtime(total_time))
+# }}}
+
+
+def write_json_results(file_name, suite_name, git_version, wall_time, tests,
+                       results):  # {{{
+    # Tests that were not run (because the suite was interrupted) have no
+    # result.
+    test_list = list()
+    for test in tests:
+        entry = {'name': test['name'],
+                 'path': test['path'],
+                 'case_output': 'case_outputs/{}'.format(test['case_output']),
+                 'cores': test['cores'],
+                 'procs': test.get('procs'),
+                 'threads': test.get('threads'),
+                 'result': None}
+        if test['name'] in results:
+            entry['result'] = results[test['name']]
+        test_list.append(entry)
+
+    suite = {'suite': suite_name,
+             'git_version': git_version,
+             'host': socket.gethostname(),
+             'time': time.time(),
+             'wall_time': wall_time,
+             'tests': test_list}
+    with open(file_name, 'w') as results_file:
+        json.dump(suite, results_file, indent=4, sort_keys=True)
+# }}}
+
+
+def write_junit_results(file_name, suite_name, wall_time, tests,
+                        results):  # {{{
+    failures = [test for test in tests if test['name'] in results and
+                not results[test['name']]['success']]
+    skipped = [test for test in tests if test['name'] not in results]
+
+    suite = ET.Element('testsuite',
+                       {'name': '{}'.format(suite_name),
+                        'tests': '{:d}'.format(len(tests)),
+                        'failures': '{:d}'.format(len(failures)),
+                        'errors': '0',
+                        'skipped': '{:d}'.format(len(skipped)),
+                        'time': '{:.3f}'.format(wall_time),
+                        'hostname': socket.gethostname()})
+
+    for test in tests:
+        case = ET.SubElement(suite, 'testcase',
+                             {'classname': '{}'.format(suite_name),
+                              'name': test['name']})
+        if test['name'] not in results:
+            ET.SubElement(case, 'skipped')
+            continue
+
+        result = results[test['name']]
+        case.set('time', '{:.3f}'.format(result['wall_time']))
+        properties = ET.SubElement(case, 'properties')
+        for key in ['user_time', 'sys_time', 'max_process_rss']:
+            ET.SubElement(properties, 'property',
+                          {'name': key, 'value': '{}'.format(result[key])})
+        for key in ['cores', 'procs', 'threads']:
+            if test.get(key) is not None:
+                ET.SubElement(properties, 'property',
+                              {'name': key,
+                               'value': '{}'.format(test[key])})
+
+        if not result['success']:
+            failure = ET.SubElement(
+                case, 'failure',
+                {'message': 'See case_outputs/{} for more '
+                            'information'.format(test['case_output'])})
+            messages = list()
+            for script in result['scripts']:
+                if script['returncode'] is None:
+                    messages.append('{} could not be run'.format(
+                        script['name']))
+                elif script['returncode'] != 0:
+                    messages.append('{} exited with {:d}'.format(
+                        script['name'], script['returncode']))
+            failure.text = ', '.join(messages)
+
+    ET.ElementTree(suite).write(file_name, encoding='UTF-8')
+# }}}
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+This module provides a simple scheduler that runs a set of tasks concurrently
+while packing them into a fixed budget of cores.
+
+Each task is a dictionary with the following keys:
+    * name: A unique name for the task.
+    * cores: The number of cores the task needs while it is running.
+    * depends: (optional) A list of task names that must succeed before this
+               task can start.
+    * run: A callable taking no arguments that performs the task, and returns
+           True if it succeeded and False otherwise.
+
+Tasks are started in the order they are given whenever their dependencies
+have succeeded and enough cores are free. A task that needs more cores than
+the budget is only started once nothing else is running. Tasks whose
+dependencies fail are skipped.
+
+This module is used by scripts generated by manage_regression_suite.py and
+setup_testcase.py.
+"""
+
+import sys
+import threading
+import traceback
+
+
+def run_task(task, results, cond):  # {{{
+    try:
+        success = bool(task['run']())
+    except Exception:
+        traceback.print_exc()
+        success = False
+
+    with cond:
+        results[task['name']] = success
+        cond.notify_all()
+# }}}
+
+
+def schedule_tasks(tasks, max_cores=None):  # {{{
+    # Returns a dictionary mapping each task name to True (succeeded), False
+    # (failed) or None (skipped because a dependency did not succeed).
+    results = dict()
+
+    # Without a core budget, run tasks one at a time in the order given.
+    if max_cores is None:
+        for task in tasks:
+            depends = task.get('depends', [])
+            if all([results.get(dep, True) for dep in depends]):
+                try:
+                    results[task['name']] = bool(task['run']())
+                except Exception:
+                    traceback.print_exc()
+                    results[task['name']] = False
+            else:
+                results[task['name']] = None
+        return results
+
+    names = set([task['name'] for task in tasks])
+    for task in tasks:
+        for dep in task.get('depends', []):
+            if dep not in names:
+                print "WARNING: Task '{}' depends on unknown task '{}', " \
+                      "which will be ignored.".format(task['name'], dep)
+
+    cond = threading.Condition()
+    pending = list(tasks)
+    running = dict()
+    used_cores = 0
+
+    with cond:
+        while pending or running:
+            # Release the cores of any tasks that have finished.
+            for name in running.keys():
+                if name in results:
+                    used_cores -= running.pop(name)
+
+            # Start every pending task that is ready and fits in the budget.
+            for task in list(pending):
+                depends = [dep for dep in task.get('depends', [])
+                           if dep in names]
+                if any([dep in results and not results[dep]
+                        for dep in depends]):
+                    pending.remove(task)
+                    results[task['name']] = None
+                    continue
+
+                if not all([dep in results for dep in depends]):
+                    continue
+
+                cores = max(1, int(task.get('cores', 1)))
+                if used_cores + cores > max_cores and running:
+                    continue
+
+                pending.remove(task)
+                running[task['name']] = cores
+                used_cores += cores
+                thread = threading.Thread(target=run_task,
+                                          args=(task, results, cond))
+                thread.daemon = True
+                thread.start()
+
+            if not running:
+                if pending:
+                    # Nothing is running, so the remaining tasks can never
+                    # start (e.g. they form a dependency cycle).
+                    for task in pending:
+                        print "ERROR: Task '{}' could not be scheduled. " \
+                              "Check its dependencies.".format(task['name'])
+                        results[task['name']] = None
+                    pending = list()
+                break
+
+            # Wake up periodically so keyboard interrupts are handled.
+            cond.wait(1.0)
+
+    sys.stdout.flush()
+    return results
+# }}}
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
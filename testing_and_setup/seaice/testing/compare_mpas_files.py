@@ -3,11 +3,96 @@
 import argparse
 from netCDF4 import Dataset
 import numpy as np
+import multiprocessing
 import os, sys
 
 #------------------------------------------------------------------
 
-def compare_files(filename1, filename2, logfile, variableNamesIgnore=[]):
+def get_chunks(shape, itemsize, bufferSize):
+
+    # slices along the first dimension reading at most about bufferSize bytes
+    # of each of two variables at a time
+    if (len(shape) == 0):
+        return [Ellipsis]
+
+    rowBytes = itemsize * int(np.prod(shape[1:]))
+    nRows = max(1, bufferSize // (2 * max(rowBytes, 1)))
+    return [slice(iRow, min(iRow + nRows, shape[0])) for iRow in range(0, shape[0], nRows)]
+
+#------------------------------------------------------------------
+
+def compare_variable(variable1, variable2, bufferSize=64*1024*1024):
+
+    # compare two variables of the same shape chunk by chunk, stopping at the
+    # first chunk that differs. Returns None if the variables are identical,
+    # or else a description of how they differ. Arrays are almost always bit
+    # for bit identical, so if the types are the same the raw bytes of each
+    # chunk are compared first, and the values are only compared if they
+    # differ. Variables of different types are compared by value.
+    sameType = (variable1.dtype == variable2.dtype)
+    itemsize = max(variable1.dtype.itemsize, variable2.dtype.itemsize)
+
+    for chunk in get_chunks(variable1.shape, itemsize, bufferSize):
+
+        if (sameType):
+            variable1.set_auto_maskandscale(False)
+            variable2.set_auto_maskandscale(False)
+            try:
+                identical = (np.asarray(variable1[chunk]).tostring() == np.asarray(variable2[chunk]).tostring())
+            finally:
+                variable1.set_auto_maskandscale(True)
+                variable2.set_auto_maskandscale(True)
+
+            if (identical):
+                continue
+
+        values1 = np.asarray(variable1[chunk])
+        values2 = np.asarray(variable2[chunk])
+
+        different = (values1 != values2)
+        if (not np.any(different)):
+            continue
+
+        # index of the first differing element in the whole variable
+        index = np.unravel_index(np.argmax(different), different.shape)
+        value1 = values1[index]
+        value2 = values2[index]
+        if (chunk is not Ellipsis):
+            index = (index[0] + chunk.start,) + tuple(index[1:])
+
+        return "first difference at index %s: %s v %s" %(tuple(index), value1, value2)
+
+    return None
+
+#------------------------------------------------------------------
+
+# files opened by each worker process of a parallel comparison
+workerFiles = {}
+
+def init_worker(filename1, filename2):
+
+    workerFiles["file1"] = Dataset(filename1, "r")
+    workerFiles["file2"] = Dataset(filename2, "r")
+
+#------------------------------------------------------------------
+
+def compare_variable_worker(arguments):
+
+    variableName, bufferSize = arguments
+
+    difference = compare_variable(workerFiles["file1"].variables[variableName], workerFiles["file2"].variables[variableName], bufferSize)
+
+    return variableName, difference
+
+#------------------------------------------------------------------
+
+def compare_files(filename1, filename2, logfile, variableNamesIgnore=[], firstDifferenceOnly=False, nProcesses=1, bufferSize=64*1024*1024):
+
+    # compare the dimensions and variables of two files. Variables are
+    # compared chunk by chunk, reading at most about bufferSize bytes of each
+    # at a time, and by nProcesses processes if more than one. If
+    # firstDifferenceOnly, the comparison stops at the first variable that
+    # differs.
 
     # init error numbers
     nErrorsNonArray = 0
@@ -89,14 +174,16 @@ def compare_files(filename1, filename2, logfile, variableNamesIgnore=[]):
             logfile.write("Variable dimension found in file 2 and not file 1: %s %s\n" %(variableName,dimensionName))
             nErrorsNonArray = nErrorsNonArray + 1
 
-    # check variable contents
-    for variableName in variablesNameIntersection:
+    # check variable shapes
+    variableNamesCompare = []
 
-        variableArray1 = file1.variables[variableName][:]
-        variableArray2 = file2.variables[variableName][:]
+    for variableName in sorted(variablesNameIntersection):
 
-        shape1 = np.shape(variableArray1)
-        shape2 = np.shape(variableArray2)
+        variable1 = file1.variables[variableName]
+        variable2 = file2.variables[variableName]
+
+        shape1 = variable1.shape
+        shape2 = variable2.shape
 
         rank1 = len(shape1)
         rank2 = len(shape2)
@@ -120,18 +207,45 @@ def compare_files(filename1, filename2, logfile, variableNamesIgnore=[]):
                     nErrorsNonArray = nErrorsNonArray + 1
                     arrayOK = False
 
-            if (arrayOK):
+            if (arrayOK and variableName not in variableNamesIgnore):
 
-                # compare array values
-                if (not np.array_equal(variableArray1,variableArray2) and variableName not in variableNamesIgnore):
+                variableNamesCompare.append(variableName)
 
-                    logfile.write("Arrays %s differ!\n" %(variableName))
+    # check variable contents
+    if (nProcesses > 1):
+
+        # the worker processes open the files themselves
+        file1.close()
+        file2.close()
+
+        pool = multiprocessing.Pool(nProcesses, init_worker, (filename1, filename2))
+        try:
+            for variableName, difference in pool.imap_unordered(compare_variable_worker, [(variableName, bufferSize) for variableName in variableNamesCompare]):
+                if (difference != None):
+                    logfile.write("Arrays %s differ! (%s)\n" %(variableName, difference))
                     nErrorsArray = nErrorsArray + 1
+                    if (firstDifferenceOnly):
+                        break
+        finally:
+            pool.terminate()
+            pool.join()
+
+    else:
+
+        for variableName in variableNamesCompare:
+            difference = compare_variable(file1.variables[variableName], file2.variables[variableName], bufferSize)
+            if (difference != None):
+                logfile.write("Arrays %s differ! (%s)\n" %(variableName, difference))
+                nErrorsArray = nErrorsArray + 1
+                if (firstDifferenceOnly):
+                    break
 
+        # close files
+        file1.close()
+        file2.close()
 
-    # close files
-    file1.close()
-    file2.close()
+    if (firstDifferenceOnly and nErrorsArray > 0):
+        logfile.write("Comparison stopped at the first differing array\n")
 
     # return error numbers
     return nErrorsArray, nErrorsNonArray
@@ -148,6 +262,8 @@ if __name__ == "__main__":
     parser.add_argument('-f1', help='First filename to compare.',             dest="filename1", required=True)
     parser.add_argument('-f2', help='Second filename to compare.',            dest="filename2", required=True)
     parser.add_argument('-i',  help='Text file of variable names to ignore.', dest="ignoreFile", default=None)
+    parser.add_argument('-n',  help='Number of processes comparing variables.', dest="nProcesses", type=int, default=1)
+    parser.add_argument('--first', help='Stop at the first differing array.', dest="firstDifferenceOnly", action='store_true')
 
     args = parser.parse_args()
 
@@ -158,9 +274,9 @@ if __name__ == "__main__":
         fileIgnoreList.close()
     variableNamesIgnore = [word.strip() for word in variableNamesIgnore]
 
-    logfile = open("log_test.txt")
+    logfile = open("log_test.txt","w")
 
-    nErrorsArray, nErrorsNonArray = compare_files(args.filename1, args.filename2, logfile, variableNamesIgnore)
+    nErrorsArray, nErrorsNonArray = compare_files(args.filename1, args.filename2, logfile, variableNamesIgnore, args.firstDifferenceOnly, args.nProcesses)
     print "Number of array errors:     ", nErrorsArray
     print "Number of non-array errors: ", nErrorsNonArray
 
@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 
-from testing_utils import colour_init, print_colour, final_summary
+from testing_utils import colour_init, print_colour, final_summary, init_run_cache
 import argparse
 import sys
 import os
 import xml.etree.ElementTree as ET
 import imp
+import threading
+import traceback
 
 # tests defined
 tests = [{"name":"regression"     , "needsBase":True,  "description":"Tests whether development and base MPAS models are bit reproducible."},
          {"name":"restartability" , "needsBase":False, "description":"Tests if restarting the model is bit reproducible."},
-         {"name":"parallelism"    , "needsBase":False, "description":"Tests whether different processor numbers is bit reproducible."}]
+         {"name":"parallelism"    , "needsBase":False, "description":"Tests whether different processor numbers is bit reproducible."},
+         {"name":"scaling"        , "needsBase":False, "description":"Measures strong scaling over a list of processor numbers, which must be bit reproducible."}]
 
 colour_init()
 
@@ -23,6 +26,7 @@ parser.add_argument("-t", "--testsuite",  required=False, dest="testSuite",
 parser.add_argument("-o", "--domainsdir", required=False, dest="domainsDir",                         help="Domains directory")
 parser.add_argument("-a", "--avail",      required=False, dest="avail",         action='store_true', help="Print available tests to stdout")
 parser.add_argument("-c", "--check",      required=False, dest="check",         action='store_true', help="Check that the testing system is working")
+parser.add_argument("-n", "--ncores",     required=False, dest="nCores",        type=int,            help="Number of cores that model runs can use concurrently")
 
 args = parser.parse_args()
 
@@ -78,6 +82,7 @@ else:
     if (not os.path.exists(domainsDir)):
         print "Requested domains directory does not exist"
         sys.exit()
+domainsDir = os.path.abspath(domainsDir)
 
 
 
@@ -85,6 +90,21 @@ else:
 nTests = 0
 nFails = 0
 
+# tests are run concurrently, and identical model runs are shared between them
+init_run_cache(args.nCores)
+
+testThreads = []
+testFailures = []
+
+def run_test(test_function, testArgs):
+
+    try:
+        failed = test_function(*testArgs)
+    except BaseException:
+        traceback.print_exc()
+        failed = 1
+    testFailures.append(failed)
+
 # load the testsuite xml document
 tree = ET.parse(testSuite)
 testsuite = tree.getroot()
@@ -92,6 +112,10 @@ testsuite = tree.getroot()
 print_colour("Testing MPAS-Seaice", "title")
 
 print "Test suite: ", testSuite
+if (args.nCores == None):
+    print "Model runs will be executed one at a time"
+else:
+    print "Model runs will be executed concurrently on up to %i cores" %(args.nCores)
 print
 
 # loop over configurations
@@ -123,12 +147,16 @@ for configuration in testsuite:
                     module = imp.load_source(testAvail["name"], os.path.dirname(os.path.abspath(__file__)) + "/tests/" + testAvail["name"]+".py")
                     test_function = getattr(module, testAvail["name"])
                     if (testAvail["needsBase"]):
-                        failed = test_function(mpasDevelopmentDir, mpasBaseDir, domainsDir, domain.get('name'), configuration.get('name'), options, args.check)
+                        testArgs = (mpasDevelopmentDir, mpasBaseDir, domainsDir, domain.get('name'), configuration.get('name'), options, args.check)
                     else:
-                        failed = test_function(mpasDevelopmentDir,              domainsDir, domain.get('name'), configuration.get('name'), options, args.check)
+                        testArgs = (mpasDevelopmentDir,              domainsDir, domain.get('name'), configuration.get('name'), options, args.check)
+
+                    testThread = threading.Thread(target=run_test, args=(test_function, testArgs))
+                    testThread.daemon = True
+                    testThread.start()
+                    testThreads.append(testThread)
 
                     nTests = nTests + 1
-                    nFails = nFails + failed
 
             # see if test wasnt available
             if (not foundTest):
@@ -137,6 +165,13 @@ for configuration in testsuite:
                 sys.exit()
 
 
+# wait for all tests to finish
+for testThread in testThreads:
+    while (testThread.is_alive()):
+        testThread.join(1.0)
+
+nFails = sum(testFailures)
+
 # print final summary of tests
 print_colour("Summary","title")
 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import os, shutil, sys
+import os, shutil, sys, threading, hashlib, json, traceback, glob
 
 #-------------------------------------------------------------------------
 
@@ -145,6 +145,86 @@ def final_summary(nTests, nFails):
         else:
             print("%i tests (%i passed, %i failed)" %(nTests, nPasses, nFails))
 
+#-------------------------------------------------------------------------
+# test options
+#-------------------------------------------------------------------------
+
+def get_option_int(options, name, default):
+
+    # integer test option from the testsuite xml file
+    if (name not in options.keys()):
+        return default
+
+    try:
+        return int(options[name])
+    except ValueError:
+        raise ValueError("Test option %s must be an integer, not %s" %(name, options[name]))
+
+#-------------------------------------------------------------------------
+
+def get_option_int_list(options, name, default):
+
+    # comma separated list of integers test option from the testsuite xml file
+    if (name not in options.keys()):
+        return default
+
+    try:
+        return [int(value) for value in options[name].split(",")]
+    except ValueError:
+        raise ValueError("Test option %s must be a comma separated list of integers, not %s" %(name, options[name]))
+
+#-------------------------------------------------------------------------
+
+def get_option_bool(options, name, default):
+
+    if (name not in options.keys()):
+        return default
+
+    return (options[name] == "True")
+
+#-------------------------------------------------------------------------
+
+def get_decomposition_changes(nBlocks):
+
+    # namelist changes to run with nBlocks blocks, distributed over the
+    # processors with the domain's block decomposition graph files
+    return {"config_block_decomp_file_prefix":'graphs/graph.info.eq.part.',
+            "config_number_of_blocks": nBlocks,
+            "config_explicit_proc_decomp": True,
+            "config_proc_decomp_file_prefix":'graphs/graph.info.eq_block.part.'}
+
+#-------------------------------------------------------------------------
+# timers
+#-------------------------------------------------------------------------
+
+def read_timers(runDir):
+
+    # read the total time of each timer from the native MPAS timer table in
+    # the log file of the first processor, written with the format
+    # (i2, 1x, a45, f15.5, ...). Timers called from more than one place keep
+    # their first (outermost) time.
+    timers = {}
+
+    logFilenames = sorted(glob.glob(runDir + "/log.*.0000.out"))
+    if (len(logFilenames) == 0):
+        return timers
+
+    logFile = open(logFilenames[0],"r")
+    for line in logFile:
+        if (len(line) < 63):
+            continue
+        try:
+            level = int(line[0:2])
+            name  = line[3:48].strip()
+            total = float(line[48:63])
+        except ValueError:
+            continue
+        if (level > 0 and name != "" and name not in timers.keys()):
+            timers[name] = total
+    logFile.close()
+
+    return timers
+
 #-------------------------------------------------------------------------
 # namelist manupulation
 #-------------------------------------------------------------------------
@@ -182,54 +262,275 @@ def create_new_streams(filenameIn, filenameOut, changes):
     tree.write(filenameOut)
 
 #-------------------------------------------------------------------------
-# run the model
+# test directories
 #-------------------------------------------------------------------------
 
-def create_test_directory(directory):
+# tests run concurrently, so directories are created and test results are
+# printed under these locks
+directoryLock = threading.Lock()
+outputLock = threading.Lock()
+
+# netCDF4/HDF5 is not thread safe, so tests compare output files one at a
+# time under this lock
+netcdfLock = threading.Lock()
+
+#-------------------------------------------------------------------------
+
+def create_unique_directory(prefix, suffix=""):
+
+    # create the first available directory prefix_i.suffix and return its
+    # absolute path
+    with directoryLock:
+        i = 1
+        directory = "%s_%i%s" %(prefix,i,suffix)
+        while (os.path.exists(directory)):
+            i = i + 1
+            directory = "%s_%i%s" %(prefix,i,suffix)
+        os.mkdir(directory)
+
+    return os.path.abspath(directory)
+
+#-------------------------------------------------------------------------
+
+def create_test_directory(testName, configuration, domain):
+
+    return create_unique_directory(testName, ".%s.%s" %(configuration,domain))
+
+#-------------------------------------------------------------------------
+# shared model runs
+#-------------------------------------------------------------------------
+
+# Model runs requested by the tests. Runs that would give identical results
+# (same executable, domain, configuration, namelist and streams changes and
+# processor counts) are only executed once, in a shared directory, and linked
+# into each test directory that needs them. Runs are executed concurrently
+# within a budget of cores.
+runCache = {"directory": None,
+            "maxCores": None,
+            "coresUsed": 0,
+            "runs": {},
+            "lock": threading.Lock(),
+            "coresCondition": threading.Condition()}
+
+fileHashes = {}
+
+#-------------------------------------------------------------------------
+
+def init_run_cache(maxCores):
+
+    # if no core budget is given, runs are executed one at a time
+    runCache["directory"] = create_unique_directory("runs")
+    runCache["maxCores"] = maxCores
+
+#-------------------------------------------------------------------------
+
+def get_file_hash(filename):
+
+    filename = os.path.realpath(filename)
+
+    with runCache["lock"]:
+        if (filename in fileHashes):
+            return fileHashes[filename]
+
+    fileHash = hashlib.sha1()
+    fileIn = open(filename,"rb")
+    while (True):
+        data = fileIn.read(16*1024*1024)
+        if (not data):
+            break
+        fileHash.update(data)
+    fileIn.close()
+
+    with runCache["lock"]:
+        fileHashes[filename] = fileHash.hexdigest()
 
-    if (os.path.exists(directory)):
-        shutil.rmtree(directory)
-    os.mkdir(directory)
-    os.chdir(directory)
+    return fileHash.hexdigest()
 
 #-------------------------------------------------------------------------
 
-def run_model(runName, mpasDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile):
+def get_run_key(mpasDir, domainsDir, domain, configuration, stages, exclusive):
 
-    # create development directory
-    os.mkdir(runName)
-    os.chdir(runName)
+    # hash of everything that determines the output of a run
+    configurationDir = mpasDir+"/testing_and_setup/seaice/configurations/"+configuration
+
+    key = {"executable": get_file_hash(mpasDir + "/seaice_model"),
+           "domain": os.path.realpath(domainsDir + "/" + domain),
+           "manifest": get_file_hash(domainsDir + "/" + domain + "/mpas_seaice_domain_manifest"),
+           "namelist": get_file_hash(configurationDir + "/namelist.seaice"),
+           "streams": get_file_hash(configurationDir + "/streams.seaice"),
+           "stages": stages,
+           "exclusive": exclusive}
+
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+#-------------------------------------------------------------------------
+
+def acquire_cores(nProcs, exclusive):
+
+    condition = runCache["coresCondition"]
+
+    with condition:
+        if (runCache["maxCores"] == None):
+            nCores = 1
+            maxCores = 1
+        elif (exclusive):
+            maxCores = runCache["maxCores"]
+            nCores = maxCores
+        else:
+            # a run bigger than the budget runs on its own
+            maxCores = runCache["maxCores"]
+            nCores = min(nProcs, maxCores)
+
+        while (runCache["coresUsed"] + nCores > maxCores):
+            condition.wait(1.0)
+        runCache["coresUsed"] = runCache["coresUsed"] + nCores
+
+    return nCores
+
+#-------------------------------------------------------------------------
+
+def release_cores(nCores):
+
+    condition = runCache["coresCondition"]
+
+    with condition:
+        runCache["coresUsed"] = runCache["coresUsed"] - nCores
+        condition.notify_all()
+
+#-------------------------------------------------------------------------
+
+def execute_run(runDir, mpasDir, domainsDir, domain, configuration, stages, exclusive):
+
+    # execute the stages of a run: the first stage starts the model and any
+    # later stages restart it. Any failure, including setting up the run
+    # directory, gives a non-zero return code.
+    returnCode = 1
+    runLog = None
+    nCores = 0
+
+    try:
+        os.mkdir(runDir)
+        runLog = open(runDir + "/log_run.txt","w")
+
+        nCores = acquire_cores(max([stage["nProcs"] for stage in stages]), exclusive)
+
+        for iStage in range(0,len(stages)):
+            stage = stages[iStage]
+            if (iStage == 0):
+                returnCode = run_model(runDir, mpasDir, domainsDir, domain, configuration, stage["nmlChanges"], stage["streamChanges"], stage["nProcs"], runLog)
+            else:
+                returnCode = restart_model(runDir, stage["nmlChanges"], stage["streamChanges"], stage["nProcs"], runLog)
+            if (returnCode != 0):
+                break
+    except Exception:
+        if (runLog is not None):
+            traceback.print_exc(file=runLog)
+        else:
+            traceback.print_exc()
+        returnCode = 1
+    finally:
+        release_cores(nCores)
+        if (runLog is not None):
+            runLog.close()
+
+    return returnCode
+
+#-------------------------------------------------------------------------
+
+def run_model_shared(testDir, runName, mpasDir, domainsDir, domain, configuration, stages, exclusive, logfile):
+
+    key = get_run_key(mpasDir, domainsDir, domain, configuration, stages, exclusive)
+
+    # the first test to request a run executes it, others wait for it
+    with runCache["lock"]:
+        if (key in runCache["runs"]):
+            run = runCache["runs"][key]
+            owner = False
+        else:
+            run = {"directory": "%s/%s_%s" %(runCache["directory"], runName, key[:12]),
+                   "finished": threading.Event(),
+                   "returnCode": 1}
+            runCache["runs"][key] = run
+            owner = True
+
+    if (owner):
+        try:
+            run["returnCode"] = execute_run(run["directory"], mpasDir, domainsDir, domain, configuration, stages, exclusive)
+        finally:
+            run["finished"].set()
+    else:
+        while (not run["finished"].wait(1.0)):
+            pass
+
+    # link the run into the test directory
+    os.symlink(os.path.relpath(run["directory"], testDir), testDir + "/" + runName)
+
+    logfile.write("Run %s: %s (log_run.txt), return code: %i\n" %(runName, run["directory"], run["returnCode"]))
+    logfile.flush()
+
+    return run["returnCode"]
+
+#-------------------------------------------------------------------------
+
+def run_models(testDir, domainsDir, domain, configuration, runs, logfile):
+
+    # execute independent runs of a test concurrently. Each run is a
+    # dictionary with the run name, the MPAS directory and a list of stages,
+    # each with nmlChanges, streamChanges and nProcs. Runs with exclusive set
+    # (e.g. for timing) don't share the cores with any other run. Returns
+    # the return code of each run.
+    returnCodes = [1] * len(runs)
+
+    def run_thread(iRun):
+        run = runs[iRun]
+        returnCodes[iRun] = run_model_shared(testDir, run["name"], run["mpasDir"], domainsDir, domain, configuration, run["stages"], run.get("exclusive", False), logfile)
+
+    threads = []
+    for iRun in range(0,len(runs)):
+        thread = threading.Thread(target=run_thread, args=(iRun,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        while (thread.is_alive()):
+            thread.join(1.0)
+
+    return returnCodes
+
+#-------------------------------------------------------------------------
+# run the model
+#-------------------------------------------------------------------------
+
+def run_model(runDir, mpasDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile):
 
     # sym link executable
-    os.symlink(mpasDir + "/seaice_model", "seaice_model")
+    os.symlink(mpasDir + "/seaice_model", runDir + "/seaice_model")
 
     # get domain
-    get_domain(domainsDir, domain)
+    get_domain(runDir, domainsDir, domain)
 
     # create namelist file
-    create_new_namelist(mpasDir+"/testing_and_setup/seaice/configurations/"+configuration+"/namelist.seaice", "namelist.seaice", nmlChanges)
+    create_new_namelist(mpasDir+"/testing_and_setup/seaice/configurations/"+configuration+"/namelist.seaice", runDir + "/namelist.seaice", nmlChanges)
 
     # create streams file
-    create_new_streams(mpasDir+"/testing_and_setup/seaice/configurations/"+configuration+"/streams.seaice", "streams.seaice", streamChanges)
+    create_new_streams(mpasDir+"/testing_and_setup/seaice/configurations/"+configuration+"/streams.seaice", runDir + "/streams.seaice", streamChanges)
 
     # run the model
-    returnCode = execute_model(nProcs, logfile)
-
-    # up one level
-    os.chdir("..")
+    returnCode = execute_model(runDir, nProcs, logfile)
 
     return returnCode
 
 #-------------------------------------------------------------------------
 
-def get_domain(domainsDir, domain):
+def get_domain(runDir, domainsDir, domain):
 
     # create directories
-    if (not os.path.isdir("graphs")):
-        os.makedirs("graphs")
+    if (not os.path.isdir(runDir + "/graphs")):
+        os.makedirs(runDir + "/graphs")
 
-    if (not os.path.isdir("forcing")):
-        os.makedirs("forcing")
+    if (not os.path.isdir(runDir + "/forcing")):
+        os.makedirs(runDir + "/forcing")
 
     # read in manifest
     manifestFilename = domainsDir + "/" + domain + "/mpas_seaice_domain_manifest"
@@ -244,48 +545,45 @@ def get_domain(domainsDir, domain):
         inputManifestLine  = manifestLine.split()[0]
         outputManifestLine = manifestLine.split()[1]
 
-        create_sym_link(domainsDir, domain, inputManifestLine, outputManifestLine)
+        create_sym_link(runDir, domainsDir, domain, inputManifestLine, outputManifestLine)
 
 #-------------------------------------------------------------------------
 
-def create_sym_link(domainsDir, domain, inputManifestLine, outputManifestLine):
+def create_sym_link(runDir, domainsDir, domain, inputManifestLine, outputManifestLine):
 
-    cmd = "ln -s %s/%s/%s %s" %(domainsDir, domain, inputManifestLine, outputManifestLine)
-    os.system(cmd)
+    source = "%s/%s/%s" %(domainsDir, domain, inputManifestLine)
+    if (not os.path.exists(source)):
+        raise IOError("Domain file %s listed in manifest does not exist" %(source))
 
-#-------------------------------------------------------------------------
+    os.symlink(source, "%s/%s" %(runDir, outputManifestLine))
 
-def restart_model(runName, nmlChanges, streamChanges, nProcs, logfile):
+#-------------------------------------------------------------------------
 
-    # move to run dir
-    os.chdir(runName)
+def restart_model(runDir, nmlChanges, streamChanges, nProcs, logfile):
 
     # update namelist
-    os.rename("namelist.seaice","namelist.seaice.prev")
-    os.rename("streams.seaice","streams.seaice.prev")
+    os.rename(runDir + "/namelist.seaice", runDir + "/namelist.seaice.prev")
+    os.rename(runDir + "/streams.seaice", runDir + "/streams.seaice.prev")
 
     # update namelist
-    create_new_namelist("namelist.seaice.prev", "namelist.seaice", nmlChanges)
+    create_new_namelist(runDir + "/namelist.seaice.prev", runDir + "/namelist.seaice", nmlChanges)
 
     # create streams file
-    create_new_streams("streams.seaice.prev", "streams.seaice", streamChanges)
+    create_new_streams(runDir + "/streams.seaice.prev", runDir + "/streams.seaice", streamChanges)
 
     # run the model
-    returnCode = execute_model(nProcs, logfile)
-
-    # up one level
-    os.chdir("..")
+    returnCode = execute_model(runDir, nProcs, logfile)
 
     return returnCode
 
 #-------------------------------------------------------------------------
 
-def execute_model(nProcs, logfile):
+def execute_model(runDir, nProcs, logfile):
 
     import subprocess
 
     # execute mpirun -np np seaice_model
-    process = subprocess.Popen(["mpirun", "-np", "%i" %(nProcs), "seaice_model"], stdout=logfile, stderr=logfile)
+    process = subprocess.Popen(["mpirun", "-np", "%i" %(nProcs), "seaice_model"], cwd=runDir, stdout=logfile, stderr=logfile)
     returnCode = process.wait()
     logfile.flush()
     logfile.write("Return code: %i\n" %(returnCode))
@@ -8,33 +8,20 @@ from testing_utils import *
 
 def parallelism(mpasDevelopmentDir, domainsDir, domain, configuration, options, check):
 
-    # find available directory name
-    iTest = 1
-    dirExists = True
-    while (dirExists):
-        testDir = "parallelism_%i.%s.%s" %(iTest,configuration,domain)
-        iTest = iTest + 1
-        dirExists = os.path.isdir(testDir)
-
     # make a test directory
-    create_test_directory(testDir)
+    testDir = create_test_directory("parallelism", configuration, domain)
 
     title = "Test: Parallelism, Configuration: %s, Domain: %s" %(configuration,domain)
 
-    print_colour(title, "title")
-
-    logfile = open("log_test.txt","w")
+    logfile = open(testDir + "/log_test.txt","w")
     logfile.write(title)
 
-    multipleBlocks = False
-    if ("multipleBlocks" in options.keys() and options["multipleBlocks"] == "True"):
-        multipleBlocks = True
+    multipleBlocks = get_option_bool(options, "multipleBlocks", False)
 
-    print "multipleBlocks: ", multipleBlocks
     logfile.write("multipleBlocks: %s" %(multipleBlocks))
 
     # development run
-    nProcs = 16
+    nProcs = get_option_int(options, "nProcs1", 16)
 
     nmlChanges = {"seaice_model": {"config_run_duration":'24:00:00'}}
     if (check):
@@ -43,22 +30,16 @@ def parallelism(mpasDevelopmentDir, domainsDir, domain, configuration, options,
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("development1", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("parallelism")
-        os.chdir("..")
-        return 1
+    stages1 = [{"nmlChanges":nmlChanges, "streamChanges":streamChanges, "nProcs":nProcs}]
 
-    # base run
-    nProcs = 32
+    # second development run
+    nProcs = get_option_int(options, "nProcs2", 32)
 
     if (not multipleBlocks):
         nmlChanges = {"seaice_model": {"config_run_duration":'24:00:00'}}
     else:
         nmlChanges = {"seaice_model": {"config_run_duration":'24:00:00'},
-                     "decomposition": {"config_block_decomp_file_prefix":'graphs/graph.info.eq.part.',
-                                       "config_number_of_blocks": 96,
-                                       "config_explicit_proc_decomp": True,
-                                       "config_proc_decomp_file_prefix":'graphs/graph.info.eq_block.part.'}}
+                     "decomposition": get_decomposition_changes(get_option_int(options, "nBlocks", 96))}
 
     if (check):
         nmlChanges["unit_test"] = {"config_testing_system_test":True}
@@ -66,30 +47,44 @@ def parallelism(mpasDevelopmentDir, domainsDir, domain, configuration, options,
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("development2", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("parallelism")
-        os.chdir("..")
-        return 1
+    stages2 = [{"nmlChanges":nmlChanges, "streamChanges":streamChanges, "nProcs":nProcs}]
+
+    runs = [{"name":"development1", "mpasDir":mpasDevelopmentDir, "stages":stages1},
+            {"name":"development2", "mpasDir":mpasDevelopmentDir, "stages":stages2}]
 
+    returnCodes = run_models(testDir, domainsDir, domain, configuration, runs, logfile)
 
-    # compare
+    if (returnCodes != [0] * len(runs)):
+        with outputLock:
+            print_colour(title, "title")
+            print "multipleBlocks: ", multipleBlocks
+            run_failed("parallelism")
+        logfile.close()
+        return 1
+
+    # compare, outside the output lock so other tests can report meanwhile
     restart_file = "restart.2000-01-02_00.00.00.nc"
 
-    file1 = "./development1/restarts/%s" %(restart_file)
-    file2 = "./development2/restarts/%s" %(restart_file)
+    file1 = testDir + "/development1/restarts/%s" %(restart_file)
+    file2 = testDir + "/development2/restarts/%s" %(restart_file)
 
     ignoreVarname = ["cellsOnCell","verticesOnCell","edgesOnEdge","edgesOnCell"]
     if (check):
         ignoreVarname.append("testArrayReproducibility")
         ignoreVarname.append("testArrayRestartability")
 
-    nErrorsArray, nErrorsNonArray = compare_files(file1,file2,logfile,ignoreVarname)
+    with netcdfLock:
+        nErrorsArray, nErrorsNonArray = compare_files(file1,file2,logfile,ignoreVarname)
 
-    failed = test_summary(nErrorsNonArray, nErrorsArray, logfile, "parallelism")
+    with outputLock:
 
-    logfile.close()
+        print_colour(title, "title")
+
+        print "multipleBlocks: ", multipleBlocks
 
-    os.chdir("..")
+        failed = test_summary(nErrorsNonArray, nErrorsArray, logfile, "parallelism")
+
+    logfile.close()
 
     return failed
 
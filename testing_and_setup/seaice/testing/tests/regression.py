@@ -8,26 +8,16 @@ from testing_utils import *
 
 def regression(mpasDevelopmentDir, mpasBaseDir, domainsDir, domain, configuration, options, check):
 
-    # find available directory name
-    iTest = 1
-    dirExists = True
-    while (dirExists):
-        testDir = "regression_%i.%s.%s" %(iTest,configuration,domain)
-        iTest = iTest + 1
-        dirExists = os.path.isdir(testDir)
-
     # make a test directory
-    create_test_directory(testDir)
+    testDir = create_test_directory("regression", configuration, domain)
 
     title = "Test: Regression, Configuration: %s, Domain: %s" %(configuration,domain)
 
-    print_colour(title, "title")
-
-    logfile = open("log_test.txt","w")
+    logfile = open(testDir + "/log_test.txt","w")
     logfile.write(title)
 
-    # development run
-    nProcs = 16
+    # development and base runs
+    nProcs = get_option_int(options, "nProcs", 16)
 
     nmlChanges = {"seaice_model": {"config_run_duration":'24:00:00'}}
     if (check):
@@ -36,44 +26,40 @@ def regression(mpasDevelopmentDir, mpasBaseDir, domainsDir, domain, configuratio
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("development", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("regression")
-        os.chdir("..")
-        return 1
+    stages = [{"nmlChanges":nmlChanges, "streamChanges":streamChanges, "nProcs":nProcs}]
 
-    # base run
-    nProcs = 16
+    runs = [{"name":"development", "mpasDir":mpasDevelopmentDir, "stages":stages},
+            {"name":"base"       , "mpasDir":mpasBaseDir       , "stages":stages}]
 
-    nmlChanges = {"seaice_model": {"config_run_duration":'24:00:00'}}
-    if (check):
-        nmlChanges["unit_test"] = {"config_testing_system_test":True}
+    returnCodes = run_models(testDir, domainsDir, domain, configuration, runs, logfile)
 
-    streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
-                     {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
-
-    if (run_model("base", mpasBaseDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("regression")
-        os.chdir("..")
+    if (returnCodes != [0] * len(runs)):
+        with outputLock:
+            print_colour(title, "title")
+            run_failed("regression")
+        logfile.close()
         return 1
 
-
-    # compare
+    # compare, outside the output lock so other tests can report meanwhile
     restart_file = "restart.2000-01-02_00.00.00.nc"
 
-    file1 = "./development/restarts/%s" %(restart_file)
-    file2 = "./base/restarts/%s" %(restart_file)
+    file1 = testDir + "/development/restarts/%s" %(restart_file)
+    file2 = testDir + "/base/restarts/%s" %(restart_file)
 
     ignoreVarname = None
     if (check):
         ignoreVarname = ["testArrayParallelism","testArrayRestartability"]
 
-    nErrorsArray, nErrorsNonArray = compare_files(file1,file2,logfile)
+    with netcdfLock:
+        nErrorsArray, nErrorsNonArray = compare_files(file1,file2,logfile)
 
-    failed = test_summary(nErrorsNonArray, nErrorsArray, logfile, "regression")
+    with outputLock:
 
-    logfile.close()
+        print_colour(title, "title")
+
+        failed = test_summary(nErrorsNonArray, nErrorsArray, logfile, "regression")
 
-    os.chdir("..")
+    logfile.close()
 
     return failed
 
@@ -8,26 +8,16 @@ from testing_utils import *
 
 def restartability(mpasDevelopmentDir, domainsDir, domain, configuration, options, check):
 
-    # find available directory name
-    iTest = 1
-    dirExists = True
-    while (dirExists):
-        testDir = "restartability_%i.%s.%s" %(iTest,configuration,domain)
-        iTest = iTest + 1
-        dirExists = os.path.isdir(testDir)
-
     # make a test directory
-    create_test_directory(testDir)
+    testDir = create_test_directory("restartability", configuration, domain)
 
     title = "Test: Restartability, Configuration: %s, Domain: %s" %(configuration,domain)
 
-    print_colour(title, "title")
-
-    logfile = open("log_test.txt","w")
+    logfile = open(testDir + "/log_test.txt","w")
     logfile.write(title)
 
     # base run
-    nProcs = 16
+    nProcs = get_option_int(options, "nProcs", 16)
 
     nmlChanges = {"seaice_model": {"config_run_duration":'24:00:00'}}
     if (check):
@@ -36,13 +26,10 @@ def restartability(mpasDevelopmentDir, domainsDir, domain, configuration, option
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("base", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("restartability")
-        os.chdir("..")
-        return 1
+    baseStages = [{"nmlChanges":nmlChanges, "streamChanges":streamChanges, "nProcs":nProcs}]
 
     # first restart run
-    nProcs = 16
+    nProcs = get_option_int(options, "nProcs", 16)
 
     nmlChanges = {"seaice_model": {"config_run_duration":'12:00:00'}}
     if (check):
@@ -51,13 +38,10 @@ def restartability(mpasDevelopmentDir, domainsDir, domain, configuration, option
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"12:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("restart", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("restartability")
-        os.chdir("..")
-        return 1
+    restartStages = [{"nmlChanges":nmlChanges, "streamChanges":streamChanges, "nProcs":nProcs}]
 
     # restart
-    nProcs = 32
+    nProcs = get_option_int(options, "nProcsRestart", 32)
 
     nmlChanges = {"seaice_model": {"config_start_time":"file"},
                   "restart":    {"config_do_restart":True}}
@@ -66,30 +50,41 @@ def restartability(mpasDevelopmentDir, domainsDir, domain, configuration, option
 
     streamChanges = []
 
-    if (restart_model("restart", nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("restartability")
-        os.chdir("..")
-        return 1
+    restartStages.append({"nmlChanges":nmlChanges, "streamChanges":streamChanges, "nProcs":nProcs})
+
+    runs = [{"name":"base"   , "mpasDir":mpasDevelopmentDir, "stages":baseStages},
+            {"name":"restart", "mpasDir":mpasDevelopmentDir, "stages":restartStages}]
 
+    returnCodes = run_models(testDir, domainsDir, domain, configuration, runs, logfile)
 
-    # compare
+    if (returnCodes != [0] * len(runs)):
+        with outputLock:
+            print_colour(title, "title")
+            run_failed("restartability")
+        logfile.close()
+        return 1
+
+    # compare, outside the output lock so other tests can report meanwhile
     restart_file = "restart.2000-01-02_00.00.00.nc"
 
-    file1 = "./base/restarts/%s" %(restart_file)
-    file2 = "./restart/restarts/%s" %(restart_file)
+    file1 = testDir + "/base/restarts/%s" %(restart_file)
+    file2 = testDir + "/restart/restarts/%s" %(restart_file)
 
     ignoreVarname = ["cellsOnCell","verticesOnCell","edgesOnEdge","edgesOnCell"]
     if (check):
         ignoreVarname.append("testArrayParallelism")
         ignoreVarname.append("testArrayReproducibility")
 
-    nErrorsArray, nErrorsNonArray = compare_files(file1,file2,logfile,ignoreVarname)
+    with netcdfLock:
+        nErrorsArray, nErrorsNonArray = compare_files(file1,file2,logfile,ignoreVarname)
 
-    failed = test_summary(nErrorsNonArray, nErrorsArray, logfile, "restartability")
+    with outputLock:
 
-    logfile.close()
+        print_colour(title, "title")
 
-    os.chdir("..")
+        failed = test_summary(nErrorsNonArray, nErrorsArray, logfile, "restartability")
+
+    logfile.close()
 
     return failed
 
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import os, shutil
+from compare_mpas_files import compare_files
+from testing_utils import *
+
+#-------------------------------------------------------------------------
+
+def scaling(mpasDevelopmentDir, domainsDir, domain, configuration, options, check):
+
+    # make a test directory
+    testDir = create_test_directory("scaling", configuration, domain)
+
+    title = "Test: Scaling, Configuration: %s, Domain: %s" %(configuration,domain)
+
+    logfile = open(testDir + "/log_test.txt","w")
+    logfile.write(title)
+
+    # processor counts and timers from the test options
+    nProcsList = get_option_int_list(options, "nProcs", [16,32,64])
+
+    multipleBlocks = get_option_bool(options, "multipleBlocks", False)
+    nBlocksList = get_option_int_list(options, "nBlocks", [96])
+    if (len(nBlocksList) == 1):
+        nBlocksList = nBlocksList * len(nProcsList)
+    if (len(nBlocksList) != len(nProcsList)):
+        raise ValueError("Test option nBlocks must have one value, or one for each of nProcs")
+
+    timerNames = ["total time", "time integration"]
+    if ("timers" in options.keys()):
+        timerNames = [timerName.strip() for timerName in options["timers"].split(",")]
+
+    # runs at each processor count, which are timed so run exclusively
+    runs = []
+    for iRun in range(0,len(nProcsList)):
+
+        nmlChanges = {"seaice_model": {"config_run_duration":'24:00:00'}}
+        if (multipleBlocks):
+            nmlChanges["decomposition"] = get_decomposition_changes(nBlocksList[iRun])
+        if (check):
+            nmlChanges["unit_test"] = {"config_testing_system_test":True}
+
+        streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
+                         {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
+
+        stages = [{"nmlChanges":nmlChanges, "streamChanges":streamChanges, "nProcs":nProcsList[iRun]}]
+
+        runs.append({"name":"procs%i" %(nProcsList[iRun]), "mpasDir":mpasDevelopmentDir, "stages":stages, "exclusive":True})
+
+    returnCodes = run_models(testDir, domainsDir, domain, configuration, runs, logfile)
+
+    logfile.write("nProcs: %s\n" %(nProcsList))
+
+    if (returnCodes != [0] * len(runs)):
+        with outputLock:
+            print_colour(title, "title")
+            print "nProcs: ", nProcsList
+            run_failed("scaling")
+        logfile.close()
+        return 1
+
+    # compare all runs against the first, outside the output lock so other
+    # tests can report meanwhile
+    restart_file = "restart.2000-01-02_00.00.00.nc"
+
+    ignoreVarname = ["cellsOnCell","verticesOnCell","edgesOnEdge","edgesOnCell"]
+    if (check):
+        ignoreVarname.append("testArrayReproducibility")
+        ignoreVarname.append("testArrayRestartability")
+
+    nErrorsArray = 0
+    nErrorsNonArray = 0
+
+    file1 = testDir + "/%s/restarts/%s" %(runs[0]["name"],restart_file)
+    for run in runs[1:]:
+        file2 = testDir + "/%s/restarts/%s" %(run["name"],restart_file)
+        with netcdfLock:
+            nErrorsArrayRun, nErrorsNonArrayRun = compare_files(file1,file2,logfile,ignoreVarname)
+        nErrorsArray = nErrorsArray + nErrorsArrayRun
+        nErrorsNonArray = nErrorsNonArray + nErrorsNonArrayRun
+
+    timers = [read_timers(testDir + "/" + run["name"]) for run in runs]
+
+    with outputLock:
+
+        print_colour(title, "title")
+
+        print "nProcs: ", nProcsList
+
+        # report timers, with speedup and parallel efficiency relative to the
+        # first processor count
+        for timerName in timerNames:
+
+            print "Timer: %s" %(timerName)
+            logfile.write("Timer: %s\n" %(timerName))
+
+            line = "%10s %15s %10s %12s" %("nProcs", "time (s)", "speedup", "efficiency")
+            print line
+            logfile.write(line + "\n")
+
+            for iRun in range(0,len(runs)):
+                if (timerName not in timers[0].keys() or timerName not in timers[iRun].keys()):
+                    line = "%10i %15s" %(nProcsList[iRun], "not available")
+                else:
+                    timerTotal = timers[iRun][timerName]
+                    if (timerTotal > 0.0):
+                        speedup = timers[0][timerName] / timerTotal
+                    else:
+                        speedup = 0.0
+                    efficiency = speedup * float(nProcsList[0]) / float(nProcsList[iRun])
+                    line = "%10i %15.5f %10.3f %11.1f%%" %(nProcsList[iRun], timerTotal, speedup, efficiency * 100.0)
+                print line
+                logfile.write(line + "\n")
+
+        failed = test_summary(nErrorsNonArray, nErrorsArray, logfile, "scaling")
+
+    logfile.close()
+
+    return failed
+
+#-------------------------------------------------------------------------